@@ -2,34 +2,441 @@ import time
 import threading
 import uuid
 import os
+import platform
+import re
+import asyncio
+import bisect
+import random
+import sys
+import json
+import hashlib
+import io
+import logging
+import sqlite3
+import queue
+import urllib.parse
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from flask import Flask, render_template, jsonify, request, redirect, url_for, session, send_from_directory
-from flask_socketio import SocketIO, emit, join_room
+from flask_socketio import SocketIO, emit, join_room, leave_room as leave_socket_room  # leave_room 是 /api/leave 的视图函数
 from playwright.sync_api import sync_playwright
-from werkzeug.utils import secure_filename
+import requests
+import requests.adapters
 
 # ----------------------------
 # Flask App Setup
 # ----------------------------
 app = Flask(__name__)
 app.secret_key = "luogu-duels-secret"
-app.config["AVATAR_FOLDER"] = "static/avatars"
-app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB max file size
+app.config["AVATAR_FOLDER"] = os.path.join(app.root_path, "static", "avatars")
+# 头像：上传文件和像素数的上限、缩略图边长（像素），以及按内容哈希命名的缩略图的缓存时间（秒）
+app.config["AVATAR_MAX_BYTES"] = int(os.environ.get("AVATAR_MAX_BYTES", 4 * 1024 * 1024))
+app.config["AVATAR_MAX_PIXELS"] = int(os.environ.get("AVATAR_MAX_PIXELS", 25_000_000))
+app.config["AVATAR_SIZE"] = int(os.environ.get("AVATAR_SIZE", 128))
+app.config["AVATAR_CACHE_MAX_AGE"] = 365 * 86400
+app.config["MAX_CONTENT_LENGTH"] = app.config["AVATAR_MAX_BYTES"] + 64 * 1024  # 头像加上表单的其他字段
+# 浏览器池：同时存在的 Chromium 进程数，以及每个 context 复用多少次后重建
+app.config["BROWSER_POOL_SIZE"] = int(os.environ.get("BROWSER_POOL_SIZE", 2))
+app.config["BROWSER_CONTEXT_MAX_USES"] = int(os.environ.get("BROWSER_CONTEXT_MAX_USES", 50))
+app.config["BROWSER_FETCH_TIMEOUT"] = 90  # 排队 + 抓取的总超时（秒）
+# 洛谷地址（可以指向本地的桩服务器做离线测试）以及记录抓取后端："http" 或 "playwright"
+app.config["LUOGU_BASE_URL"] = os.environ.get("LUOGU_BASE_URL", "https://www.luogu.com.cn")
+app.config["RECORD_FETCHER"] = os.environ.get("RECORD_FETCHER", "http")
+app.config["RECORD_MAX_PAGES"] = int(os.environ.get("RECORD_MAX_PAGES", 5))  # 增量扫描时最多往后翻几页
+# 评测调度：新房间的轮询间隔，以及自适应间隔的上下限（秒）；同一扫描键两次抓取至少隔 JUDGE_MIN_INTERVAL
+app.config["JUDGE_INTERVAL"] = int(os.environ.get("JUDGE_INTERVAL", 10))
+app.config["JUDGE_MIN_INTERVAL"] = int(os.environ.get("JUDGE_MIN_INTERVAL", 5))
+app.config["JUDGE_MAX_INTERVAL"] = int(os.environ.get("JUDGE_MAX_INTERVAL", 60))
+# 全局抓取速率上限（次/秒）
+app.config["JUDGE_MAX_FETCHES_PER_SEC"] = float(os.environ.get("JUDGE_MAX_FETCHES_PER_SEC", 2))
+app.config["JUDGE_CONCURRENCY"] = int(os.environ.get("JUDGE_CONCURRENCY", 8))  # 同时进行的抓取任务数
+# AC 结果缓存：确认“还没 AC”的结论多久内有效（秒）；AC 过的结论永久有效
+app.config["AC_NEGATIVE_TTL"] = float(os.environ.get("AC_NEGATIVE_TTL", app.config["JUDGE_MIN_INTERVAL"]))
+# 持久化：SQLite 文件路径和批量写盘间隔（秒）
+app.config["DATABASE"] = os.environ.get("DATABASE", "luogu_duels.db")
+app.config["STORE_FLUSH_INTERVAL"] = float(os.environ.get("STORE_FLUSH_INTERVAL", 2))
+# 房间生命周期：没人连着且闲置多久、或者结束多久之后归档出内存（秒）
+app.config["ROOM_IDLE_TTL"] = int(os.environ.get("ROOM_IDLE_TTL", 3600))
+app.config["ROOM_FINISHED_TTL"] = int(os.environ.get("ROOM_FINISHED_TTL", 600))
+app.config["LIFECYCLE_SWEEP_INTERVAL"] = 30
+# 题目信息缓存：存在的题目和不存在的题目各缓存多久（秒），内存里最多缓存多少道（数据库里不限）
+app.config["PROBLEM_CACHE_TTL"] = int(os.environ.get("PROBLEM_CACHE_TTL", 86400))
+app.config["PROBLEM_MISSING_TTL"] = int(os.environ.get("PROBLEM_MISSING_TTL", 600))
+app.config["PROBLEM_CACHE_SIZE"] = int(os.environ.get("PROBLEM_CACHE_SIZE", 2048))
+app.config["PROPOSAL_HISTORY"] = int(os.environ.get("PROPOSAL_HISTORY", 50))  # 每个房间保留多少条已处理的申请
+app.config["ROOM_SNAPSHOT_EVERY"] = int(os.environ.get("ROOM_SNAPSHOT_EVERY", 100))  # 事件日志每多少条事件拍一次房间快照
+# 队内聊天：每个队伍保留多少条历史、每页多少条、攒批发送的时间窗口（秒）、每个用户的限速（条/秒和突发条数）以及单条最大长度
+app.config["CHAT_HISTORY"] = int(os.environ.get("CHAT_HISTORY", 200))
+app.config["CHAT_PAGE_SIZE"] = int(os.environ.get("CHAT_PAGE_SIZE", 50))
+app.config["CHAT_BATCH_WINDOW"] = float(os.environ.get("CHAT_BATCH_WINDOW", 0.1))
+app.config["CHAT_RATE"] = float(os.environ.get("CHAT_RATE", 1))
+app.config["CHAT_BURST"] = int(os.environ.get("CHAT_BURST", 5))
+app.config["CHAT_MAX_LENGTH"] = 500
+# 报记录核验：每个用户的限速（次/秒和突发次数）、同时排队的核验数上限，以及 /api/claim 最多等多久（秒）
+app.config["CLAIM_RATE"] = float(os.environ.get("CLAIM_RATE", 0.2))
+app.config["CLAIM_BURST"] = int(os.environ.get("CLAIM_BURST", 3))
+app.config["CLAIM_MAX_PENDING"] = int(os.environ.get("CLAIM_MAX_PENDING", 32))
+app.config["CLAIM_TIMEOUT"] = 15
+# 房间事件的二进制传输（需要 msgpack）：是否向客户端提供，以及编码后超过多少字节再压缩
+app.config["WIRE_BINARY"] = os.environ.get("WIRE_BINARY", "1") == "1"
+app.config["WIRE_COMPRESS_THRESHOLD"] = int(os.environ.get("WIRE_COMPRESS_THRESHOLD", 512))
+# 观战：给观众推送状态的最短间隔（秒），这段时间里的多次变化合并成一次
+app.config["SPECTATOR_INTERVAL"] = float(os.environ.get("SPECTATOR_INTERVAL", 1))
+# 多 worker 部署：共享房间状态的 Redis 地址（留空则只在本进程内共享，也就是单机模式）、
+# SocketIO 广播用的消息队列（通常是同一个 Redis），以及本 worker 的名字
+app.config["SHARED_STATE_URL"] = os.environ.get("SHARED_STATE_URL", "")
+app.config["SOCKETIO_MESSAGE_QUEUE"] = os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None
+app.config["WORKER_ID"] = os.environ.get("WORKER_ID") or f"{platform.node()}-{os.getpid()}"
+app.config["CLUSTER_LOCK_TTL"] = 10000    # 跨 worker 房间锁的过期时间（毫秒），持有者挂掉后自动释放
+app.config["CLUSTER_JUDGE_LEASE"] = 15000  # 判题租约（毫秒），每秒续约，worker 挂掉后由别的 worker 接手
+# 日志：级别，以及采样——同一条日志模板每 LOG_SAMPLE_INTERVAL 秒最多输出 LOG_SAMPLE_BURST 次（WARNING 及以上不采样）
+app.config["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "INFO").upper()
+app.config["LOG_SAMPLE_INTERVAL"] = float(os.environ.get("LOG_SAMPLE_INTERVAL", 10))
+app.config["LOG_SAMPLE_BURST"] = int(os.environ.get("LOG_SAMPLE_BURST", 20))
 os.makedirs(app.config["AVATAR_FOLDER"], exist_ok=True)
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# ----------------------------
+# Metrics & Logging
+# 进程内的 Prometheus 指标，由 /metrics 按文本格式导出；没有引入 prometheus_client，
+# 多 worker 部署时每个 worker 各自导出，由 Prometheus 按实例汇总。
+# ----------------------------
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """计数器和直方图在代码里直接累加；仪表盘（队列深度、房间延迟等）在抓取 /metrics 时由 collector 现算。"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.meta = {}        # name -> (类型, 说明, 直方图的桶)
+        self.values = {}      # name -> {标签: 值}；直方图的值是 [各个桶的计数..., 总和, 次数]
+        self.collectors = []  # 抓取时调用，产出 (name, 类型, 说明, {标签: 值})
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.meta[name] = (kind, help_text, buckets)
+        self.values[name] = {}
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = self.meta[name][2]
+        key = self._labels(labels)
+        with self.lock:
+            series = self.values[name].get(key)
+            if series is None:
+                series = self.values[name][key] = [0] * (len(buckets) + 2)
+            # 桶是累计的：落在 le=b 的观测也计入所有更大的桶
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{self._escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {self.prefix}{name} {help_text}")
+            lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        with self.lock:
+            snapshot = {name: {key: list(v) if isinstance(v, list) else v for key, v in series.items()}
+                        for name, series in self.values.items()}
+        for name, (kind, help_text, buckets) in self.meta.items():
+            header(name, kind, help_text)
+            for key, value in snapshot[name].items():
+                if kind != "histogram":
+                    lines.append(f"{self.prefix}{name}{self._format_labels(key)} {value}")
+                    continue
+                for bound, count in zip(buckets, value):
+                    lines.append(f"{self.prefix}{name}_bucket{self._format_labels(key, [('le', bound)])} {count}")
+                lines.append(f"{self.prefix}{name}_bucket{self._format_labels(key, [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{self.prefix}{name}_sum{self._format_labels(key)} {value[-2]}")
+                lines.append(f"{self.prefix}{name}_count{self._format_labels(key)} {value[-1]}")
+        for collect in self.collectors:
+            for name, kind, help_text, samples in collect():
+                header(name, kind, help_text)
+                for labels, value in samples.items():
+                    lines.append(f"{self.prefix}{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics("luogu_duels_")
+metrics.describe("fetch_seconds", "histogram", "Upstream fetch latency by backend and target (pid, user, problem).", LATENCY_BUCKETS)
+metrics.describe("browser_pool_wait_seconds", "histogram", "Time a Playwright job waited for a free browser.", LATENCY_BUCKETS)
+metrics.describe("judge_dispatch_seconds", "histogram", "Time spent planning one judge scheduler tick.", LATENCY_BUCKETS)
+metrics.describe("judge_cycle_seconds", "histogram", "Time from a room becoming due until all of its fetches finished.", LATENCY_BUCKETS)
+metrics.describe("errors_total", "counter", "Errors by component and exception type.")
+metrics.describe("socketio_emits_total", "counter", "SocketIO events emitted by this worker.")
+metrics.describe("socketio_payload_bytes_total", "counter", "Encoded SocketIO payload bytes per emit, before fan-out to clients.")
+metrics.describe("log_suppressed_total", "counter", "Log lines dropped by sampling.")
+metrics.describe("chat_messages_total", "counter", "Chat messages accepted, including system messages.")
+metrics.describe("chat_rate_limited_total", "counter", "Chat messages rejected by the per-user rate limit.")
+metrics.describe("claims_total", "counter", "Solve claims by outcome.")
+metrics.describe("avatars_total", "counter", "Avatar uploads by outcome (stored, deduplicated, rejected, failed).")
+metrics.describe("avatar_process_seconds", "histogram", "Time to decode, resize and store one avatar.", LATENCY_BUCKETS)
+
+def count_error(component, e):
+    metrics.inc("errors_total", component=component, type=type(e).__name__)
+
+
+class SampledLogFilter(logging.Filter):
+    """同一条日志模板（未格式化的 msg）在 interval 秒内最多放行 burst 条，WARNING 及以上全部放行。
+    热点路径（每次抓取都打的日志）因此不会刷屏，被略过的条数附在下一个窗口的第一条后面。"""
+    def __init__(self, interval, burst):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}  # (级别, 模板) -> [窗口开始时间, 已放行, 已略过]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.time()
+        with self.lock:
+            window = self.windows.setdefault((record.levelno, record.msg), [now, 0, 0])
+            if now - window[0] >= self.interval:
+                if window[2]:
+                    record.msg = f"{record.msg} (上个 {self.interval:g} 秒内略过 {window[2]} 条同类日志)"
+                window[:] = [now, 0, 0]
+            if window[1] >= self.burst:
+                window[2] += 1
+                suppressed = True
+            else:
+                window[1] += 1
+                suppressed = False
+        if suppressed:
+            metrics.inc("log_suppressed_total", level=record.levelname.lower())
+        return not suppressed
+
+log = logging.getLogger("luogu_duels")
+log.setLevel(app.config["LOG_LEVEL"])
+log.propagate = False
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+_log_handler.addFilter(SampledLogFilter(app.config["LOG_SAMPLE_INTERVAL"], app.config["LOG_SAMPLE_BURST"]))
+log.addHandler(_log_handler)
+
+
+def payload_size(args):
+    size = 0
+    for arg in args:
+        if isinstance(arg, (bytes, bytearray)):
+            size += len(arg)
+        else:
+            size += len(json.dumps(arg, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8"))
+    return size
+
+class InstrumentedSocketIO(SocketIO):
+    """统计每种事件的发送次数和负载大小。flask_socketio.emit() 最终也走这里。"""
+    def emit(self, event, *args, **kwargs):
+        metrics.inc("socketio_emits_total", event=event)
+        metrics.inc("socketio_payload_bytes_total", payload_size(args), event=event)
+        return super().emit(event, *args, **kwargs)
+
+# 配了消息队列时，任何 worker（包括判题线程）发出的广播都会经由它转发给所有 worker 上的客户端。
+# 负载均衡需要对 SocketIO 连接开启会话粘滞。
+socketio = InstrumentedSocketIO(app, cors_allowed_origins="*", message_queue=app.config["SOCKETIO_MESSAGE_QUEUE"])
+
+# ----------------------------
+# Wire Format (binary room events)
+# 房间频道上的事件（patch / snapshot / game_over / 申请通知）默认发 JSON。客户端在 join_room 时声明支持
+# WIRE_FORMAT 的话改发二进制帧：1 字节标志（0 原样，1 zlib）+ 两个连续的 msgpack 对象，字符串表和消息体。
+# 消息体里重复出现的字符串（队名、用户名、题号，以及 "proposer" 这类重复的键）换成指向字符串表的
+# ext 引用，编码后超过 WIRE_COMPRESS_THRESHOLD 字节再整体压缩。帧只取决于消息本身、和连接无关，
+# 一次编码就能发给房间里所有二进制客户端。浏览器端的解码在 static/wire.js。
+# msgpack 没装或者关掉了 WIRE_BINARY 时不提供二进制格式，客户端照旧收 JSON。
+# ----------------------------
+WIRE_FORMAT = "msgpack-z1"
+
+class WireCodec:
+    REF = 0  # msgpack ext 类型：数据是字符串表的下标（大端，1/2/4 字节）
+
+    def __init__(self, compress_threshold, enabled=True):
+        self.compress_threshold = compress_threshold
+        self.msgpack = None
+        if enabled:
+            try:
+                import msgpack
+                self.msgpack = msgpack
+            except ImportError:
+                log.info("msgpack is not installed, room events are sent as JSON only")
+
+    @property
+    def available(self):
+        return self.msgpack is not None
+
+    def _count(self, value, counts):
+        if isinstance(value, str):
+            counts[value] = counts.get(value, 0) + 1
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                self._count(key, counts)
+                self._count(item, counts)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                self._count(item, counts)
+
+    def _intern(self, value, refs):
+        if isinstance(value, str):
+            return refs.get(value, value)
+        if isinstance(value, dict):
+            return {self._intern(key, refs): self._intern(item, refs) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._intern(item, refs) for item in value]
+        return value
+
+    def encode(self, payload):
+        counts = {}
+        self._count(payload, counts)
+        # 引用占 3 字节（下标超过 255 时 4 字节），只有省下来的比表里多存一份更多时才值得放进表
+        table = [s for s, n in counts.items() if n > 1 and (n - 1) * (len(s.encode("utf-8")) + 1) > 3 * n]
+        refs = {}
+        for index, s in enumerate(table):
+            refs[s] = self.msgpack.ExtType(self.REF, index.to_bytes(1 if index < 0x100 else 2 if index < 0x10000 else 4, "big"))
+        body = self.msgpack.packb(table) + self.msgpack.packb(self._intern(payload, refs))
+        if len(body) > self.compress_threshold:
+            compressed = zlib.compress(body, 6)
+            if len(compressed) < len(body):
+                return b"\x01" + compressed
+        return b"\x00" + body
+
+    def decode(self, frame):
+        """encode 的逆过程，给 Python 写的客户端和基准测试用。"""
+        body = zlib.decompress(frame[1:]) if frame[0] == 1 else frame[1:]
+        table = []
+        unpacker = self.msgpack.Unpacker(
+            ext_hook=lambda code, data: table[int.from_bytes(data, "big")], strict_map_key=False,
+        )
+        unpacker.feed(body)
+        table.extend(next(unpacker))
+        return next(unpacker)
+
+wire = WireCodec(app.config["WIRE_COMPRESS_THRESHOLD"], app.config["WIRE_BINARY"])
+# 协商了二进制格式的连接不加入 room_id 本身，而是加入 wire_room(room_id)，两边各收各的格式
+wire_lock = threading.Lock()
+wire_clients = {}  # sid -> 这个连接以二进制格式加入的房间
+wire_rooms = {}    # room_id -> 本 worker 上的二进制连接数
+
+def wire_room(room_id):
+    return f"{room_id}#{WIRE_FORMAT}"
+
+def wire_subscribe(sid, room_id):
+    with wire_lock:
+        joined = wire_clients.setdefault(sid, set())
+        if room_id not in joined:
+            joined.add(room_id)
+            wire_rooms[room_id] = wire_rooms.get(room_id, 0) + 1
+    join_room(wire_room(room_id))
+
+def wire_unsubscribe(sid):
+    with wire_lock:
+        for room_id in wire_clients.pop(sid, ()):
+            wire_rooms[room_id] -= 1
+            if not wire_rooms[room_id]:
+                del wire_rooms[room_id]
+
+def emit_room(event, payload, room_id):
+    """向房间频道广播：JSON 客户端收原样的 payload，二进制客户端收编码后的帧。"""
+    socketio.emit(event, payload, room=room_id)
+    # 多 worker 时不知道别的 worker 上有没有二进制客户端，总是编码
+    if wire.available and (cluster.distributed or room_id in wire_rooms):
+        socketio.emit(event, wire.encode(payload), room=wire_room(room_id))
+
+def emit_client(event, payload):
+    """回复当前连接，按它协商的格式编码。"""
+    emit(event, wire.encode(payload) if request.sid in wire_clients else payload)
 
 # ----------------------------
-# Global State (Memory-based)
+# Global State (in-memory hot cache, persisted by Store)
 # ----------------------------
 users = {}  # user_id -> {luogu_name, avatar}
 rooms = {}  # room_id -> Room object
 
+class FrozenDict(dict):
+    """只读字典：缓存的房间快照被多个调用方共享，不允许原地修改。"""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("room snapshot is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+def freeze(value):
+    """深拷贝成只读结构：dict -> FrozenDict，list/set/deque -> tuple。"""
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset, deque)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+class RoomLock:
+    """房间锁。单机时就是一把可重入锁；房间登记到共享存储后（多 worker 部署），最外层加锁时还会
+    拿到跨 worker 的分布式锁并加载其他 worker 写入的新状态，释放前把本次的修改写回共享存储。"""
+    def __init__(self, room):
+        self.room = room
+        self.local = threading.RLock()
+        self.depth = 0  # 只有持有 local 的线程会改它
+        self.token = None
+        self.generation = 0
+
+    def __enter__(self):
+        self.local.acquire()
+        self.depth += 1
+        if self.depth == 1 and self.room.shared_version is not None:
+            try:
+                self.token = cluster.acquire_lock(self.room.room_id)
+                cluster.refresh_room(self.room)
+            except Exception:
+                self._release()
+                raise
+            self.generation = self.room._generation
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self.depth == 1 and self.token is not None and self.room._generation != self.generation:
+                # 先把未广播的变化发出去，其他 worker 加载后的 broadcast_status 才和客户端一致
+                broadcast_room(self.room)
+                cluster.save_room(self.room)
+        finally:
+            self._release()
+
+    def _release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.token is not None:
+            cluster.release_lock(self.room.room_id, self.token)
+            self.token = None
+        self.local.release()
+
 class Room:
     def __init__(self, room_id, team1_name="Team1", team2_name="Team2"):
         self.room_id = room_id
         # 使用动态队伍名作为字典键
         self.teams = {team1_name: [], team2_name: []}
         self.members = set()
+        self.member_team = {}  # 成员 -> 所在队伍
         # 分数也使用动态队伍名作为键
         self.scores = {team1_name: 0, team2_name: 0}
         self.problems = set(["P1000"])
@@ -38,147 +445,2535 @@ class Room:
         self.finished = False
         self.winner = None
         self.created_at = time.time()
-        self.proposals = []
-        self.deletion_proposals = []
+        self.finished_at = None
+        # 待处理的申请按 (kind, pid) 索引，kind 是 "add" 或 "delete"；处理完的申请移进定长的历史
+        self.pending = {}
+        self.proposal_history = deque(maxlen=app.config["PROPOSAL_HISTORY"])  # (kind, pid, 发起队伍, 结果, 时间)
+        self.judge_strategy = "problem"  # "problem" 按题目轮询，"user" 按成员轮询
+        # get_status 的缓存：(生成时的代数, 只读快照)，touch() 让代数加一使缓存失效
+        self._generation = 0
+        self._status = None
+        self._status_json = None
+        self.last_activity = time.time()
+        # 房间锁：判题、HTTP 请求和 SocketIO 事件会同时改同一个房间，读写都要持有它
+        self.lock = RoomLock(self)
+        self.shared_version = None  # 登记到共享存储后是本地状态对应的共享版本号
+        # 事件日志：event_seq 是已应用的最后一条事件的序号；内存里留最近两份快照 (序号, to_json 文本)
+        # 和最早那份之后的事件，断线重连的客户端直接从这里补齐
+        self.event_seq = 0
+        self.log_snapshots = deque(maxlen=2)
+        self.log_tail = []
+        # 已广播给客户端的版本号和对应的状态，broadcast_room 据此计算增量
+        self.revision = 0
+        self.broadcast_status = self.get_status()
 
     def add_member(self, team_name, luogu_name):
-        # 检查队伍是否存在
-        if team_name not in self.teams:
-            return False
-        # 检查用户是否已在房间内
-        if luogu_name in self.members:
-            return False
-        # 添加成员
-        self.teams[team_name].append(luogu_name)
-        self.members.add(luogu_name)
-        # 初始化分数（如果队伍分数不存在，通常不会发生）
-        if team_name not in self.scores:
-            self.scores[team_name] = 0
-        return True
+        with self.lock:
+            # 检查队伍是否存在
+            if team_name not in self.teams:
+                return False
+            # 检查用户是否已在房间内
+            if luogu_name in self.members:
+                return False
+            self.record("join", team=team_name, user=luogu_name)
+            return True
 
     def remove_member(self, luogu_name):
-        for team_name, members in self.teams.items():
-            if luogu_name in members:
-                members.remove(luogu_name)
-                self.members.discard(luogu_name)
-                return True
-        return False
+        with self.lock:
+            if luogu_name not in self.member_team:
+                return False
+            self.record("leave", user=luogu_name)
+            return True
+
+    def add_proposal(self, kind, proposer, pid):
+        """登记一个待处理的申请。同一道题已经有待处理的同类申请时返回 None。"""
+        with self.lock:
+            if (kind, pid) in self.pending:
+                return None
+            self.record("propose", kind=kind, pid=pid, proposer=proposer, timestamp=time.strftime("%H:%M:%S"))
+            return self.pending[(kind, pid)]
+
+    def resolve_proposal(self, kind, pid, status):
+        """把待处理的申请标记为 accepted / rejected 并移进历史。"""
+        with self.lock:
+            proposal = self.pending.get((kind, pid))
+            if proposal:
+                self.record("resolve", kind=kind, pid=pid, status=status)
+            return proposal
+
+    def record(self, event_type, **fields):
+        """记一条事件并应用到房间上。房间状态的每一次修改都走这里，所以事件日志可以重放出任意版本。"""
+        with self.lock:
+            if not self.log_snapshots:
+                event_log.snapshot(self)  # 日志从一份快照开始，之前的历史（旧数据）不用重放
+            event = {"seq": self.event_seq + 1, "t": round(time.time(), 3), "type": event_type, **fields}
+            self.apply_event(event)
+            event_log.append(self, event)
+            self.touch()
+            return event
+
+    def apply_event(self, event):
+        """纯状态转移，只让状态缓存失效，不写日志也不 touch()；重放时直接调用。"""
+        kind = event["type"]
+        if kind == "create":
+            self.problems = set(event["problems"])
+        elif kind == "join":
+            team = event["team"]
+            self.teams[team].append(event["user"])
+            self.members.add(event["user"])
+            self.member_team[event["user"]] = team
+            self.scores.setdefault(team, 0)
+        elif kind == "leave":
+            team = self.member_team.pop(event["user"])
+            self.teams[team].remove(event["user"])
+            self.members.discard(event["user"])
+        elif kind == "propose":
+            self.pending[(event["kind"], event["pid"])] = {
+                "proposer": event["proposer"], "pid": event["pid"], "status": "pending", "timestamp": event["timestamp"],
+            }
+        elif kind == "resolve":
+            proposal = self.pending.pop((event["kind"], event["pid"]))
+            self.proposal_history.append((event["kind"], event["pid"], proposal["proposer"], event["status"], proposal["timestamp"]))
+        elif kind == "add_problem":
+            self.problems.add(event["pid"])
+        elif kind == "remove_problem":
+            # 删掉已解决的题目不扣分
+            self.problems.discard(event["pid"])
+            self.solved.discard(event["pid"])
+            self.solved_by.pop(event["pid"], None)
+        elif kind == "solve":
+            self.solved.add(event["pid"])
+            self.solved_by[event["pid"]] = {"user": event["user"], "team": event["team"]}
+            self.scores[event["team"]] += event["points"]
+        elif kind == "finish":
+            self.winner = event["winner"]
+            self.finished = True
+            self.finished_at = event["t"]
+        else:
+            raise ValueError(f"unknown room event {kind!r}")
+        self.event_seq = event["seq"]
+        self._generation += 1
+
+    def pending_proposals(self, kind):
+        return [proposal for (k, _), proposal in self.pending.items() if k == kind]
+
+    def mark_active(self):
+        # 有人解题、加入、申请或聊天时调用，评测调度会更频繁地轮询活跃的房间
+        self.last_activity = time.time()
+
+    def touch(self):
+        # 任何修改房间状态的地方都要调用，下一次 get_status 会重新生成快照，并安排写盘
+        self._generation += 1
+        store.mark_room(self.room_id)
+        lobby.update(self)
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps({
+                "room_id": self.room_id,
+                "teams": self.teams,
+                "scores": self.scores,
+                "problems": sorted(self.problems),
+                "solved": sorted(self.solved),
+                "solved_by": self.solved_by,
+                "finished": self.finished,
+                "winner": self.winner,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "last_activity": self.last_activity,
+                "proposals": self.pending_proposals("add"),
+                "deletion_proposals": self.pending_proposals("delete"),
+                "proposal_history": list(self.proposal_history),
+                "revision": self.revision,
+                "event_seq": self.event_seq,
+            }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        team1_name, team2_name = list(data["teams"])[:2]
+        room = cls(data["room_id"], team1_name, team2_name)
+        room.load_json(data)
+        return room
+
+    def load_json(self, data):
+        """用 to_json() 的内容覆盖当前状态（调用方持有锁，或者房间还没有共享出去）。"""
+        self.teams = data["teams"]
+        self.member_team = {name: team for team, members in self.teams.items() for name in members}
+        self.members = set(self.member_team)
+        self.scores = data["scores"]
+        self.problems = set(data["problems"])
+        self.solved = set(data["solved"])
+        self.solved_by = data["solved_by"]
+        self.finished = data["finished"]
+        self.winner = data["winner"]
+        self.created_at = data["created_at"]
+        self.finished_at = data.get("finished_at")
+        self.last_activity = data.get("last_activity", self.created_at)
+        self.pending = {}
+        self.proposal_history.clear()
+        self.proposal_history.extend(tuple(entry) for entry in data.get("proposal_history", ()))
+        for kind, key in (("add", "proposals"), ("delete", "deletion_proposals")):
+            for proposal in data[key]:
+                if proposal["status"] == "pending":
+                    self.pending[(kind, proposal["pid"])] = proposal
+                else:
+                    # 旧数据里处理过的申请还留在列表里，转进历史
+                    self.proposal_history.append((kind, proposal["pid"], proposal["proposer"], proposal["status"], proposal["timestamp"]))
+        self.revision = data.get("revision", 0)
+        self.event_seq = data.get("event_seq", 0)
+        # 状态被整体替换（比如从共享存储刷新），内存里的日志接不上了，下一条事件时重新拍快照
+        self.log_snapshots.clear()
+        self.log_tail = []
+        self._generation += 1
+        self.broadcast_status = self.get_status()
 
     def get_status(self):
+        """返回只读快照。没有 touch() 过就直接复用缓存，不产生任何新对象。"""
+        cached = self._status
+        if cached is not None and cached[0] == self._generation:
+            return cached[1]
+        with self.lock:
+            snapshot = freeze(self._build_status())
+            self._status = (self._generation, snapshot)
+            return snapshot
+
+    def status_json(self):
+        """预先编码好的 get_status() JSON，快照不变时复用同一个字符串。"""
+        snapshot = self.get_status()
+        cached = self._status_json
+        if cached is None or cached[0] is not snapshot:
+            cached = self._status_json = (snapshot, json.dumps(snapshot, ensure_ascii=False))
+        return cached[1]
+
+    def _build_status(self):
         return {
             "room_id": self.room_id,
-            "problems": list(self.problems),
-            "teams": {k: v[:] for k, v in self.teams.items()},
-            "solved": list(self.solved),
-            "solved_by": self.solved_by.copy(),
-            "scores": self.scores.copy(),
+            "problems": self.problems,
+            "teams": self.teams,
+            "solved": self.solved,
+            "solved_by": self.solved_by,
+            "scores": self.scores,
             "finished": self.finished,
             "winner": self.winner,
-            "proposals": self.proposals[:],
-            "deletion_proposals": self.deletion_proposals[:]
+            "proposals": self.pending_proposals("add"),
+            "deletion_proposals": self.pending_proposals("delete"),
+            "proposal_history": self.proposal_history,
+            "seq": self.event_seq,
         }
 
-def fetch_ac_users_for_room(pid: str, room_members: set):
-    url = f"https://www.luogu.com.cn/record/list?pid={pid}"
-    print(f"[INFO] Fetching AC users for {pid} (room members: {len(room_members)}) ...")
-    try:
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = browser.new_context()
-            context.add_cookies([
-                {"name": "_uid", "value": "661094", "domain": "www.luogu.com.cn", "path": "/"},
-                {"name": "__client_id", "value": "80b4a27bc7d95af2513b252879973a2f26a22f2c", "domain": "www.luogu.com.cn", "path": "/"}
-            ])
-
-            page = context.new_page()
-            page.goto(url, wait_until="domcontentloaded", timeout=30000)
-            page.wait_for_timeout(1000)
-
-            # 修改：返回一个字典，key 是 pid，value 是 AC 的用户集合
-            ac_by_pid = {pid: set()}
-            rows = page.query_selector_all("div.row")
-            for row in rows:
-                status_span = row.query_selector("span.status-name")
-                if not status_span:
+# ----------------------------
+# Persistence (SQLite, write-behind)
+# 内存里的 users / rooms 是热缓存。房间每次 touch() 只记一个脏标记，后台线程每隔
+# STORE_FLUSH_INTERVAL 秒把脏房间批量写进 SQLite（WAL 模式）；归档的房间只留在数据库里。
+# ----------------------------
+class Store:
+    def __init__(self, path, flush_interval):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.dirty_rooms = set()
+        self.pending_events = []     # (room_id, seq, 事件 JSON)
+        self.pending_snapshots = []  # (room_id, seq, 房间 JSON)
+        self.thread = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.events_written = 0
+        self.archived = 0
+        with self.db_lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rooms ("
+                "room_id TEXT PRIMARY KEY, finished INTEGER NOT NULL, archived INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, data TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS problems (pid TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS ac_facts (pid TEXT NOT NULL, user TEXT NOT NULL, PRIMARY KEY (pid, user))"
+            )
+            # 房间事件日志（只追加）和定期快照，归档的房间也保留，供事后查证
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS room_events (room_id TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (room_id, seq)) WITHOUT ROWID"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS room_snapshots (room_id TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (room_id, seq)) WITHOUT ROWID"
+            )
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+    def mark_room(self, room_id):
+        with self.lock:
+            self.dirty_rooms.add(room_id)
+
+    def save_user(self, user_id, user):
+        # 用户只在注册时写一次，直接写穿
+        with self.db_lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)", (user_id, json.dumps(user)))
+
+    def append_event(self, room_id, event):
+        with self.lock:
+            self.pending_events.append((room_id, event["seq"], json.dumps(event, ensure_ascii=False, separators=(",", ":"))))
+
+    def save_snapshot(self, room_id, seq, data):
+        with self.lock:
+            self.pending_snapshots.append((room_id, seq, data))
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty_rooms = self.dirty_rooms, set()
+            events, self.pending_events = self.pending_events, []
+            snapshots, self.pending_snapshots = self.pending_snapshots, []
+        rows = []
+        for room_id in dirty:
+            room = rooms.get(room_id)
+            if room:
+                rows.append((room_id, int(room.finished), room.created_at, room.to_json()))
+        if not rows and not events and not snapshots:
+            return
+        # 房间、事件和快照在同一个事务里落盘，崩溃后三者是一致的
+        with self.db_lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO room_events (room_id, seq, data) VALUES (?, ?, ?)", events)
+            self.conn.executemany("INSERT OR REPLACE INTO room_snapshots (room_id, seq, data) VALUES (?, ?, ?)", snapshots)
+            # 刷盘可能和 archive_room 赛跑：已经归档的行不再覆盖，否则会被改回未归档、数据也可能更旧
+            self.conn.executemany(
+                "INSERT INTO rooms (room_id, finished, archived, created_at, data) VALUES (?, ?, 0, ?, ?) "
+                "ON CONFLICT (room_id) DO UPDATE SET finished = excluded.finished, created_at = excluded.created_at, "
+                "data = excluded.data WHERE rooms.archived = 0",
+                rows,
+            )
+        self.flushes += 1
+        self.rows_written += len(rows)
+        self.events_written += len(events)
+
+    def archive_room(self, room_id):
+        """把房间写盘并标记为归档，然后移出内存。"""
+        room = rooms.get(room_id)
+        if not room:
+            return
+        with self.db_lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rooms (room_id, finished, archived, created_at, data) VALUES (?, ?, 1, ?, ?)",
+                (room_id, int(room.finished), room.created_at, room.to_json()),
+            )
+        rooms.pop(room_id, None)
+        lobby.remove(room_id)
+        self.archived += 1
+        log.debug("Room %s archived", room_id)
+
+    def count_archived(self):
+        with self.db_lock:
+            return self.conn.execute("SELECT COUNT(*) FROM rooms WHERE archived = 1").fetchone()[0]
+
+    def load_users(self):
+        with self.db_lock:
+            return {user_id: json.loads(data) for user_id, data in self.conn.execute("SELECT user_id, data FROM users")}
+
+    def load_live_rooms(self):
+        with self.db_lock:
+            rows = self.conn.execute("SELECT data FROM rooms WHERE archived = 0").fetchall()
+        return {room.room_id: room for room in (Room.from_json(data) for (data,) in rows)}
+
+    def load_room(self, room_id):
+        with self.db_lock:
+            row = self.conn.execute("SELECT data FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+        return Room.from_json(row[0]) if row else None
+
+    def load_snapshot(self, room_id, upto=None):
+        """序号不超过 upto 的最新快照 (序号, 房间 JSON)，没有时返回 None。"""
+        with self.db_lock:
+            return self.conn.execute(
+                "SELECT seq, data FROM room_snapshots WHERE room_id = ? AND seq <= ? ORDER BY seq DESC LIMIT 1",
+                (room_id, upto if upto is not None else 2 ** 62),
+            ).fetchone()
+
+    def load_events(self, room_id, after=0, upto=None, limit=None):
+        with self.db_lock:
+            rows = self.conn.execute(
+                "SELECT data FROM room_events WHERE room_id = ? AND seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                (room_id, after, upto if upto is not None else 2 ** 62, limit if limit is not None else -1),
+            ).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def load_problem(self, pid):
+        """返回 (题目信息, 抓取时间)，没有缓存过时返回 None。"""
+        with self.db_lock:
+            row = self.conn.execute("SELECT data, fetched_at FROM problems WHERE pid = ?", (pid,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def load_ac_facts(self):
+        with self.db_lock:
+            return self.conn.execute("SELECT pid, user FROM ac_facts").fetchall()
+
+    def save_ac_facts(self, facts):
+        with self.db_lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO ac_facts (pid, user) VALUES (?, ?)", facts)
+
+    def save_problem(self, pid, meta, fetched_at):
+        with self.db_lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO problems (pid, data, fetched_at) VALUES (?, ?, ?)",
+                (pid, json.dumps(meta, ensure_ascii=False), fetched_at),
+            )
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                count_error("store", e)
+                log.error("Store flush failed: %s", e)
+
+    def stats(self):
+        with self.lock:
+            dirty = len(self.dirty_rooms)
+        return {
+            "path": self.path,
+            "dirty_rooms": dirty,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "events_written": self.events_written,
+            "archived": self.archived,
+            "live_rooms": len(rooms),
+        }
+
+store = Store(app.config["DATABASE"], app.config["STORE_FLUSH_INTERVAL"])
+
+# ----------------------------
+# Room Event Log
+# 房间的每次修改都是一条只追加的事件（见 Room.record / Room.apply_event），随房间一起批量写进
+# SQLite；每 ROOM_SNAPSHOT_EVERY 条事件拍一次快照，重建任意版本只要一份快照加一小段事件。
+# 事件序号 seq 也在房间状态里，断线重连的客户端报上自己的 seq，服务器用内存里的日志
+# 重建出它手里的状态，只补发差异。
+# ----------------------------
+class EventLogError(Exception):
+    """事件日志里缺了一段，没法重建到要求的版本。"""
+
+class EventLog:
+    def __init__(self, snapshot_every):
+        self.snapshot_every = snapshot_every
+
+    def snapshot(self, room):
+        data = room.to_json()
+        room.log_snapshots.append((room.event_seq, data))
+        oldest = room.log_snapshots[0][0]
+        room.log_tail = [event for event in room.log_tail if event["seq"] > oldest]
+        store.save_snapshot(room.room_id, room.event_seq, data)
+
+    def append(self, room, event):
+        room.log_tail.append(event)
+        store.append_event(room.room_id, event)
+        if event["seq"] - room.log_snapshots[-1][0] >= self.snapshot_every:
+            self.snapshot(room)
+
+    @staticmethod
+    def _replay(data, events, seq):
+        room = Room.from_json(data)
+        for event in events:
+            if seq is not None and event["seq"] > seq:
+                break
+            if event["seq"] != room.event_seq + 1:
+                raise EventLogError(f"room {room.room_id}: expected event {room.event_seq + 1}, got {event['seq']}")
+            room.apply_event(event)
+        return room
+
+    def status_at(self, room, seq):
+        """只用内存里的日志重建房间在 seq 时的状态（调用方持有房间锁）；内存里够不着时返回 None。"""
+        if not isinstance(seq, int) or not room.log_snapshots or seq > room.event_seq:
+            return None
+        base = next(((s, data) for s, data in reversed(room.log_snapshots) if s <= seq), None)
+        if base is None:
+            return None
+        return self._replay(base[1], [e for e in room.log_tail if e["seq"] > base[0]], seq).get_status()
+
+    def rebuild(self, room_id, seq=None):
+        """从磁盘上的快照和事件重建房间（默认是最新版本），返回一个不登记到任何地方的 Room；没有日志时返回 None。"""
+        store.flush()  # 先把还在内存里的事件写下去
+        snapshot = store.load_snapshot(room_id, seq)
+        if snapshot is None:
+            return None
+        room = self._replay(snapshot[1], store.load_events(room_id, after=snapshot[0], upto=seq), seq)
+        if seq is not None and room.event_seq != seq:
+            raise EventLogError(f"room {room_id}: log ends at event {room.event_seq}, before {seq}")
+        return room
+
+event_log = EventLog(app.config["ROOM_SNAPSHOT_EVERY"])
+
+def catch_up_patch(room, rev, seq):
+    """客户端停在广播版本 rev、事件序号 seq 时，返回把它补齐到当前状态的 patch；日志不够时返回 None。"""
+    with room.lock:
+        broadcast_room(room)
+        if not isinstance(rev, int) or rev > room.revision:
+            return None
+        old = event_log.status_at(room, seq)
+        if old is None:
+            return None
+        changed, items = diff_status(old, room.broadcast_status)
+        return {"room_id": room.room_id, "base": rev, "rev": room.revision, "set": changed, "items": items}
+
+def restore_state():
+    """启动时从数据库恢复用户和进行中的房间；评测调度在第一个请求到来时启动。"""
+    users.update(store.load_users())
+    ac_cache.load(store.load_ac_facts())
+    rooms.update(store.load_live_rooms())
+    for room in list(rooms.values()):
+        # 房间行比日志旧的话（比如写房间时出错），把后面的事件补上
+        events = store.load_events(room.room_id, after=room.event_seq)
+        for event in events:
+            room.apply_event(event)
+        if events:
+            store.mark_room(room.room_id)
+        cluster.register_room(room, replace=False)
+        lobby.update(room, notify=False)
+    if rooms:
+        log.info("Restored %d users and %d live rooms from %s", len(users), len(rooms), store.path)
+
+def get_room(room_id):
+    """按 id 取房间。多 worker 部署时本地没有就从共享存储加载，本地落后于共享版本时先同步。"""
+    room = rooms.get(room_id)
+    if room is None:
+        return cluster.load_room(room_id) if room_id else None
+    if cluster.is_stale(room):
+        with room.lock:  # 加锁时会重新加载
+            pass
+    return room
+
+# ----------------------------
+# Cluster (multi-worker deployment)
+# 多个 worker 部署在负载均衡后面时，房间和用户写进共享存储（Redis），每个 worker 的 rooms
+# 只是热缓存；修改房间要先拿到跨 worker 的房间锁（见 RoomLock），SocketIO 广播经
+# SOCKETIO_MESSAGE_QUEUE 扇出；每个房间由租约选出唯一一个 worker 负责判题和归档。
+# 没有配置 SHARED_STATE_URL 时用进程内的 LocalSharedState，所有操作都退化成单机行为。
+# ----------------------------
+class LocalSharedState:
+    """进程内的共享存储替身，实现了 Cluster 用到的那一小部分 Redis 命令。"""
+    def __init__(self):
+        self.data = {}  # key -> (value, 过期时间或 None)
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.time():
+            del self.data[key]
+            return None
+        return item[0]
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        with self.lock:
+            if nx and self._get(key) is not None:
+                return False
+            self.data[key] = (value, time.time() + px / 1000 if px else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            value = int(self._get(key) or 0) + amount
+            self.data[key] = (str(value), None)
+            return value
+
+    def sadd(self, key, member):
+        with self.lock:
+            members = self._get(key) or set()
+            members.add(member)
+            self.data[key] = (members, None)
+
+    def srem(self, key, member):
+        with self.lock:
+            (self._get(key) or set()).discard(member)
+
+    def smembers(self, key):
+        with self.lock:
+            return set(self._get(key) or ())
+
+    def delete_if(self, key, value):
+        with self.lock:
+            if self._get(key) != value:
+                return False
+            del self.data[key]
+            return True
+
+    def expire_if(self, key, value, px):
+        with self.lock:
+            if self._get(key) != value:
+                return False
+            self.data[key] = (value, time.time() + px / 1000)
+            return True
+
+    def rpush_capped(self, key, value, maxlen):
+        """追加到列表末尾，只保留最后 maxlen 个（环形缓冲）。"""
+        with self.lock:
+            items = self._get(key)
+            if items is None:
+                items = deque(maxlen=maxlen)
+                self.data[key] = (items, None)
+            items.append(value)
+
+    def lrange(self, key):
+        with self.lock:
+            return list(self._get(key) or ())
+
+
+class RedisSharedState:
+    """redis-py 实现，只有多 worker 部署时才需要安装 redis。"""
+    DELETE_IF = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+    EXPIRE_IF = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        return bool(self.redis.set(key, value, nx=nx, px=px))
+
+    def delete(self, key):
+        self.redis.delete(key)
+
+    def incr(self, key, amount=1):
+        return self.redis.incrby(key, amount)
+
+    def sadd(self, key, member):
+        self.redis.sadd(key, member)
+
+    def srem(self, key, member):
+        self.redis.srem(key, member)
+
+    def smembers(self, key):
+        return self.redis.smembers(key)
+
+    def delete_if(self, key, value):
+        return bool(self.redis.eval(self.DELETE_IF, 1, key, value))
+
+    def expire_if(self, key, value, px):
+        return bool(self.redis.eval(self.EXPIRE_IF, 1, key, value, px))
+
+    def rpush_capped(self, key, value, maxlen):
+        pipe = self.redis.pipeline()
+        pipe.rpush(key, value)
+        pipe.ltrim(key, -maxlen, -1)
+        pipe.execute()
+
+    def lrange(self, key):
+        return self.redis.lrange(key, 0, -1)
+
+
+class Cluster:
+    def __init__(self, url, worker_id, lock_ttl, judge_lease):
+        self.distributed = bool(url)
+        self.shared = RedisSharedState(url) if url else LocalSharedState()
+        self.worker_id = worker_id
+        self.lock_ttl = lock_ttl
+        self.judge_lease = judge_lease
+        self.lock_waits = 0
+        self.reloads = 0
+
+    # --- rooms ---
+    def register_room(self, room, replace=True):
+        """把新房间写进共享存储，之后对它加锁都会走分布式锁。replace=False 时不覆盖已有的状态。"""
+        if not self.distributed:
+            return
+        if self.shared.set(f"room:{room.room_id}", room.to_json(), nx=not replace):
+            room.shared_version = self.shared.incr(f"room:{room.room_id}:version")
+        else:
+            room.shared_version = 0  # 共享存储里的版本更新，第一次加锁时加载
+        self.shared.sadd("rooms", room.room_id)
+
+    def save_room(self, room):
+        self.shared.set(f"room:{room.room_id}", room.to_json())
+        room.shared_version = self.shared.incr(f"room:{room.room_id}:version")
+
+    def shared_version(self, room_id):
+        return int(self.shared.get(f"room:{room_id}:version") or 0)
+
+    def is_stale(self, room):
+        return room.shared_version is not None and self.shared_version(room.room_id) > room.shared_version
+
+    def refresh_room(self, room):
+        """持有房间锁时调用：共享版本比本地新就重新加载。"""
+        version = self.shared_version(room.room_id)
+        if version <= room.shared_version:
+            return
+        text = self.shared.get(f"room:{room.room_id}")
+        if text:
+            room.load_json(json.loads(text))
+            lobby.update(room, notify=False)
+            self.reloads += 1
+        room.shared_version = version
+
+    def load_room(self, room_id):
+        if not self.distributed:
+            return None
+        text = self.shared.get(f"room:{room_id}")
+        if not text:
+            return None
+        room = Room.from_json(text)
+        room.shared_version = self.shared_version(room_id)
+        room = rooms.setdefault(room_id, room)
+        lobby.update(room, notify=False)
+        return room
+
+    def drop_room(self, room_id):
+        if self.distributed:
+            self.shared.srem("rooms", room_id)
+            self.shared.delete(f"room:{room_id}")
+            self.shared.delete(f"room:{room_id}:version")
+
+    def room_ids(self):
+        return self.shared.smembers("rooms") if self.distributed else list(rooms)
+
+    # --- chat ---
+    def append_chat(self, channel, message, maxlen):
+        """给消息分配频道内递增的 id 并存进共享的环形缓冲，多 worker 时大家看到同一份历史。"""
+        message["id"] = self.shared.incr(f"chat:{channel}:seq")
+        self.shared.rpush_capped(f"chat:{channel}", json.dumps(message, ensure_ascii=False), maxlen)
+        return message
+
+    def chat_history(self, channel):
+        # 不同 worker 分配 id 和写入的先后可能交错，按 id 排一下
+        return sorted((json.loads(item) for item in self.shared.lrange(f"chat:{channel}")), key=lambda m: m["id"])
+
+    def drop_chat(self, channel):
+        self.shared.delete(f"chat:{channel}")
+        self.shared.delete(f"chat:{channel}:seq")
+
+    def acquire_lock(self, room_id):
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.lock_ttl / 1000 * 2
+        while not self.shared.set(f"lock:{room_id}", token, nx=True, px=self.lock_ttl):
+            if time.time() > deadline:
+                raise TimeoutError(f"房间 {room_id} 的锁等待超时")
+            self.lock_waits += 1
+            time.sleep(0.005)
+        return token
+
+    def release_lock(self, room_id, token):
+        self.shared.delete_if(f"lock:{room_id}", token)
+
+    # --- judge election ---
+    def owns_judge(self, room_id):
+        """抢占或续约房间的判题租约；单机时总是 True。"""
+        if not self.distributed:
+            return True
+        key = f"judge:{room_id}"
+        return (self.shared.set(key, self.worker_id, nx=True, px=self.judge_lease)
+                or self.shared.expire_if(key, self.worker_id, self.judge_lease))
+
+    # --- users and connections ---
+    def save_user(self, user_id, user):
+        if self.distributed:
+            self.shared.set(f"user:{user_id}", json.dumps(user))
+
+    def load_user(self, user_id):
+        if not self.distributed:
+            return None
+        text = self.shared.get(f"user:{user_id}")
+        if not text:
+            return None
+        return users.setdefault(user_id, json.loads(text))
+
+    def add_connected(self, room_id, amount):
+        if self.distributed:
+            self.shared.incr(f"connected:{room_id}", amount)
+
+    def connected(self, room_id):
+        return int(self.shared.get(f"connected:{room_id}") or 0)
+
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "distributed": self.distributed,
+            "message_queue": bool(app.config["SOCKETIO_MESSAGE_QUEUE"]),
+            "local_rooms": len(rooms),
+            "shared_rooms": len(self.room_ids()),
+            "judged_rooms": sorted(room_id for room_id in judge_scheduler.room_state),
+            "lock_waits": self.lock_waits,
+            "reloads": self.reloads,
+        }
+
+cluster = Cluster(
+    app.config["SHARED_STATE_URL"],
+    app.config["WORKER_ID"],
+    app.config["CLUSTER_LOCK_TTL"],
+    app.config["CLUSTER_JUDGE_LEASE"],
+)
+
+# ----------------------------
+# Lobby Index
+# 大厅用的房间摘要表，以及 用户 -> 所在房间 的反向索引。房间每次 touch() 时增量更新，
+# /api/lobby 直接从摘要表分页；摘要有变化时推送到 "lobby" 频道，大厅页面不用再整页刷新。
+# ----------------------------
+class Lobby:
+    def __init__(self):
+        self.summaries = {}   # room_id -> 摘要（只整体替换，不原地修改）
+        self.members = {}     # room_id -> 上次索引时的成员集合
+        self.user_rooms = {}  # 洛谷用户名 -> 所在房间 id 集合
+        # 分页用的有序键 (-created_at, room_id)，新房间在前；按状态各维护一份
+        self.order = {"all": [], "active": [], "finished": []}
+        self.version = 0      # 摘要表每变一次加一，/api/lobby 用它做 ETag
+        self.synced_at = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(summary):
+        return (-summary["created_at"], summary["id"])
+
+    @staticmethod
+    def _state(summary):
+        return "finished" if summary["finished"] else "active"
+
+    def _insert(self, name, key):
+        bisect.insort(self.order[name], key)
+
+    def _delete(self, name, key):
+        order = self.order[name]
+        i = bisect.bisect_left(order, key)
+        if i < len(order) and order[i] == key:
+            del order[i]
+
+    def update(self, room, notify=True):
+        """重新生成房间摘要；有变化时通过 "lobby" 频道推送 room_created / room_updated / room_finished。
+
+        notify=False 用于从数据库或共享存储加载房间：修改它的 worker 已经推送过了。
+        """
+        team1_name, team2_name = list(room.teams)[:2]
+        summary = {
+            "id": room.room_id,
+            "teams": {"team1": team1_name, "team2": team2_name},
+            "players": f"{team1_name}: {len(room.teams[team1_name])} | {team2_name}: {len(room.teams[team2_name])}",
+            "status": "进行中" if not room.finished else "已结束",
+            "finished": room.finished,
+            "created_at": room.created_at,
+        }
+        members = set(room.members)
+        with self.lock:
+            old_members = self.members.get(room.room_id, set())
+            if members != old_members:
+                for name in old_members - members:
+                    self._unindex(name, room.room_id)
+                for name in members - old_members:
+                    self.user_rooms.setdefault(name, set()).add(room.room_id)
+                self.members[room.room_id] = members
+            old = self.summaries.get(room.room_id)
+            if old == summary:
+                return
+            self.summaries[room.room_id] = summary
+            key = self._key(summary)
+            if old is None:
+                self._insert("all", key)
+                self._insert(self._state(summary), key)
+            elif self._state(old) != self._state(summary):
+                self._delete(self._state(old), key)
+                self._insert(self._state(summary), key)
+            self.version += 1
+        if notify:
+            if old is None:
+                event = "room_created"
+            elif summary["finished"] and not old["finished"]:
+                event = "room_finished"
+            else:
+                event = "room_updated"
+            socketio.emit(event, summary, room="lobby")
+
+    def remove(self, room_id, notify=True):
+        with self.lock:
+            summary = self.summaries.pop(room_id, None)
+            for name in self.members.pop(room_id, ()):
+                self._unindex(name, room_id)
+            if summary is None:
+                return
+            key = self._key(summary)
+            self._delete("all", key)
+            self._delete(self._state(summary), key)
+            self.version += 1
+        if notify:
+            socketio.emit("room_removed", {"id": room_id}, room="lobby")
+
+    def _unindex(self, name, room_id):
+        joined = self.user_rooms.get(name)
+        if joined:
+            joined.discard(room_id)
+            if not joined:
+                del self.user_rooms[name]
+
+    def rooms_of(self, luogu_name):
+        with self.lock:
+            return set(self.user_rooms.get(luogu_name, ()))
+
+    def sync(self):
+        """多 worker 时把其他 worker 上创建的房间加载进来，最多每秒一次。"""
+        if not cluster.distributed or time.time() - self.synced_at < 1:
+            return
+        self.synced_at = time.time()
+        for room_id in cluster.room_ids():
+            get_room(room_id)
+
+    def page(self, state=None, cursor=None, limit=20, member=None):
+        """按创建时间从新到旧取一页摘要，返回 (摘要列表, 下一页的游标或 None)。
+
+        state 是 None / "active" / "finished"；member 不为空时只看该用户所在的房间。
+        cursor 是上一页返回的游标，格式不对时抛 ValueError。
+        """
+        start = None
+        if cursor:
+            created_at, _, room_id = cursor.partition(":")
+            start = (-float(created_at), room_id)
+        with self.lock:
+            if member is None:
+                order = self.order[state or "all"]
+            else:
+                # 一个人所在的房间不多，现排序就行
+                order = sorted(
+                    self._key(self.summaries[room_id]) for room_id in self.user_rooms.get(member, ())
+                    if state is None or self._state(self.summaries[room_id]) == state
+                )
+            i = bisect.bisect_right(order, start) if start else 0
+            keys = order[i:i + limit]
+            items = [self.summaries[room_id] for _, room_id in keys]
+            more = i + limit < len(order)
+        next_cursor = f"{items[-1]['created_at']!r}:{items[-1]['id']}" if items and more else None
+        return items, next_cursor
+
+lobby = Lobby()
+
+# ----------------------------
+# Team Chat
+# 每个队伍频道 ({room_id}_{team}) 的最近若干条消息存在共享存储的环形缓冲里，加入时推送最新一页，
+# 往上翻时按 id 分页取更早的。短时间内的多条消息攒成一个 messages 事件发出；每个用户按令牌桶限速。
+# ----------------------------
+class ChatService:
+    def __init__(self, history, page_size, window, rate, burst, max_length):
+        self.history_size = history
+        self.page_size = page_size
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.max_length = max_length
+        self.limiters = {}  # 用户 -> RateLimiter
+        self.pending = {}   # (room_id, team) -> 等待下一次发出的消息
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+    def allow(self, user):
+        """user 这次发言是否在限速之内。"""
+        with self.lock:
+            limiter = self.limiters.get(user)
+            if limiter is None:
+                limiter = self.limiters[user] = RateLimiter(self.rate, self.burst)
+        if limiter.try_acquire():
+            return True
+        metrics.inc("chat_rate_limited_total")
+        return False
+
+    def post(self, room_id, team, user, text):
+        message = {"user": user, "text": text[:self.max_length], "time": time.strftime("%H:%M:%S")}
+        cluster.append_chat(f"{room_id}_{team}", message, self.history_size)
+        metrics.inc("chat_messages_total")
+        with self.lock:
+            self.pending.setdefault((room_id, team), []).append(message)
+        self.start()
+        self.wakeup.set()
+        return message
+
+    def system(self, room_id, team, text):
+        return self.post(room_id, team, "系统", text)
+
+    def history(self, room_id, team, before=None, limit=None):
+        """id 小于 before 的最近 limit 条消息（before 为空时是最新的一页），按时间顺序排列。"""
+        limit = min(limit or self.page_size, self.page_size)
+        messages = cluster.chat_history(f"{room_id}_{team}")
+        if before is not None:
+            messages = [m for m in messages if m["id"] < before]
+        page = messages[-limit:]
+        return {"room_id": room_id, "team": team, "before": before, "messages": page, "has_more": len(messages) > len(page)}
+
+    def drop_room(self, room):
+        for team in room.teams:
+            cluster.drop_chat(f"{room.room_id}_{team}")
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for (room_id, team), messages in pending.items():
+            socketio.emit("messages", {"room_id": room_id, "team": team, "messages": messages}, room=f"{room_id}_{team}")
+
+    def _loop(self):
+        while True:
+            self.wakeup.wait()
+            # 等一个窗口，把这段时间里的消息攒到一起
+            time.sleep(self.window)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                self.prune()
+            except Exception as e:
+                count_error("chat", e)
+                log.error("Chat flush failed: %s", e)
+
+    def prune(self):
+        # 令牌早已回满的限速器和新建的没有区别，丢掉免得一直涨
+        now = time.time()
+        with self.lock:
+            for user in [user for user, limiter in self.limiters.items() if now - limiter.updated > self.burst / self.rate + 60]:
+                del self.limiters[user]
+
+chat_service = ChatService(
+    app.config["CHAT_HISTORY"],
+    app.config["CHAT_PAGE_SIZE"],
+    app.config["CHAT_BATCH_WINDOW"],
+    app.config["CHAT_RATE"],
+    app.config["CHAT_BURST"],
+    app.config["CHAT_MAX_LENGTH"],
+)
+
+# ----------------------------
+# Room Lifecycle
+# 记录每个房间连着多少个 socket。没有人连着的房间暂停判题；结束或闲置超过 TTL 的房间
+# 归档进数据库并移出内存。
+# ----------------------------
+class LifecycleManager:
+    def __init__(self, idle_ttl, finished_ttl, sweep_interval):
+        self.idle_ttl = idle_ttl
+        self.finished_ttl = finished_ttl
+        self.sweep_interval = sweep_interval
+        self.sockets = {}    # sid -> 该 socket 加入的房间 id 集合
+        self.connected = {}  # room_id -> 连接数
+        self.lock = threading.Lock()
+        self.thread = None
+        self.expired = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+    def attach(self, sid, room_id):
+        with self.lock:
+            joined = self.sockets.setdefault(sid, set())
+            if room_id in joined:
+                return
+            joined.add(room_id)
+            self.connected[room_id] = self.connected.get(room_id, 0) + 1
+        cluster.add_connected(room_id, 1)
+
+    def detach(self, sid):
+        with self.lock:
+            left = self.sockets.pop(sid, ())
+            for room_id in left:
+                self.connected[room_id] -= 1
+                if not self.connected[room_id]:
+                    del self.connected[room_id]
+        for room_id in left:
+            cluster.add_connected(room_id, -1)
+
+    def is_suspended(self, room):
+        if room.finished:
+            return False
+        # 多 worker 时连接可能落在别的 worker 上，看共享计数
+        return not (cluster.connected(room.room_id) if cluster.distributed else self.connected.get(room.room_id))
+
+    def sweep(self):
+        now = time.time()
+        live_ids = set(cluster.room_ids())
+        for room_id, room in list(rooms.items()):
+            if room_id not in live_ids:
+                rooms.pop(room_id, None)  # 已经被别的 worker 归档
+                lobby.remove(room_id, notify=False)
+                continue
+            if not cluster.owns_judge(room_id):
+                continue  # 归档由负责判题的 worker 做
+            if room.finished:
+                expired = room.finished_at is not None and now - room.finished_at > self.finished_ttl
+            else:
+                expired = self.is_suspended(room) and now - room.last_activity > self.idle_ttl
+            if expired:
+                store.archive_room(room_id)
+                cluster.drop_room(room_id)
+                chat_service.drop_room(room)
+                self.expired += 1
+
+    def _loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                count_error("lifecycle", e)
+                log.error("Lifecycle sweep failed: %s", e)
+
+    def stats(self):
+        live = suspended = finished = 0
+        for room in list(rooms.values()):
+            if room.finished:
+                finished += 1
+            elif self.is_suspended(room):
+                suspended += 1
+            else:
+                live += 1
+        with self.lock:
+            sockets = len(self.sockets)
+        return {
+            "live": live,
+            "suspended": suspended,
+            "finished": finished,
+            "archived": store.count_archived(),
+            "expired": self.expired,
+            "sockets": sockets,
+        }
+
+lifecycle = LifecycleManager(app.config["ROOM_IDLE_TTL"], app.config["ROOM_FINISHED_TTL"], app.config["LIFECYCLE_SWEEP_INTERVAL"])
+
+# ----------------------------
+# Room Broadcasts (versioned patches)
+# 每次变化只推送 patch：{"base": 旧版本, "rev": 新版本, "set": {整体替换的键}, "items": {列表键: {下标: 新条目}}}
+# 客户端发现 base 和自己的版本对不上时发 sync，服务器回一份完整的 snapshot。
+# ----------------------------
+APPEND_ONLY_KEYS = ("proposals", "deletion_proposals", "proposal_history")
+
+def diff_status(old, new):
+    changed, items = {}, {}
+    for key, value in new.items():
+        old_value = old.get(key)
+        if old_value == value:
+            continue
+        if key in APPEND_ONLY_KEYS and isinstance(old_value, tuple) and len(value) >= len(old_value):
+            # 申请列表和历史通常只在末尾追加，只发变化的条目（变短时整体替换）
+            items[key] = {
+                str(i): entry for i, entry in enumerate(value)
+                if i >= len(old_value) or old_value[i] != entry
+            }
+        else:
+            changed[key] = value
+    return changed, items
+
+def broadcast_room(room):
+    """把房间自上次广播以来的变化作为 patch 推送给房间内所有客户端。"""
+    with room.lock:
+        status = room.get_status()
+        changed, items = diff_status(room.broadcast_status, status)
+        if not changed and not items:
+            return
+        room.revision += 1
+        room.broadcast_status = status
+        patch = {"room_id": room.room_id, "base": room.revision - 1, "rev": room.revision, "set": changed, "items": items}
+        # 在锁内发送，保证客户端按版本顺序收到 patch
+        emit_room("patch", patch, room.room_id)
+
+def room_snapshot(room):
+    """先把未广播的变化发出去，再返回 (版本号, 完整状态)。"""
+    with room.lock:
+        broadcast_room(room)
+        return room.revision, room.broadcast_status
+
+# ----------------------------
+# Spectators
+# 观众只读，一个房间可以有成千上万个。观众不加入房间频道和队伍频道，收不到 patch 和队内聊天，
+# 而是加入 spectator_room(room_id)。后台线程每 SPECTATOR_INTERVAL 秒看一遍有观众的房间，版本变了
+# 才推一次完整的观战状态，期间的多次变化合并成一次。同一版本的状态只构造、编码一次，python-socketio
+# 再把同一个包发给频道里的每个人；这些发送都在观战线程里，不占用给选手广播的线程。
+# 多 worker 时每个 worker 只给连在自己上面的观众推送（ignore_queue），不经过消息队列。
+# ----------------------------
+SPECTATOR_KEYS = ("room_id", "problems", "teams", "solved", "solved_by", "scores", "finished", "winner", "seq")
+
+def spectator_room(room_id, binary=False):
+    return f"{room_id}#spectators#{WIRE_FORMAT}" if binary else f"{room_id}#spectators"
+
+class SpectatorHub:
+    def __init__(self, interval):
+        self.interval = interval
+        self.viewers = {}  # sid -> (room_id, 是否二进制)
+        self.counts = {}   # room_id -> [JSON 观众数, 二进制观众数]
+        self.frames = {}   # room_id -> (版本号, payload, 二进制帧)，同一版本共用
+        self.pushed = {}   # room_id -> 最后一次推给所有观众的版本号
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pushes = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+    def join(self, sid, room_id, binary):
+        """把当前连接登记为 room_id 的观众（在 socket 事件里调用）；一个连接同时只看一个房间。"""
+        with self.lock:
+            previous = self.viewers.get(sid)
+        # 先切换频道再改计数：切换出错时计数和订阅仍然对得上
+        if previous is not None:
+            leave_socket_room(spectator_room(*previous))
+        try:
+            join_room(spectator_room(room_id, binary))
+        finally:
+            self.leave(sid)
+        with self.lock:
+            self.viewers[sid] = (room_id, binary)
+            self.counts.setdefault(room_id, [0, 0])[binary] += 1
+        self.start()
+
+    def leave(self, sid):
+        with self.lock:
+            entry = self.viewers.pop(sid, None)
+            if entry is None:
+                return None
+            room_id, binary = entry
+            counts = self.counts[room_id]
+            counts[binary] -= 1
+            if not any(counts):
+                del self.counts[room_id]
+                self.frames.pop(room_id, None)
+                self.pushed.pop(room_id, None)
+            return entry
+
+    def frame(self, room):
+        """room 当前版本的 (版本号, 观战 payload, 二进制帧)，同一版本只构造一次。"""
+        revision, status = room_snapshot(room)
+        with self.lock:
+            cached = self.frames.get(room.room_id)
+        if cached is not None and cached[0] == revision:
+            return cached
+        payload = {"room_id": room.room_id, "rev": revision, "state": {key: status[key] for key in SPECTATOR_KEYS}}
+        entry = (revision, payload, wire.encode(payload) if wire.available else None)
+        with self.lock:
+            if room.room_id in self.counts:
+                self.frames[room.room_id] = entry
+        return entry
+
+    def push(self):
+        """给每个有观众并且版本变了的房间推一次状态。"""
+        with self.lock:
+            watched = {room_id: tuple(counts) for room_id, counts in self.counts.items()}
+        for room_id, (json_viewers, binary_viewers) in watched.items():
+            room = get_room(room_id)
+            if room is None:
+                continue
+            revision, payload, frame = self.frame(room)
+            with self.lock:
+                if self.pushed.get(room_id) == revision or room_id not in self.counts:
                     continue
-                status_text = status_span.inner_text().strip()
-                if status_text != "Accepted":
+                self.pushed[room_id] = revision
+            if json_viewers:
+                socketio.emit("spectate", payload, room=spectator_room(room_id), ignore_queue=True)
+            if binary_viewers:
+                socketio.emit("spectate", frame, room=spectator_room(room_id, True), ignore_queue=True)
+            self.pushes += 1
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.push()
+            except Exception as e:
+                count_error("spectators", e)
+                log.error("Spectator push failed: %s", e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "viewers": len(self.viewers),
+                "rooms": {room_id: sum(counts) for room_id, counts in self.counts.items()},
+                "pushes": self.pushes,
+            }
+
+spectator_hub = SpectatorHub(app.config["SPECTATOR_INTERVAL"])
+
+LUOGU_COOKIES = [
+    {"name": "_uid", "value": "661094", "domain": "www.luogu.com.cn", "path": "/"},
+    {"name": "__client_id", "value": "80b4a27bc7d95af2513b252879973a2f26a22f2c", "domain": "www.luogu.com.cn", "path": "/"}
+]
+
+# ----------------------------
+# Browser Pool (shared Playwright browsers)
+# Playwright 的同步 API 只能在创建它的线程里使用，所以每个 worker 线程独占
+# 一个 browser + context + 温热的 page，调用方把任务放进队列排队等待结果。
+# ----------------------------
+class BrowserPool:
+    def __init__(self, size, max_uses):
+        self.size = size
+        self.max_uses = max_uses
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.browsers = 0   # 当前存活的 Chromium 进程数
+        self.busy = 0
+        self.fetches = 0
+        self.failures = 0
+        self.recycles = 0
+        self.latencies = deque(maxlen=200)  # 最近的抓取耗时（秒）
+        self.waits = deque(maxlen=200)      # 最近的排队耗时（秒）
+
+    def start(self):
+        with self.lock:
+            while len(self.workers) < self.size:
+                worker = threading.Thread(target=self._worker, daemon=True)
+                self.workers.append(worker)
+                worker.start()
+
+    def run(self, fn, timeout=None):
+        """在池中某个温热的 page 上执行 fn(page)；池满时排队等待。"""
+        self.start()
+        future = Future()
+        self.jobs.put((fn, future, time.time()))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()  # 还没轮到的任务直接丢弃
+            raise
+
+    def _new_context(self, browser):
+        context = browser.new_context()
+        context.add_cookies(LUOGU_COOKIES)
+        return context, context.new_page()
+
+    def _close(self, obj):
+        if obj is None:
+            return
+        try:
+            obj.close()
+        except Exception:
+            pass
+
+    def _worker(self):
+        try:
+            self._serve()
+        except Exception as e:
+            # Playwright 本身起不来时让出名额，下次 run() 会重新拉起 worker
+            count_error("browser_pool", e)
+            log.error("Browser pool worker crashed: %s", e)
+            with self.lock:
+                self.workers.remove(threading.current_thread())
+
+    def _serve(self):
+        with sync_playwright() as p:
+            browser = context = page = None
+            uses = 0
+            while True:
+                fn, future, queued_at = self.jobs.get()
+                if not future.set_running_or_notify_cancel():
                     continue
+                started = time.time()
+                with self.lock:
+                    self.busy += 1
+                    self.waits.append(started - queued_at)
+                metrics.observe("browser_pool_wait_seconds", started - queued_at)
+                try:
+                    if browser is None or not browser.is_connected():
+                        if browser is not None:
+                            with self.lock:
+                                self.browsers -= 1
+                        browser = p.chromium.launch(headless=True)
+                        context = page = None
+                        with self.lock:
+                            self.browsers += 1
+                    if page is None:
+                        context, page = self._new_context(browser)
+                        uses = 0
+                    result = fn(page)
+                except Exception as e:
+                    # 出错（包括页面或浏览器崩溃）后丢弃当前 context，下次重建
+                    self._close(context)
+                    context = page = None
+                    with self.lock:
+                        self.failures += 1
+                        self.recycles += 1
+                    future.set_exception(e)
+                else:
+                    uses += 1
+                    if uses >= self.max_uses:
+                        self._close(context)
+                        context = page = None
+                        with self.lock:
+                            self.recycles += 1
+                    future.set_result(result)
+                finally:
+                    with self.lock:
+                        self.busy -= 1
+                        self.fetches += 1
+                        self.latencies.append(time.time() - started)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            waits = list(self.waits)
+            return {
+                "size": self.size,
+                "browsers": self.browsers,
+                "busy": self.busy,
+                "queued": self.jobs.qsize(),
+                "fetches": self.fetches,
+                "failures": self.failures,
+                "recycles": self.recycles,
+                "latency_avg": sum(latencies) / len(latencies) if latencies else 0,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0,
+                "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0,
+                "wait_avg": sum(waits) / len(waits) if waits else 0,
+            }
+
+browser_pool = BrowserPool(app.config["BROWSER_POOL_SIZE"], app.config["BROWSER_CONTEXT_MAX_USES"])
+
+# ----------------------------
+# Record Fetchers
+# 所有后端都实现 fetch_records(pid, page)，返回该题第 page 页的提交记录：
+# [{"id": 记录编号, "pid": 题号, "user": 用户名, "accepted": 是否 AC, "pending": 是否还在评测}, ...]
+# ----------------------------
+LUOGU_STATUS_ACCEPTED = 12
+LUOGU_STATUS_PENDING = {0, 1}  # 等待评测、评测中
+LUOGU_STATUS_PENDING_NAMES = {"Waiting", "Judging"}  # 页面上显示的状态名
+
+class RateLimitedError(Exception):
+    """洛谷返回了限流响应（HTTP 429/503）。"""
+
+class RecordFetcher:
+    name = None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def record_list_url(self, page=1, **params):
+        params["page"] = page
+        return f"{self.base_url}/record/list?{urllib.parse.urlencode(params)}"
+
+    def fetch_records(self, pid, page=1):
+        return self.fetch_record_list(self.record_list_url(page, pid=pid), pid)
+
+    def fetch_user_records(self, user, page=1):
+        """某个用户自己的提交记录。不按状态过滤：只看 Accepted 的话，还在评测中的提交会被
+        之后更早评测完的 AC 挡在高水位后面。"""
+        return self.fetch_record_list(self.record_list_url(page, user=user))
+
+    def fetch_record_list(self, url, pid=None):
+        raise NotImplementedError
+
+    def fetch_record(self, record_id):
+        """单条评测记录 {"id", "pid", "user", "status", "accepted"}；记录不存在时返回 None。"""
+        raise NotImplementedError
+
+    @staticmethod
+    def parse_record(payload):
+        record = (payload.get("currentData") or {}).get("record")
+        if payload.get("code", 200) == 404 or not record:
+            return None
+        return {
+            "id": record.get("id"),
+            "pid": (record.get("problem") or {}).get("pid"),
+            "user": (record.get("user") or {}).get("name", ""),
+            "status": record.get("status"),
+            "accepted": record.get("status") == LUOGU_STATUS_ACCEPTED,
+        }
+
 
+class PlaywrightRecordFetcher(RecordFetcher):
+    """在浏览器池里渲染 record/list 页面，再从 DOM 里读出记录。"""
+    name = "playwright"
+
+    @staticmethod
+    def _link_tail(row, selector):
+        link = row.query_selector(selector)
+        if not link:
+            return None
+        return (link.get_attribute("href") or "").rstrip("/").rsplit("/", 1)[-1] or None
+
+    def fetch_record_list(self, url, pid=None):
+        def scrape(browser_page):
+            browser_page.goto(url, wait_until="domcontentloaded", timeout=30000)
+            browser_page.wait_for_timeout(1000)
+
+            records = []
+            for row in browser_page.query_selector_all("div.row"):
+                status_span = row.query_selector("span.status-name")
                 user_span = row.query_selector(".user div > span > span > span > a > span")
-                if user_span:
-                    username = user_span.inner_text().strip()
-                    if username in room_members:
-                        ac_by_pid[pid].add(username)
+                if not status_span or not user_span:
+                    continue
+                record_id = self._link_tail(row, "a[href*='/record/']")
+                status = status_span.inner_text().strip()
+                records.append({
+                    "id": int(record_id) if record_id and record_id.isdigit() else None,
+                    "pid": pid or self._link_tail(row, "a[href*='/problem/']"),
+                    "user": user_span.inner_text().strip(),
+                    "accepted": status == "Accepted",
+                    "pending": status in LUOGU_STATUS_PENDING_NAMES,
+                })
+            return records
+
+        return browser_pool.run(scrape, timeout=app.config["BROWSER_FETCH_TIMEOUT"])
+
+    def fetch_record(self, record_id):
+        url = f"{self.base_url}/record/{record_id}"
+
+        def scrape(browser_page):
+            browser_page.goto(url, wait_until="domcontentloaded", timeout=30000)
+            return browser_page.content()
+
+        # 记录页的数据也在 _feInjection 里，不用解析 DOM
+        return self.parse_record(parse_luogu_payload(browser_pool.run(scrape, timeout=app.config["BROWSER_FETCH_TIMEOUT"])))
+
+
+class HttpRecordFetcher(RecordFetcher):
+    """用带 keep-alive 连接池的 requests.Session 直接取页面内嵌的 JSON 数据，不启动浏览器。"""
+    name = "http"
+
+    def __init__(self, base_url, pool_size=16):
+        super().__init__(base_url)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = "Mozilla/5.0 (luogu-duels)"
+        for cookie in LUOGU_COOKIES:
+            self.session.cookies.set(cookie["name"], cookie["value"])
+
+    def fetch_record_list(self, url, pid=None):
+        # _contentOnly=1 时洛谷直接返回 JSON；否则从 HTML 里的 _feInjection 取出同样的数据
+        resp = self.session.get(url + "&_contentOnly=1", timeout=15)
+        if resp.status_code in (429, 503):
+            raise RateLimitedError(f"HTTP {resp.status_code} from {url}")
+        resp.raise_for_status()
+        payload = parse_luogu_payload(resp.text)
+        result = payload["currentData"]["records"]["result"]
+        return [
+            {
+                "id": item.get("id"),
+                "pid": (item.get("problem") or {}).get("pid", pid),
+                "user": (item.get("user") or {}).get("name", ""),
+                "accepted": item.get("status") == LUOGU_STATUS_ACCEPTED,
+                "pending": item.get("status") in LUOGU_STATUS_PENDING,
+            }
+            for item in result
+        ]
+
+    def fetch_record(self, record_id):
+        resp = self.session.get(f"{self.base_url}/record/{record_id}?_contentOnly=1", timeout=15)
+        if resp.status_code in (429, 503):
+            raise RateLimitedError(f"HTTP {resp.status_code} for record {record_id}")
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return self.parse_record(parse_luogu_payload(resp.text))
+
+
+FE_INJECTION_RE = re.compile(r'decodeURIComponent\("([^"]*)"\)')
+
+def parse_luogu_payload(text):
+    """解析洛谷页面数据：纯 JSON，或者 HTML 中 window._feInjection 里 URL 编码的 JSON。"""
+    text = text.strip()
+    if text.startswith("{"):
+        return json.loads(text)
+    match = FE_INJECTION_RE.search(text)
+    if not match:
+        raise ValueError("页面中没有找到记录数据")
+    return json.loads(urllib.parse.unquote(match.group(1)))
+
+
+record_fetchers = {
+    fetcher.name: fetcher
+    for fetcher in (
+        HttpRecordFetcher(app.config["LUOGU_BASE_URL"]),
+        PlaywrightRecordFetcher(app.config["LUOGU_BASE_URL"]),
+    )
+}
+
+FETCH_TARGETS = {"fetch_records": "pid", "fetch_user_records": "user", "fetch_record": "record"}
+
+def timed_fetch(backend, method, *args):
+    """每次请求洛谷前都从判题调度器的限速器拿一个令牌，翻页和回退也不例外。"""
+    judge_scheduler.limiter.acquire()
+    started = time.perf_counter()
+    try:
+        return getattr(record_fetchers[backend], method)(*args)
+    except Exception as e:
+        count_error(backend, e)
+        raise
+    finally:
+        metrics.observe("fetch_seconds", time.perf_counter() - started, backend=backend, target=FETCH_TARGETS[method])
+
+def fetch_with_fallback(method, *args):
+    """用配置的后端抓取记录；其他后端出错时回退到 Playwright。"""
+    backend = app.config["RECORD_FETCHER"]
+    try:
+        return timed_fetch(backend, method, *args)
+    except Exception as e:
+        # 被限流时换个后端也没用，交给调度器退避
+        if backend == PlaywrightRecordFetcher.name or isinstance(e, RateLimitedError):
+            raise
+        log.warning("%s fetcher failed for %s, falling back to playwright: %s", backend, args[0], e)
+        return timed_fetch(PlaywrightRecordFetcher.name, method, *args)
+
+def fetch_records(pid, page=1):
+    return fetch_with_fallback("fetch_records", pid, page)
+
+def fetch_user_records(user, page=1):
+    return fetch_with_fallback("fetch_user_records", user, page)
+
+class RecordScanner:
+    """增量扫描 record/list：记住每个扫描键看过的最新记录编号（高水位），
+    下次只读比它新的记录，必要时往后翻页直到碰到高水位，热门题也不会漏掉 AC。
+
+    扫描键是 ("pid", 题号) 或 ("user", 用户名)。AC 只会从无到有，所以扫到的 AC
+    都记下来（按题目扫时不只是当前房间成员），之后加入房间的人也能直接命中。
+    还在等待评测/评测中的记录之后可能变成 AC，高水位停在其中最早的一条之前，下次从那里重读。
+    """
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self.high_water = {}  # 扫描键 -> 已看过的最大记录编号
+        self.ac_users = {}    # pid -> 扫到过的 AC 用户
+        self.ac_pids = {}     # 用户名 -> 扫到过的 AC 题目
+        self.lock = threading.Lock()
+        self.pages_read = 0
+        self.records_read = 0
+
+    def _scan(self, key, fetch_page):
+        """读取新记录并登记其中的 AC。抓取失败时抛出异常，高水位不变。"""
+        mark = self.high_water.get(key)
+        newest = mark
+        oldest_pending = None
+        new_ac = set()  # (pid, user)
+        # 第一次只读第一页；之后一直翻到高水位为止（最多 max_pages 页）
+        for page in range(1, (1 if mark is None else self.max_pages) + 1):
+            records = fetch_page(page)
+            with self.lock:
+                self.pages_read += 1
+            reached_mark = False
+            for record in records:
+                record_id = record["id"]
+                if record_id is not None:
+                    if mark is not None and record_id <= mark:
+                        reached_mark = True
+                        break
+                    newest = record_id if newest is None else max(newest, record_id)
+                    if record.get("pending"):
+                        oldest_pending = record_id if oldest_pending is None else min(oldest_pending, record_id)
+                with self.lock:
+                    self.records_read += 1
+                if record["accepted"] and record["pid"]:
+                    new_ac.add((record["pid"], record["user"]))
+            if reached_mark or not records:
+                break
+
+        if oldest_pending is not None:
+            # 读到的待评测记录都比旧的高水位新，所以这里不会让高水位倒退
+            newest = oldest_pending - 1
+        kind, name = key
+        with self.lock:
+            if newest is not None:
+                self.high_water[key] = newest
+            self.ac_users.setdefault(name, set()) if kind == "pid" else self.ac_pids.setdefault(name, set())
+            # 另一种索引只补充已经在跟踪的键，避免把全站用户都记进内存
+            for pid, user in new_ac:
+                if pid in self.ac_users:
+                    self.ac_users[pid].add(user)
+                if user in self.ac_pids:
+                    self.ac_pids[user].add(pid)
+
+    def scan_pid(self, pid):
+        """返回该题目前已知的全部 AC 用户。"""
+        self._scan(("pid", pid), lambda page: fetch_records(pid, page))
+        with self.lock:
+            return set(self.ac_users[pid])
+
+    def scan_user(self, user):
+        """返回该用户目前已知 AC 的全部题目。"""
+        self._scan(("user", user), lambda page: fetch_user_records(user, page))
+        with self.lock:
+            return set(self.ac_pids[user])
+
+    def forget(self, key):
+        kind, name = key
+        with self.lock:
+            self.high_water.pop(key, None)
+            (self.ac_users if kind == "pid" else self.ac_pids).pop(name, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "tracked_pids": len(self.ac_users),
+                "tracked_users": len(self.ac_pids),
+                "pages_read": self.pages_read,
+                "records_read": self.records_read,
+            }
+
+record_scanner = RecordScanner(app.config["RECORD_MAX_PAGES"])
+
+class AcCache:
+    """所有房间共享的 (题目, 用户) AC 结果缓存，挡在抓取前面。
+
+    AC 只会从无到有：确认 AC 的结论永久保存（写进数据库，重启后还在）；确认“还没 AC”的结论
+    只在 negative_ttl 秒内有效，过期后需要重新抓取。
+    """
+    def __init__(self, negative_ttl):
+        self.negative_ttl = negative_ttl
+        self.solved = {}   # pid -> 已知 AC 的用户集合
+        self.checked = {}  # (pid, user) -> 上次确认还没 AC 的时间
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, facts):
+        with self.lock:
+            for pid, user in facts:
+                self.solved.setdefault(pid, set()).add(user)
+
+    def record(self, ac_results, checked):
+        """登记一次抓取的结果：ac_results 是 {pid: AC 用户}，checked 是这次确认过的 (pid, user)。"""
+        now = time.time()
+        new_facts = []
+        with self.lock:
+            for pid, user in checked:
+                if user in ac_results.get(pid, ()):
+                    self.checked.pop((pid, user), None)
+                    known = self.solved.setdefault(pid, set())
+                    if user not in known:
+                        known.add(user)
+                        new_facts.append((pid, user))
+                else:
+                    self.checked[(pid, user)] = now
+        if new_facts:
+            store.save_ac_facts(new_facts)
+
+    def known_ac(self, pids, users):
+        """返回缓存里已知的 {pid: AC 用户}，只包含有人 AC 的题目。"""
+        users = set(users)
+        with self.lock:
+            result = {pid: self.solved[pid] & users for pid in pids if pid in self.solved}
+        return {pid: ac_users for pid, ac_users in result.items() if ac_users}
+
+    def covers(self, pairs):
+        """这些 (pid, user) 是否都能由缓存回答（已知 AC，或者还没 AC 的结论未过期）。"""
+        now = time.time()
+        with self.lock:
+            known = sum(
+                1 for pid, user in pairs
+                if user in self.solved.get(pid, ()) or now - self.checked.get((pid, user), 0) < self.negative_ttl
+            )
+        self.hits += known
+        self.misses += len(pairs) - known
+        return known == len(pairs)
+
+    def prune(self):
+        now = time.time()
+        with self.lock:
+            for pair in [pair for pair, t in self.checked.items() if now - t >= self.negative_ttl]:
+                del self.checked[pair]
+
+    def stats(self):
+        with self.lock:
+            facts = sum(len(ac_users) for ac_users in self.solved.values())
+            negatives = len(self.checked)
+        total = self.hits + self.misses
+        return {
+            "facts": facts,
+            "negatives": negatives,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+ac_cache = AcCache(app.config["AC_NEGATIVE_TTL"])
 
-            browser.close()
-            print(f"[DEBUG] AC users for {pid} in room: {ac_by_pid[pid]}")
-            return ac_by_pid
+def fetch_ac_users_for_room(pid: str, room_members: set):
+    log.info("Fetching AC users for %s (room members: %d) ...", pid, len(room_members))
+    try:
+        # 修改：返回一个字典，key 是 pid，value 是 AC 的用户集合
+        ac_by_pid = {pid: record_scanner.scan_pid(pid) & set(room_members)}
+        log.debug("AC users for %s in room: %s", pid, ac_by_pid[pid])
+        ac_cache.record(ac_by_pid, [(pid, user) for user in room_members])
+        return ac_by_pid
 
     except Exception as e:
-        print(f"[ERROR] Failed to fetch AC users for {pid}: {e}")
-        return {pid: set()}
+        # 让调度器知道抓取失败，按退避策略重试
+        log.error("Failed to fetch AC users for %s: %s", pid, e)
+        raise
+
+def fetch_ac_problems_for_user(username: str, problems: set):
+    """按用户轮询：返回和 fetch_ac_users_for_room 同样形状的 {pid: {username}}。"""
+    log.info("Fetching AC problems for %s (problems: %d) ...", username, len(problems))
+    try:
+        ac_pids = record_scanner.scan_user(username) & set(problems)
+        log.debug("AC problems for %s in room: %s", username, ac_pids)
+        ac_results = {pid: {username} for pid in ac_pids}
+        ac_cache.record(ac_results, [(pid, username) for pid in problems])
+        return ac_results
+
+    except Exception as e:
+        log.error("Failed to fetch AC problems for %s: %s", username, e)
+        raise
 
 # ----------------------------
-# Judge Loop (Updated win condition)
+# Problem Metadata
+# 题目信息（是否存在、标题、难度）的 LRU + TTL 缓存，下面还有一层 SQLite。创建房间时批量校验题号，
+# 提出申请时在后台预取，不存在的题目在进房间之前就被拦下，不会让判题一直去抓一道不存在的题。
+# ----------------------------
+PID_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_]{1,31}$")
+
+class ProblemService:
+    """题目信息查询。结果是 {"pid", "valid", "title", "difficulty"}；洛谷暂时访问不了时是 None，
+    调用方按“未知”处理，不因此拒绝用户的操作。"""
+    def __init__(self, base_url, size, ttl, missing_ttl, workers=4):
+        self.base_url = base_url.rstrip("/")
+        self.size = size
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.cache = OrderedDict()  # pid -> (题目信息, 抓取时间)，按最近使用排序
+        self.in_flight = {}         # pid -> 正在查询的 Future
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="problem-fetch")
+        self.hits = 0
+        self.disk_hits = 0
+        self.fetches = 0
+        self.errors = 0
+
+    def _fresh(self, meta, fetched_at):
+        return time.time() - fetched_at < (self.ttl if meta["valid"] else self.missing_ttl)
+
+    def _remember(self, pid, meta, fetched_at):
+        with self.lock:
+            self.cache[pid] = (meta, fetched_at)
+            self.cache.move_to_end(pid)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def peek(self, pid):
+        """只查内存缓存，不发请求。"""
+        with self.lock:
+            entry = self.cache.get(pid)
+            if entry is None or not self._fresh(*entry):
+                return None
+            self.cache.move_to_end(pid)
+            return entry[0]
+
+    def known_invalid(self, pid):
+        meta = self.peek(pid)
+        return meta is not None and not meta["valid"]
+
+    def fetch(self, pid):
+        session = record_fetchers[HttpRecordFetcher.name].session
+        started = time.perf_counter()
+        try:
+            resp = session.get(f"{self.base_url}/problem/{urllib.parse.quote(pid)}?_contentOnly=1", timeout=15)
+        finally:
+            metrics.observe("fetch_seconds", time.perf_counter() - started, backend=HttpRecordFetcher.name, target="problem")
+        if resp.status_code in (429, 503):
+            raise RateLimitedError(f"HTTP {resp.status_code} for problem {pid}")
+        missing = {"pid": pid, "valid": False, "title": None, "difficulty": None}
+        if resp.status_code == 404:
+            return missing
+        resp.raise_for_status()
+        payload = parse_luogu_payload(resp.text)
+        problem = (payload.get("currentData") or {}).get("problem")
+        if payload.get("code", 200) == 404 or not problem:
+            return missing
+        return {"pid": pid, "valid": True, "title": problem.get("title"), "difficulty": problem.get("difficulty")}
+
+    def _load(self, pid):
+        """内存缓存没有时先查数据库，再请求洛谷；出错返回 None。"""
+        try:
+            row = store.load_problem(pid)
+            if row and self._fresh(*row):
+                self.disk_hits += 1
+                self._remember(pid, *row)
+                return row[0]
+            judge_scheduler.limiter.acquire()  # 和判题共用对洛谷的请求速率
+            meta = self.fetch(pid)
+            fetched_at = time.time()
+            self.fetches += 1
+            self._remember(pid, meta, fetched_at)
+            store.save_problem(pid, meta, fetched_at)
+            return meta
+        except Exception as e:
+            self.errors += 1
+            count_error("problem", e)
+            log.error("Failed to fetch problem %s: %s", pid, e)
+            return None
+        finally:
+            with self.lock:
+                self.in_flight.pop(pid, None)
+
+    def prefetch(self, pid, callback=None):
+        """在后台查询，返回 Future；同一道题同时只查一次。callback(pid, 题目信息) 在查到后调用。"""
+        meta = self.peek(pid)
+        if meta is not None:
+            self.hits += 1
+            future = Future()
+            future.set_result(meta)
+        else:
+            with self.lock:
+                future = self.in_flight.get(pid)
+                if future is None:
+                    future = self.in_flight[pid] = self.executor.submit(self._load, pid)
+        if callback:
+            future.add_done_callback(lambda f: callback(pid, f.result()))
+        return future
+
+    def lookup_many(self, pids, timeout=20):
+        """批量查询，缓存未命中的题目并发请求。返回 {pid: 题目信息或 None}。"""
+        futures = {pid: self.prefetch(pid) for pid in set(pids)}
+        result = {}
+        for pid, future in futures.items():
+            try:
+                result[pid] = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                result[pid] = None
+        return result
+
+    def lookup(self, pid, timeout=20):
+        return self.lookup_many([pid], timeout)[pid]
+
+    def stats(self):
+        with self.lock:
+            cached = len(self.cache)
+            in_flight = len(self.in_flight)
+        return {
+            "cached": cached,
+            "in_flight": in_flight,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "fetches": self.fetches,
+            "errors": self.errors,
+        }
+
+problem_service = ProblemService(
+    app.config["LUOGU_BASE_URL"],
+    app.config["PROBLEM_CACHE_SIZE"],
+    app.config["PROBLEM_CACHE_TTL"],
+    app.config["PROBLEM_MISSING_TTL"],
+)
+
+def invalid_pids(pids):
+    """返回格式不对或者洛谷上确认不存在的题号。"""
+    malformed = [pid for pid in pids if not isinstance(pid, str) or not PID_RE.match(pid)]
+    metas = problem_service.lookup_many([pid for pid in pids if pid not in malformed])
+    return malformed + sorted(pid for pid, meta in metas.items() if meta is not None and not meta["valid"])
+
+def reject_invalid_proposal(room_id, pid, meta):
+    """后台预取发现申请的题目不存在时，自动取消这个添加申请。"""
+    if meta is None or meta["valid"]:
+        return
+    room = get_room(room_id)
+    if not room:
+        return
+    with room.lock:
+        if room.resolve_proposal("add", pid, "invalid"):
+            broadcast_room(room)
+            for team in room.teams:
+                chat_service.system(room_id, team, f"题目 {pid} 不存在，添加申请已自动取消。")
+
+# ----------------------------
+# Judge (Updated win condition)
 # Win condition: First team to have any of its members solve ALL problems in the room wins
 # Also ends if all problems are deleted (though unlikely)
 # ----------------------------
-# ... (其他代码) ...
+def apply_ac_results(room, ac_results):
+    """把 {pid: AC 用户集合} 应用到房间上：记分、判胜负并广播。
+
+    持有房间锁完成判定、记分和胜负检查，并发的判题任务不会重复记分。
+    """
+    with room.lock:
+        _apply_ac_results(room, ac_results)
+
+def resolve_from_cache(room):
+    """用 AC 缓存里已知的结果直接记分：新房间、新成员、新题目不用等下一轮抓取。返回还没解决的题目。"""
+    with room.lock:
+        # 已经确认不存在的题目不去抓（旧房间里可能还有）
+        unsolved = [pid for pid in room.problems if pid not in room.solved and not problem_service.known_invalid(pid)]
+        members = list(room.members)
+    cached = ac_cache.known_ac(unsolved, members)
+    if cached:
+        apply_ac_results(room, cached)
+        unsolved = [pid for pid in unsolved if pid not in cached]
+    return [] if room.finished else unsolved
+
+def _apply_ac_results(room, ac_results):
+    room_id = room.room_id
+    for pid, ac_users in ac_results.items():
+        if room.finished or pid in room.solved or pid not in room.problems:
+            continue
+
+        solved_by_team = None
+        for team_name in room.teams.keys(): # 使用动态队伍名
+            if any(user in ac_users for user in room.teams[team_name]):
+                solved_by_team = team_name
+                break
 
-def judge_room(room_id):
-    room = rooms[room_id]
-    print(f"[DEBUG] Judge loop started for room {room_id}")
-    while not room.finished:
-        ac_results = {}
-        for pid in list(room.problems):
-            if pid in room.solved:
+        if not solved_by_team:
+            continue
+
+        solving_user = next(user for user in ac_users if user in room.teams[solved_by_team])
+        room.record("solve", pid=pid, user=solving_user, team=solved_by_team, points=100)
+        log.info("Room %s: %s (%s) solved %s", room_id, solved_by_team, solving_user, pid)
+
+        total_points = len(room.problems) * 100
+        win_points = total_points // 2
+        if room.scores[solved_by_team] > win_points:
+            room.record("finish", winner=solved_by_team)
+            log.info("Room %s FINISHED! Winner: %s (Score: %d > %d)", room_id, solved_by_team, room.scores[solved_by_team], win_points)
+            broadcast_room(room)
+            # --- 修改点：发送 game_over 时携带完整的房间状态 ---
+            final_status = room.get_status() # 获取完整的最终状态
+            emit_room("game_over", final_status, room_id) # 发送完整状态
+            # --- 修改点结束 ---
+            break
+        room.mark_active()
+        broadcast_room(room)
+
+
+class RateLimiter:
+    """简单的令牌桶。reserve() 预订一个令牌并返回需要等待的秒数。"""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    def try_acquire(self):
+        """有令牌就拿走一个并返回 True；没有时不预订，直接返回 False。"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class JudgeScheduler:
+    """全局唯一的评测调度器，跑在独立的 asyncio 事件循环线程里。
+
+    每秒找出到期需要轮询的房间，汇总它们要轮询的扫描键（题目或成员，见 collect），同一个键
+    同时只有一个抓取任务，任务在全局信号量下并发执行（阻塞的抓取交给线程池），每个结果一到就
+    立刻分发给需要它的房间并广播，不用等整轮扫完。取房间、记分这些可能访问 Redis 或等房间锁的
+    操作也交给线程池，事件循环线程上只做调度的簿记。
+
+    每个房间的轮询间隔是自适应的：刚有动静或者只差一题就能决出胜负的房间按最短间隔轮询，
+    安静的房间逐步放慢到最长间隔。抓取出错的键按指数退避（带抖动）重试，遇到限流则全局暂停。
+    """
+    def __init__(self, interval, min_interval, max_interval, max_fetches_per_sec, concurrency):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(max_fetches_per_sec)
+        self.last_fetched = {}  # 扫描键 -> 上次抓取完成的时间
+        self.backoff = {}       # 扫描键 -> (连续失败次数, 退避到何时)
+        self.paused_until = 0   # 被限流后全局暂停到何时
+        self.room_state = {}    # room_id -> 轮询间隔、下次轮询时间和计数
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loop = None
+        self.semaphore = None
+        # 调度用的单独线程，不和抓取抢线程池，抓取排队时也能按时调度
+        self.planner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="judge-plan")
+        self.cycles = 0
+        self.fetches = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.wanted = 0
+        self.strategies = {}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run_loop, daemon=True)
+                self.thread.start()
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="judge-fetch"))
+        self.loop.run_until_complete(self._main())
+
+    async def _main(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        log.info("Judge engine started")
+        while True:
+            started = time.perf_counter()
+            try:
+                await self.dispatch()
+            except Exception as e:
+                count_error("judge_dispatch", e)
+                log.error("Judge dispatch failed: %s", e)
+            metrics.observe("judge_dispatch_seconds", time.perf_counter() - started)
+            await asyncio.sleep(1)
+
+    def next_interval(self, room, state):
+        now = time.time()
+        leading = max(room.scores.values(), default=0)
+        win_points = len(room.problems) * 100 // 2
+        # 最近一个最长间隔内有动静，或者再解一题就结束：用最短间隔
+        if now - room.last_activity < self.max_interval or leading + 100 > win_points:
+            return self.min_interval
+        return min(self.max_interval, state["interval"] * 1.5)
+
+    def judged_rooms(self):
+        """返回这个 worker 现在要判题的房间 [(room_id, room)]。在线程池里运行：多 worker 时
+        取房间、续租约和查连接数都要访问 Redis，取房间还可能等房间锁。"""
+        judged = []
+        for room_id in cluster.room_ids():
+            room = get_room(room_id)
+            if room is None or not cluster.owns_judge(room_id):
+                continue  # 这个房间由别的 worker 判题
+            if room.finished:
                 continue
-
-            ac_users_for_pid = fetch_ac_users_for_room(pid, room.members)
-            if pid in ac_users_for_pid:
-                ac_results[pid] = ac_users_for_pid[pid]
-
-        for pid, ac_users in ac_results.items():
-            if pid in room.solved:
+            if lifecycle.is_suspended(room):
+                continue  # 没有人连着的房间不判题，重新连上后马上轮询
+            judged.append((room_id, room))
+        return judged
+
+    def due_rooms(self, judged):
+        """从要判题的房间里返回到期需要轮询的，并为它们排好下一次轮询时间。"""
+        now = time.time()
+        due = []
+        # 不再由这里判题的房间清掉轮询状态
+        for room_id in set(self.room_state) - {room_id for room_id, _ in judged}:
+            del self.room_state[room_id]
+        for room_id, room in judged:
+            state = self.room_state.setdefault(room_id, {
+                "interval": self.interval, "next_poll": 0, "polls": 0, "errors": 0, "last_error": None,
+                # 本轮还在等的扫描键、本轮开始时间、上一轮用时，以及数据最近一次完整刷新的时间
+                "waiting": set(), "cycle_started": now, "last_cycle": None, "fresh_at": now,
+            })
+            if state["next_poll"] > now:
                 continue
+            state["interval"] = self.next_interval(room, state)
+            state["next_poll"] = now + state["interval"]
+            state["polls"] += 1
+            due.append((room_id, room))
+        return due
+
+    def collect(self, due):
+        """返回 {扫描键: (关心的成员或题目, 房间 id 列表)}。
+
+        按题目轮询时键是 ("pid", 题号)，附带所有关心该题的成员；
+        按用户轮询时键是 ("user", 用户名)，附带这些房间里还没解决的题目。
+        """
+        wanted = {}
+        strategies = {"problem": 0, "user": 0}
+        for room_id, room in due:
+            unsolved = resolve_from_cache(room)
+            members = list(room.members)
+            if not unsolved or not members:
+                continue
+            # 成员比未解决的题目少（常见的 1v1、2v2）时，按用户轮询更便宜
+            room.judge_strategy = "user" if len(members) < len(unsolved) else "problem"
+            strategies[room.judge_strategy] += 1
+            if room.judge_strategy == "user":
+                jobs = [(("user", user), unsolved) for user in members]
+            else:
+                jobs = [(("pid", pid), members) for pid in unsolved]
+            for key, interest in jobs:
+                wanted_interest, room_ids = wanted.setdefault(key, (set(), []))
+                wanted_interest.update(interest)
+                room_ids.append(room_id)
+        self.strategies = strategies
+        return wanted
+
+    def finish_cycle(self, state, now):
+        state["fresh_at"] = now
+        state["last_cycle"] = now - state["cycle_started"]
+        metrics.observe("judge_cycle_seconds", state["last_cycle"])
+
+    async def dispatch(self):
+        if time.time() < self.paused_until:
+            return
+        try:
+            pending = self.loop.run_in_executor(self.planner, self.judged_rooms)
+        except RuntimeError:
+            return  # 解释器退出时线程池先关了，不再调度
+        judged = await pending
+        now = time.time()
+        due = self.due_rooms(judged)
+        # collect 先用 AC 缓存记分，要拿房间锁
+        wanted = await self.loop.run_in_executor(self.planner, self.collect, due)
+        self.wanted = len(wanted)
+        # 太久没人关心的键清掉扫描状态
+        for key in list(self.last_fetched):
+            if key not in wanted and now - self.last_fetched[key] > self.max_interval * 2:
+                del self.last_fetched[key]
+                self.backoff.pop(key, None)
+                record_scanner.forget(key)
+        ac_cache.prune()
+
+        for key, (interest, room_ids) in wanted.items():
+            if key in self.in_flight:
+                continue
+            if now - self.last_fetched.get(key, 0) < self.min_interval:
+                continue
+            if self.backoff.get(key, (0, 0))[1] > now:
+                continue
+            kind, name = key
+            pairs = [(name, user) for user in interest] if kind == "pid" else [(pid, name) for pid in interest]
+            if ac_cache.covers(pairs):
+                continue  # 别的房间刚抓过，结论都还有效
+            self.in_flight.add(key)
+            self.loop.create_task(self.judge_key(key, interest, room_ids))
+
+        # 每个到期房间的这一轮，在它关心的、正在抓的键都完成时结束（见 judge_key）
+        waiting = {room_id: set() for room_id, _ in due}
+        for key, (_, room_ids) in wanted.items():
+            if key in self.in_flight:
+                for room_id in room_ids:
+                    waiting[room_id].add(key)
+        for room_id, keys in waiting.items():
+            state = self.room_state[room_id]
+            state["waiting"] = keys
+            state["cycle_started"] = now
+            if not keys:
+                self.finish_cycle(state, now)
+        self.cycles += 1
+
+    def backoff_delay(self, failures):
+        # 指数退避 + 抖动，避免大量键同时重试
+        delay = min(self.max_interval * 4, self.min_interval * 2 ** failures)
+        return delay * random.uniform(0.5, 1.5)
+
+    def record_error(self, key, room_ids, e):
+        failures = self.backoff.get(key, (0, 0))[0] + 1
+        self.backoff[key] = (failures, time.time() + self.backoff_delay(failures))
+        self.errors += 1
+        count_error("judge", e)
+        if isinstance(e, RateLimitedError):
+            self.rate_limited += 1
+            self.paused_until = max(self.paused_until, time.time() + self.backoff_delay(failures))
+        for room_id in room_ids:
+            state = self.room_state.get(room_id)
+            if state:
+                state["errors"] += 1
+                state["last_error"] = f"{type(e).__name__}: {e}"
+
+    async def judge_key(self, key, interest, room_ids):
+        kind, name = key
+        fetch = fetch_ac_users_for_room if kind == "pid" else fetch_ac_problems_for_user
+        try:
+            async with self.semaphore:
+                # 限速在 timed_fetch 里按每次请求进行，多翻的页也要排队
+                ac_results = await self.loop.run_in_executor(None, fetch, name, interest)
+        except Exception as e:
+            self.record_error(key, room_ids, e)
+            return
+        else:
+            self.backoff.pop(key, None)
+            self.last_fetched[key] = time.time()
+            self.fetches += 1
+            # 记分要拿房间锁（多 worker 时是 Redis 锁），同样不在事件循环线程上做
+            await self.loop.run_in_executor(None, self.apply_results, ac_results, room_ids)
+        finally:
+            self.in_flight.discard(key)
+            now = time.time()
+            for state in list(self.room_state.values()):
+                if key in state["waiting"]:
+                    state["waiting"].discard(key)
+                    if not state["waiting"]:
+                        self.finish_cycle(state, now)
+
+    def apply_results(self, ac_results, room_ids):
+        for room_id in room_ids:
+            room = get_room(room_id)
+            if room:
+                apply_ac_results(room, {pid: ac_users & room.members for pid, ac_users in ac_results.items()})
+
+    def stats(self):
+        now = time.time()
+        return {
+            "cycles": self.cycles,
+            "fetches": self.fetches,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "paused_for": round(max(0, self.paused_until - now), 1),
+            "keys": self.wanted,
+            "strategies": self.strategies,
+            "in_flight": len(self.in_flight),
+            "concurrency": self.concurrency,
+            "backoff": {f"{kind}:{name}": round(max(0, until - now), 1) for (kind, name), (_, until) in list(self.backoff.items())},
+            "staleness": {f"{kind}:{name}": round(now - t, 1) for (kind, name), t in list(self.last_fetched.items())},
+            "rooms": {
+                room_id: {
+                    "interval": round(state["interval"], 1),
+                    "next_poll_in": round(max(0, state["next_poll"] - now), 1),
+                    "polls": state["polls"],
+                    "errors": state["errors"],
+                    "last_error": state["last_error"],
+                    "lag": round(now - state["fresh_at"], 1),
+                    "last_cycle": None if state["last_cycle"] is None else round(state["last_cycle"], 2),
+                }
+                for room_id, state in list(self.room_state.items())
+            },
+            "scanner": record_scanner.stats(),
+            "ac_cache": ac_cache.stats(),
+        }
 
-            solved_by_team = None
-            for team_name in room.teams.keys(): # 使用动态队伍名
-                if any(user in ac_users for user in room.teams[team_name]):
-                    solved_by_team = team_name
-                    break
+judge_scheduler = JudgeScheduler(
+    app.config["JUDGE_INTERVAL"],
+    app.config["JUDGE_MIN_INTERVAL"],
+    app.config["JUDGE_MAX_INTERVAL"],
+    app.config["JUDGE_MAX_FETCHES_PER_SEC"],
+    app.config["JUDGE_CONCURRENCY"],
+)
 
-            if not solved_by_team:
-                continue
+# ----------------------------
+# Solve Claims
+# 做出题的选手可以直接报记录编号（/api/claim 或聊天里的 !ac <记录编号>）：服务器只抓这一条记录，
+# 核对题号、用户和 Accepted 后马上走和判题相同的记分流程，不用等下一轮轮询。
+# 同一条记录同时只抓一次、评测完的结果会记住；每个用户按令牌桶限速，排队的核验数也有上限。
+# ----------------------------
+RECORD_ID_RE = re.compile(r"^\d{1,12}$")
+
+CLAIM_MESSAGES = {
+    "accepted": "{user} 的记录 {record_id} 核验通过，{pid} 记分成功！",
+    "already_solved": "{pid} 已经被解决了。",
+    "not_accepted": "记录 {record_id} 没有通过（不是 Accepted）。",
+    "judging": "记录 {record_id} 还在评测中，稍后再试。",
+    "wrong_user": "记录 {record_id} 不是 {user} 的提交。",
+    "not_in_room": "记录 {record_id} 的题目 {pid} 不在本房间里。",
+    "not_found": "记录 {record_id} 不存在。",
+    "rate_limited": "核验太频繁，请稍后再试。",
+    "busy": "核验的人太多了，请稍后再试。",
+    "error": "暂时无法访问洛谷，记录 {record_id} 没能核验，请稍后再试。",
+    "no_room": "房间不存在",
+}
+CLAIM_THROTTLED = {"rate_limited", "busy"}  # 只告诉提交核验的人，不进队伍聊天记录
+
+class ClaimService:
+    def __init__(self, rate, burst, max_pending, workers=2, remember=4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_pending = max_pending
+        self.remember = remember
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="claim")
+        self.limiters = {}            # 用户 -> RateLimiter
+        self.in_flight = {}           # 记录编号 -> 正在抓取的 Future
+        self.records = OrderedDict()  # 记录编号 -> 评测完的记录（None 表示不存在），LRU
+        self.lock = threading.Lock()
+
+    def allow(self, user):
+        with self.lock:
+            limiter = self.limiters.get(user)
+            if limiter is None:
+                limiter = self.limiters[user] = RateLimiter(self.rate, self.burst)
+        return limiter.try_acquire()
+
+    def lookup(self, record_id):
+        """返回这条记录的 Future：记住的结果直接完成，正在抓的共用同一个，队列满时返回 None。"""
+        with self.lock:
+            if record_id in self.records:
+                self.records.move_to_end(record_id)
+                future = Future()
+                future.set_result(self.records[record_id])
+                return future
+            future = self.in_flight.get(record_id)
+            if future is None:
+                if len(self.in_flight) >= self.max_pending:
+                    return None
+                future = self.in_flight[record_id] = self.executor.submit(self._fetch, record_id)
+            return future
+
+    def _fetch(self, record_id):
+        try:
+            record = fetch_with_fallback("fetch_record", record_id)  # 和判题共用对洛谷的请求速率
+            # 还在评测的记录过一会儿会变，不记
+            if record is None or record["status"] not in LUOGU_STATUS_PENDING:
+                with self.lock:
+                    self.records[record_id] = record
+                    while len(self.records) > self.remember:
+                        self.records.popitem(last=False)
+            return record
+        finally:
+            with self.lock:
+                self.in_flight.pop(record_id, None)
+
+    def claim(self, room_id, team, user, record_id):
+        """核验 user 报的记录，返回 Future，结果是 (状态, 题号)；结果也会发到队伍聊天里。
+        被限流（CLAIM_THROTTLED）时不发聊天，Future 直接完成，由调用方告诉提交的人。"""
+        result = Future()
+
+        def finish(status, pid=None):
+            metrics.inc("claims_total", status=status)
+            if status not in CLAIM_THROTTLED:
+                chat_service.system(room_id, team, CLAIM_MESSAGES[status].format(user=user, record_id=record_id, pid=pid))
+            result.set_result((status, pid))
+
+        def verified(future):
+            try:
+                finish(*self.verify(room_id, user, future.result()))
+            except Exception as e:
+                count_error("claim", e)
+                log.error("Failed to verify record %s: %s", record_id, e)
+                finish("error")
+
+        if not self.allow(user):
+            finish("rate_limited")
+            return result
+        future = self.lookup(record_id)
+        if future is None:
+            finish("busy")
+        else:
+            future.add_done_callback(verified)
+        return result
+
+    def verify(self, room_id, user, record):
+        room = get_room(room_id)
+        if room is None:
+            return "no_room", None
+        if record is None:
+            return "not_found", None
+        pid = record["pid"]
+        if record["user"] != user:
+            return "wrong_user", pid
+        if record["status"] in LUOGU_STATUS_PENDING:
+            return "judging", pid
+        if not record["accepted"]:
+            return "not_accepted", pid
+        if pid not in room.problems:
+            return "not_in_room", pid
+        ac_cache.record({pid: {user}}, [(pid, user)])
+        if pid in room.solved:
+            return "already_solved", pid
+        apply_ac_results(room, {pid: {user}})
+        return ("accepted" if room.solved_by.get(pid, {}).get("user") == user else "already_solved"), pid
 
-            room.solved.add(pid)
-            solving_user = next(user for user in ac_users if user in room.teams[solved_by_team])
-            room.solved_by[pid] = {"user": solving_user, "team": solved_by_team}
-            room.scores[solved_by_team] += 100
-            print(f"[DEBUG] Room {room_id}: {solved_by_team} ({solving_user}) solved {pid}")
-
-            total_points = len(room.problems) * 100
-            win_points = total_points // 2
-            if room.scores[solved_by_team] > win_points:
-                room.winner = solved_by_team
-                room.finished = True
-                print(f"[DEBUG] Room {room_id} FINISHED! Winner: {solved_by_team} (Score: {room.scores[solved_by_team]} > {win_points})")
-                # --- 修改点：发送 game_over 时携带完整的房间状态 ---
-                final_status = room.get_status() # 获取完整的最终状态
-                socketio.emit("game_over", final_status, room=room_id) # 发送完整状态
-                # --- 修改点结束 ---
-                break
-            socketio.emit("update", room.get_status(), room=room_id)
+claim_service = ClaimService(app.config["CLAIM_RATE"], app.config["CLAIM_BURST"], app.config["CLAIM_MAX_PENDING"])
 
-        if not room.finished:
-            time.sleep(10)
-    print(f"[DEBUG] Judge loop ended for room {room_id}")
+# ----------------------------
+# Avatars
+# 请求线程里只读文件头做校验（格式和尺寸，不解码像素），解码、缩放和编码放到后台线程池。
+# 缩略图统一是 AVATAR_SIZE 见方的 WebP，文件名是内容的哈希：相同的上传只存一份，
+# 文件名不变内容就不变，浏览器可以永久缓存。Pillow 只有允许上传头像时才需要安装。
+# ----------------------------
+AVATAR_NAME_RE = re.compile(r"^[0-9a-f]{16}\.webp$")
+
+class AvatarError(Exception):
+    """上传的头像不合格，消息直接展示给用户。"""
+
+class AvatarService:
+    FORMATS = {"PNG", "JPEG", "GIF", "WEBP", "BMP"}
+
+    def __init__(self, folder, size, max_bytes, max_pixels, workers=2):
+        self.folder = folder
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.sources = OrderedDict()  # 原文件的 sha256 -> 缩略图路径，重复上传时连解码都省掉
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="avatar")
+
+    def check(self, data):
+        """快速校验，不合格时抛 AvatarError。"""
+        if len(data) > self.max_bytes:
+            raise AvatarError(f"头像文件不能超过 {self.max_bytes // (1024 * 1024)}MB")
+        try:
+            from PIL import Image
+        except ImportError:
+            raise AvatarError("服务器暂不支持上传头像")
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image_format, (width, height) = image.format, image.size
+        except Exception:
+            raise AvatarError("无法识别的图片文件")
+        if image_format not in self.FORMATS:
+            raise AvatarError("头像只支持 PNG、JPEG、GIF、WebP 和 BMP 格式")
+        if width * height > self.max_pixels:
+            raise AvatarError("图片尺寸过大")
+
+    def submit(self, data):
+        """校验后在后台生成缩略图，返回 Future，结果是相对 static 目录的路径（"avatars/<哈希>.webp"）。"""
+        self.check(data)
+        return self.executor.submit(self._process, data)
+
+    def _process(self, data):
+        started = time.perf_counter()
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            path = self.sources.get(digest)
+        if path is not None:
+            metrics.inc("avatars_total", result="deduplicated")
+            return path
+        from PIL import Image, ImageOps
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft("RGB", (self.size, self.size))  # JPEG 直接按接近目标的尺寸解码
+            image = ImageOps.exif_transpose(image)
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+            thumb = ImageOps.fit(image.convert("RGBA" if has_alpha else "RGB"), (self.size, self.size), Image.LANCZOS)
+        buf = io.BytesIO()
+        thumb.save(buf, "WEBP", quality=80, method=4)
+        blob = buf.getvalue()
+        filename = hashlib.sha256(blob).hexdigest()[:16] + ".webp"
+        target = os.path.join(self.folder, filename)
+        if os.path.exists(target):
+            metrics.inc("avatars_total", result="deduplicated")
+        else:
+            tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(blob)
+            os.replace(tmp, target)
+            metrics.inc("avatars_total", result="stored")
+        path = f"avatars/{filename}"
+        with self.lock:
+            self.sources[digest] = path
+            while len(self.sources) > 1024:
+                self.sources.popitem(last=False)
+        metrics.observe("avatar_process_seconds", time.perf_counter() - started)
+        return path
+
+avatar_service = AvatarService(
+    app.config["AVATAR_FOLDER"], app.config["AVATAR_SIZE"], app.config["AVATAR_MAX_BYTES"], app.config["AVATAR_MAX_PIXELS"],
+)
+
+
+@app.before_request
+def start_background_workers():
+    # 在第一个请求时才启动后台线程，避免 debug 重载器的父进程也去抓取
+    judge_scheduler.start()
+    store.start()
+    lifecycle.start()
 
 
 def get_current_user():
     uid = session.get("user_id")
-    return users.get(uid) if uid else None
+    if not uid:
+        return None
+    return users.get(uid) or cluster.load_user(uid)
 
 # ----------------------------
 # Routes
@@ -190,33 +2985,60 @@ def index():
     if not user:
         return redirect(url_for("register"))
 
-    room_list = []
-    for rid, room in rooms.items():
-        # --- 修复点：获取动态队伍名 ---
-        teams_list = list(room.teams.keys()) # 获取当前房间的两个队伍名
-        if len(teams_list) >= 2: # 确保有两个队伍
-            team1_name = teams_list[0]
-            team2_name = teams_list[1]
-            players_info = f"{team1_name}: {len(room.teams[team1_name])} | {team2_name}: {len(room.teams[team2_name])}"
-        else:
-            # 如果队伍数量异常，显示未知
-            players_info = "未知队伍"
-        # --- 修复点结束 ---
-
-        is_in_room = user["luogu_name"] in room.members
-        room_list.append({
-            "id": rid,
-            "teams": { # 传递队伍名给前端，方便显示
-                "team1": team1_name,
-                "team2": team2_name
-            },
-            "players": players_info,
-            "status": "进行中" if not room.finished else "已结束",
-            "url": url_for("room_page", room_id=rid),
-            "is_in_room": is_in_room
-        })
-    return render_template("index.html", rooms=room_list, current_user=user)
+    # 房间列表由页面通过 /api/lobby 分页加载，之后靠 "lobby" 频道的推送增量更新
+    return render_template("index.html", current_user=user)
+
+
+@app.route("/api/lobby")
+def lobby_rooms():
+    """大厅房间列表：?status=active|finished 按状态筛选，?mine=1 只看自己所在的房间，
+    ?cursor= 传上一页返回的 next_cursor，?limit= 每页条数（最多 100）。"""
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "请先注册"}), 401
+
+    state = request.args.get("status") or None
+    if state not in (None, "active", "finished"):
+        return jsonify({"error": "无效的筛选条件"}), 400
+    mine = request.args.get("mine") == "1"
+    cursor = request.args.get("cursor") or None
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "无效的 limit"}), 400
+
+    lobby.sync()
+    # 摘要表没变过就直接 304，不用重新分页和序列化
+    etag = uuid.uuid5(uuid.NAMESPACE_URL, f"{cluster.worker_id}/{lobby.version}/{session['user_id']}/{state}/{mine}/{cursor}/{limit}").hex
+    if etag in request.if_none_match:
+        return "", 304
+    try:
+        items, next_cursor = lobby.page(state, cursor, limit, user["luogu_name"] if mine else None)
+    except ValueError:
+        return jsonify({"error": "无效的游标"}), 400
+
+    joined = lobby.rooms_of(user["luogu_name"])
+    resp = jsonify({
+        "rooms": [
+            dict(summary, url=url_for("room_page", room_id=summary["id"]), is_in_room=summary["id"] in joined)
+            for summary in items
+        ],
+        "next_cursor": next_cursor,
+    })
+    resp.set_etag(etag)
+    return resp
+
 
+@app.errorhandler(413)
+def request_too_large(e):
+    # 请求体超过 MAX_CONTENT_LENGTH（没有 Content-Length 的分块上传读到超限时也会走到这里）。
+    # 接口返回 JSON，注册表单和它的其他错误一样返回纯文本
+    if request.path.startswith("/api/"):
+        return jsonify({"error": "请求太大"}), 413
+    if request.endpoint == "register":
+        metrics.inc("avatars_total", result="rejected")
+        return f"头像文件不能超过 {app.config['AVATAR_MAX_BYTES'] // (1024 * 1024)}MB", 413
+    return "请求太大", 413
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -228,18 +3050,23 @@ def register():
             return "洛谷用户名不能为空", 400
 
         user_id = str(uuid.uuid4())
-        avatar_path = None
+        pending_avatar = None
         if avatar_file and avatar_file.filename != '':
-            # Secure filename and save
-            filename = secure_filename(f"{user_id}.png")
-            filepath = os.path.join(app.config["AVATAR_FOLDER"], filename)
-            avatar_file.save(filepath)
-            avatar_path = f"avatars/{filename}"
+            try:
+                pending_avatar = avatar_service.submit(avatar_file.read(app.config["AVATAR_MAX_BYTES"] + 1))
+            except AvatarError as e:
+                metrics.inc("avatars_total", result="rejected")
+                return str(e), 400
 
         users[user_id] = {
             "luogu_name": luogu_name,
-            "avatar": avatar_path
+            "avatar": None
         }
+        store.save_user(user_id, users[user_id])
+        cluster.save_user(user_id, users[user_id])
+        if pending_avatar is not None:
+            # 缩略图生成好之后再补上头像，注册不用等
+            pending_avatar.add_done_callback(lambda future: set_user_avatar(user_id, future))
         session["user_id"] = user_id
         return redirect(url_for("index"))
 
@@ -249,6 +3076,21 @@ def register():
 
     return render_template("register.html")
 
+def set_user_avatar(user_id, future):
+    try:
+        path = future.result()
+    except Exception as e:
+        metrics.inc("avatars_total", result="failed")
+        count_error("avatar", e)
+        log.error("Failed to process avatar for user %s: %s", user_id, e)
+        return
+    user = users.get(user_id)
+    if user is None:
+        return
+    user["avatar"] = path
+    store.save_user(user_id, user)
+    cluster.save_user(user_id, user)
+
 @app.route("/logout")
 def logout():
     session.pop("user_id", None)
@@ -260,15 +3102,87 @@ def room_page(room_id):
     if not user:
         return redirect(url_for("register"))
 
-    if room_id not in rooms:
+    room = get_room(room_id) or store.load_room(room_id)  # 已归档的房间从数据库里读出来只读展示
+    if not room:
         return "房间不存在", 404
 
-    room = rooms[room_id]
-    # Check if user is in the room
+    # 不在房间里的人进观战页
     if user["luogu_name"] not in room.members:
-        return "你不在这个房间中", 403
+        return redirect(url_for("watch_page", room_id=room_id))
+
+    revision, status = room_snapshot(room)
+    return render_template("room.html", room=status, room_rev=revision, current_user=user)
+
+@app.route("/room/<room_id>/watch")
+def watch_page(room_id):
+    user = get_current_user()
+    if not user:
+        return redirect(url_for("register"))
+
+    room = get_room(room_id) or store.load_room(room_id)
+    if not room:
+        return "房间不存在", 404
+    revision, status = room_snapshot(room)
+    return render_template(
+        "spectate.html", room={key: status[key] for key in SPECTATOR_KEYS}, room_rev=revision, current_user=user,
+    )
 
-    return render_template("room.html", room=room.get_status(), current_user=user)
+
+@app.route("/api/room/<room_id>/status")
+def room_status(room_id):
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "请先注册"}), 401
+
+    room = get_room(room_id)
+    if not room:
+        return jsonify({"error": "房间不存在"}), 404
+    # 不在房间里的人和观战页一样，只能看到观战字段（看不到申请等队内细节）
+    if user["luogu_name"] not in room.members:
+        status = room.get_status()
+        return jsonify({key: status[key] for key in SPECTATOR_KEYS})
+    # 直接返回预编码的 JSON，状态没变时不用重新序列化
+    return app.response_class(room.status_json(), mimetype="application/json")
+
+@app.route("/api/room/<room_id>/events")
+def room_events(room_id):
+    # 事件日志分页：?after=<seq>&limit=<n>，归档的房间也能查
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "请先注册"}), 401
+    room = get_room(room_id) or store.load_room(room_id)
+    if not room:
+        return jsonify({"error": "房间不存在"}), 404
+    # 事件里有各队的申请等细节，只给房间成员看；观众用 replay，只能看到观战字段
+    if user["luogu_name"] not in room.members:
+        return jsonify({"error": "你不在该房间中"}), 403
+    after = request.args.get("after", 0, type=int)
+    limit = max(1, min(request.args.get("limit", 200, type=int), 1000))
+    store.flush()
+    events = store.load_events(room_id, after=after, limit=limit)
+    return jsonify({"events": events, "next": events[-1]["seq"] if len(events) == limit else None})
+
+@app.route("/api/room/<room_id>/replay")
+def room_replay(room_id):
+    # 用快照 + 事件重建房间在第 seq 条事件之后的状态（不传 seq 时是最新的）
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "请先注册"}), 401
+    current = get_room(room_id) or store.load_room(room_id)
+    if not current:
+        return jsonify({"error": "房间不存在"}), 404
+    seq = request.args.get("seq", type=int)
+    try:
+        room = event_log.rebuild(room_id, seq)
+    except EventLogError as e:
+        return jsonify({"error": str(e)}), 409
+    if room is None:
+        return jsonify({"error": "这个房间没有事件日志"}), 404
+    state = room.get_status()
+    # 不在房间里的人和观战页一样，只能看到观战字段
+    if user["luogu_name"] not in current.members:
+        state = {key: state[key] for key in SPECTATOR_KEYS}
+    return jsonify({"room_id": room_id, "seq": room.event_seq, "state": state})
 
 
 @app.route("/api/leave", methods=["POST"])
@@ -280,10 +3194,10 @@ def leave_room():
     data = request.json
     room_id = data.get("room_id")
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
     if room.remove_member(user["luogu_name"]):
         # Check if game should end due to empty team (optional rule)
         # if not room.teams["team1"] or not room.teams["team2"]:
@@ -292,7 +3206,8 @@ def leave_room():
         #     socketio.emit("game_over", {"winner": room.winner}, room=room_id)
 
         # Emit update to all in the room
-        socketio.emit("update", room.get_status(), room=room_id)
+        room.mark_active()
+        broadcast_room(room)
         return jsonify({"ok": True})
     else:
         return jsonify({"error": "你不在该房间中"}), 400
@@ -307,34 +3222,40 @@ def accept_proposal():
     room_id = data.get("room_id")
     pid = data.get("pid")
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
-    proposal_to_accept = None
-    for prop in room.proposals:
-        if prop["pid"] == pid and prop["status"] == "pending":
-            proposal_to_accept = prop
-            break
+    # 提出申请时已经预取过，通常直接命中缓存；放在加锁之前，避免持锁等待网络
+    meta = problem_service.lookup(pid) if room.pending.get(("add", pid)) else None
 
-    if not proposal_to_accept:
-        return jsonify({"error": "提案未找到或非待处理状态"}), 404
+    with room.lock:
+        proposal_to_accept = room.pending.get(("add", pid))
 
-    proposer_team = proposal_to_accept["proposer"]
-    # 根据发起队伍找到对方队伍
-    teams_list = list(room.teams.keys())
-    if proposer_team not in teams_list:
-        return jsonify({"error": "内部错误：提案队伍无效"}), 500
-    accepter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
+        if not proposal_to_accept:
+            return jsonify({"error": "提案未找到或非待处理状态"}), 404
 
-    if user["luogu_name"] not in room.teams.get(accepter_team, []):
-        return jsonify({"error": "你不在有权限同意的队伍中"}), 403
+        proposer_team = proposal_to_accept["proposer"]
+        # 根据发起队伍找到对方队伍
+        teams_list = list(room.teams.keys())
+        if proposer_team not in teams_list:
+            return jsonify({"error": "内部错误：提案队伍无效"}), 500
+        accepter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
 
-    proposal_to_accept["status"] = "accepted"
-    room.problems.add(pid)
+        if room.member_team.get(user["luogu_name"]) != accepter_team:
+            return jsonify({"error": "你不在有权限同意的队伍中"}), 403
 
-    socketio.emit("update", room.get_status(), room=room_id)
-    return jsonify({"ok": True})
+        if meta is not None and not meta["valid"]:
+            room.resolve_proposal("add", pid, "invalid")
+            broadcast_room(room)
+            return jsonify({"error": f"题目 {pid} 不存在，申请已取消"}), 400
+
+        room.resolve_proposal("add", pid, "accepted")
+        room.record("add_problem", pid=pid)
+
+        room.mark_active()
+        broadcast_room(room)
+        return jsonify({"ok": True})
 
 
 @app.route("/api/accept_delete", methods=["POST"])
@@ -347,36 +3268,31 @@ def accept_delete():
     room_id = data.get("room_id")
     pid = data.get("pid")
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
-    proposal_to_accept = None
-    for prop in room.deletion_proposals:
-        if prop["pid"] == pid and prop["status"] == "pending":
-            proposal_to_accept = prop
-            break
+    with room.lock:
+        proposal_to_accept = room.pending.get(("delete", pid))
 
-    if not proposal_to_accept:
-        return jsonify({"error": "删除提案未找到或非待处理状态"}), 404
+        if not proposal_to_accept:
+            return jsonify({"error": "删除提案未找到或非待处理状态"}), 404
 
-    proposer_team = proposal_to_accept["proposer"]
-    teams_list = list(room.teams.keys())
-    if proposer_team not in teams_list:
-        return jsonify({"error": "内部错误：提案队伍无效"}), 500
-    accepter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
+        proposer_team = proposal_to_accept["proposer"]
+        teams_list = list(room.teams.keys())
+        if proposer_team not in teams_list:
+            return jsonify({"error": "内部错误：提案队伍无效"}), 500
+        accepter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
 
-    if user["luogu_name"] not in room.teams.get(accepter_team, []):
-        return jsonify({"error": "你不在有权限同意的队伍中"}), 403
+        if room.member_team.get(user["luogu_name"]) != accepter_team:
+            return jsonify({"error": "你不在有权限同意的队伍中"}), 403
 
-    proposal_to_accept["status"] = "accepted"
-    room.problems.discard(pid)
-    room.solved.discard(pid)
-    if pid in room.solved_by:
-        del room.solved_by[pid]
+        room.resolve_proposal("delete", pid, "accepted")
+        room.record("remove_problem", pid=pid)
 
-    socketio.emit("update", room.get_status(), room=room_id)
-    return jsonify({"ok": True})
+        room.mark_active()
+        broadcast_room(room)
+        return jsonify({"ok": True})
 
 
 
@@ -385,89 +3301,224 @@ def accept_delete():
 def handle_join_room(data):
     room_id = data["room_id"]
     team = data["team"]
-    join_room(room_id)
+    # 只有这个队的队员能订阅房间和队伍频道；不在房间里的人用 spectate 观战
+    if not is_team_member(room_id, team):
+        return
+    # 客户端在 wire 里列出它能解码的格式；老客户端不带这个字段，照旧收 JSON
+    formats = data.get("wire")
+    if wire.available and isinstance(formats, list) and WIRE_FORMAT in formats:
+        wire_subscribe(request.sid, room_id)
+    else:
+        join_room(room_id)
     join_room(f"{room_id}_{team}")
-    emit("message", {"user": "系统", "text": f"欢迎 {team} 队员加入!", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
+    lifecycle.attach(request.sid, room_id)
+    # 先把最近的聊天记录发给新来的人，再广播欢迎消息。欢迎消息不进聊天记录，否则每次重连都会多一条
+    emit("chat_history", chat_service.history(room_id, team))
+    welcome = {"user": "系统", "text": f"欢迎 {team} 队员加入!", "time": time.strftime("%H:%M:%S")}
+    emit("messages", {"room_id": room_id, "team": team, "messages": [welcome]}, room=f"{room_id}_{team}")
+
+@socketio.on("chat_history")
+def handle_chat_history(data):
+    # 客户端往上翻到头时按 id 分页取更早的消息
+    room_id = data.get("room_id")
+    team = data.get("team")
+    if not is_team_member(room_id, team):
+        return
+    try:
+        before = None if data.get("before") is None else int(data["before"])
+        limit = None if data.get("limit") is None else int(data["limit"])
+    except (TypeError, ValueError):
+        return
+    emit("chat_history", chat_service.history(room_id, team, before, limit))
+
+@socketio.on("join_lobby")
+def handle_join_lobby(*args):
+    # 大厅页面订阅 room_created / room_updated / room_finished / room_removed
+    join_room("lobby")
+
+@socketio.on("disconnect")
+def handle_disconnect(*args):
+    lifecycle.detach(request.sid)
+    wire_unsubscribe(request.sid)
+    spectator_hub.leave(request.sid)
+
+@socketio.on("spectate")
+def handle_spectate(data):
+    # 观众：只读，收合并过的完整状态；和 join_room 一样可以在 wire 里协商二进制格式
+    room = get_room(data.get("room_id"))
+    if not room:
+        return
+    formats = data.get("wire")
+    binary = wire.available and isinstance(formats, list) and WIRE_FORMAT in formats
+    spectator_hub.join(request.sid, room.room_id, binary)
+    lifecycle.attach(request.sid, room.room_id)
+    _, payload, frame = spectator_hub.frame(room)
+    emit("spectate", frame if binary else payload)
+
+@socketio.on("sync")
+def handle_sync(data):
+    # 客户端发现 patch 有缺口（或重连）时同步：报上了 rev 和 seq 并且内存里的事件日志够得着时只补发差异，
+    # 否则发完整快照
+    room = get_room(data.get("room_id"))
+    if not room:
+        return
+    # 完整状态只发给房间成员；观众的状态由 spectate 推送
+    user = get_current_user()
+    if not user or user["luogu_name"] not in room.members:
+        return
+    lifecycle.attach(request.sid, room.room_id)
+    patch = catch_up_patch(room, data.get("rev"), data.get("seq"))
+    if patch is not None:
+        if patch["set"] or patch["items"] or patch["rev"] != patch["base"]:
+            emit_client("patch", patch)
+        return
+    revision, status = room_snapshot(room)
+    emit_client("snapshot", {"room_id": room.room_id, "rev": revision, "state": status})
+
+def is_team_member(room_id, team):
+    user = get_current_user()
+    room = get_room(room_id)
+    return bool(user and room and room.member_team.get(user["luogu_name"]) == team)
 
 @socketio.on("chat")
 def handle_chat(data):
     room_id = data["room_id"]
     team = data["team"]
-    user = data["user"]
     text = data["text"]
 
+    # 只有队员能在队伍频道里发言，身份用登录的用户，不信任客户端发来的 user
+    if not is_team_member(room_id, team):
+        return
+    current = get_current_user()
+    user = current["luogu_name"]
+
+    # 按登录的用户限速，命令也算在内
+    if not chat_service.allow(user):
+        notice = {"user": "系统", "text": "发言太频繁，请稍后再试。", "time": time.strftime("%H:%M:%S")}
+        emit("messages", {"room_id": room_id, "team": team, "messages": [notice]})
+        return
+
     # --- Check for commands ---
     if text.startswith("!propose "):
         pid = text[len("!propose "):].strip()
         if not pid:
-            emit("message", {"user": "系统", "text": "格式错误：!propose <题目ID>", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
+            chat_service.system(room_id, team, "格式错误：!propose <题目ID>")
             return
 
-        room = rooms.get(room_id)
+        room = get_room(room_id)
         if not room:
             return
 
-        if user not in room.teams.get(team, []):
-             emit("message", {"user": "系统", "text": "你不在该队伍中，无法申请。", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
-             return
-
-        # Add proposal to room state
-        room.proposals.append({
-            "proposer": team,
-            "pid": pid,
-            "status": "pending",
-            "timestamp": time.strftime("%H:%M:%S")
-        })
-        # Broadcast the proposal request to the entire room
-        socketio.emit("proposal_request", {"proposer": team, "pid": pid, "timestamp": time.strftime("%H:%M:%S")}, room=room_id)
-        # Also broadcast an update so the proposal list refreshes
-        socketio.emit("update", room.get_status(), room=room_id)
-        # Send confirmation to the sender's team
-        emit("message", {"user": "系统", "text": f"已申请添加题目: {pid}", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
+        if not PID_RE.match(pid) or problem_service.known_invalid(pid):
+            chat_service.system(room_id, team, f"题目 {pid} 不存在。")
+            return
+
+        with room.lock:
+            if room.member_team.get(user) != team:
+                 chat_service.system(room_id, team, "你不在该队伍中，无法申请。")
+                 return
+
+            # Add proposal to room state
+            proposal = room.add_proposal("add", team, pid)
+            if not proposal:
+                chat_service.system(room_id, team, f"添加申请 {pid} 已存在。")
+                return
+            # Broadcast the proposal request to the entire room
+            emit_room("proposal_request", {"proposer": team, "pid": pid, "timestamp": proposal["timestamp"]}, room_id)
+            # Also broadcast an update so the proposal list refreshes
+            room.mark_active()
+            broadcast_room(room)
+            # Send confirmation to the sender's team
+            chat_service.system(room_id, team, f"已申请添加题目: {pid}")
+        problem_service.prefetch(pid, lambda pid, meta: reject_invalid_proposal(room_id, pid, meta))
         return # Don't send the command as a normal message
 
+    elif text.startswith("!ac "):
+        record_id = text[len("!ac "):].strip()
+        if not RECORD_ID_RE.match(record_id):
+            chat_service.system(room_id, team, "格式错误：!ac <记录编号>")
+            return
+
+        room = get_room(room_id)
+        if not room:
+            return
+        future = claim_service.claim(room_id, team, user, record_id)  # 结果会发到队伍聊天里
+        status, _ = future.result() if future.done() else (None, None)
+        if status in CLAIM_THROTTLED:
+            # 被限流的结果只发给自己，不占队伍的聊天记录
+            notice = {"user": "系统", "text": CLAIM_MESSAGES[status], "time": time.strftime("%H:%M:%S")}
+            emit("messages", {"room_id": room_id, "team": team, "messages": [notice]})
+        return
+
     elif text.startswith("!delete "):
         pid = text[len("!delete "):].strip()
         if not pid:
-            emit("message", {"user": "系统", "text": "格式错误：!delete <题目ID>", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
+            chat_service.system(room_id, team, "格式错误：!delete <题目ID>")
             return
 
-        room = rooms.get(room_id)
+        room = get_room(room_id)
         if not room:
             return
 
-        if user not in room.teams.get(team, []):
-             emit("message", {"user": "系统", "text": "你不在该队伍中，无法申请。", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
-             return
+        with room.lock:
+            if room.member_team.get(user) != team:
+                 chat_service.system(room_id, team, "你不在该队伍中，无法申请。")
+                 return
 
-        # Check if problem exists
-        if pid not in room.problems:
-            emit("message", {"user": "系统", "text": f"题目 {pid} 不存在，无法删除。", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
-            return
-
-        # Check if already proposed for deletion
-        for prop in room.deletion_proposals:
-            if prop["pid"] == pid and prop["status"] == "pending":
-                emit("message", {"user": "系统", "text": f"删除申请 {pid} 已存在。", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
+            # Check if problem exists
+            if pid not in room.problems:
+                chat_service.system(room_id, team, f"题目 {pid} 不存在，无法删除。")
                 return
 
-        # Add deletion proposal to room state
-        room.deletion_proposals.append({
-            "proposer": team,
-            "pid": pid,
-            "status": "pending",
-            "timestamp": time.strftime("%H:%M:%S")
-        })
-        # Broadcast the deletion proposal request to the entire room
-        socketio.emit("deletion_request", {"proposer": team, "pid": pid, "timestamp": time.strftime("%H:%M:%S")}, room=room_id)
-        # Also broadcast an update so the deletion proposal list refreshes
-        socketio.emit("update", room.get_status(), room=room_id)
-        # Send confirmation to the sender's team
-        emit("message", {"user": "系统", "text": f"已申请删除题目: {pid} (需对方同意)", "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
-        return # Don't send the command as a normal message
+            # Add deletion proposal to room state (None if already proposed)
+            proposal = room.add_proposal("delete", team, pid)
+            if not proposal:
+                chat_service.system(room_id, team, f"删除申请 {pid} 已存在。")
+                return
+            # Broadcast the deletion proposal request to the entire room
+            emit_room("deletion_request", {"proposer": team, "pid": pid, "timestamp": proposal["timestamp"]}, room_id)
+            # Also broadcast an update so the deletion proposal list refreshes
+            room.mark_active()
+            broadcast_room(room)
+            # Send confirmation to the sender's team
+            chat_service.system(room_id, team, f"已申请删除题目: {pid} (需对方同意)")
+            return # Don't send the command as a normal message
 
     # --- Send normal message ---
-    emit("message", {"user": user, "text": text, "time": time.strftime("%H:%M:%S")}, room=f"{room_id}_{team}")
+    room = get_room(room_id)
+    if room:
+        room.mark_active()
+    chat_service.post(room_id, team, user, text)
+
+@app.route("/api/claim", methods=["POST"])
+def claim_solve():
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "请先注册"}), 401
+
+    data = request.json
+    room_id = data.get("room_id")
+    record_id = str(data.get("record_id", "")).strip()
+
+    room = get_room(room_id)
+    if not room:
+        return jsonify({"error": "房间不存在"}), 404
+    if not RECORD_ID_RE.match(record_id):
+        return jsonify({"error": "记录编号格式不正确"}), 400
+    team = room.member_team.get(user["luogu_name"])
+    if team is None:
+        return jsonify({"error": "你不在该房间中"}), 403
+
+    future = claim_service.claim(room_id, team, user["luogu_name"], record_id)
+    try:
+        status, pid = future.result(timeout=app.config["CLAIM_TIMEOUT"])
+    except FutureTimeoutError:
+        return jsonify({"status": "pending", "message": "正在核验，结果会发到队伍聊天里"}), 202
+    message = CLAIM_MESSAGES[status].format(user=user["luogu_name"], record_id=record_id, pid=pid)
+    if status == "accepted":
+        return jsonify({"ok": True, "status": status, "pid": pid, "message": message})
+    code = {"rate_limited": 429, "busy": 429, "error": 502}.get(status, 400)
+    return jsonify({"error": message, "status": status, "pid": pid}), code
 
 @app.route("/api/propose_delete", methods=["POST"])
 def propose_delete():
@@ -480,32 +3531,26 @@ def propose_delete():
     pid = data.get("pid")
     proposer_team = data.get("team")
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
-    # Check if user is in the proposing team
-    if user["luogu_name"] not in room.teams.get(proposer_team, []):
-         return jsonify({"error": "你不在该队伍中"}), 403
+    with room.lock:
+        # Check if user is in the proposing team
+        if room.member_team.get(user["luogu_name"]) != proposer_team:
+             return jsonify({"error": "你不在该队伍中"}), 403
 
-    # Check if problem exists
-    if pid not in room.problems:
-        return jsonify({"error": "题目不存在"}), 400
+        # Check if problem exists
+        if pid not in room.problems:
+            return jsonify({"error": "题目不存在"}), 400
 
-    # Check if already proposed
-    for prop in room.deletion_proposals:
-        if prop["pid"] == pid and prop["status"] == "pending":
+        # Check if already proposed
+        if not room.add_proposal("delete", proposer_team, pid):
             return jsonify({"error": "删除申请已存在"}), 400
-
-    room.deletion_proposals.append({
-        "proposer": proposer_team,
-        "pid": pid,
-        "status": "pending",
-        "timestamp": time.strftime("%H:%M:%S")
-    })
-    # Emit deletion proposal notification to the room
-    socketio.emit("deletion_proposal", {"proposer": proposer_team, "pid": pid}, room=room_id)
-    return jsonify({"ok": True})
+        # Emit deletion proposal notification to the room
+        room.mark_active()
+        emit_room("deletion_proposal", {"proposer": proposer_team, "pid": pid}, room_id)
+        return jsonify({"ok": True})
 
 @app.route("/api/create", methods=["POST"])
 def create_room():
@@ -523,15 +3568,22 @@ def create_room():
     if team1_name == team2_name:
         return jsonify({"error": "队伍名不能相同"}), 400
 
+    # 批量校验题号，不存在的题目不进房间
+    invalid = invalid_pids(custom_problems)
+    if invalid:
+        return jsonify({"error": f"题目不存在或题号格式不正确: {', '.join(map(str, invalid))}"}), 400
+
     room_id = str(uuid.uuid4())[:8]
     # 创建房间时传入自定义队伍名
     room = Room(room_id, team1_name, team2_name)
-    room.problems = set(custom_problems)
+    room.record("create", problems=sorted(set(custom_problems)))
     # 创建者默认加入 team1_name 队伍
     room.add_member(team1_name, user["luogu_name"])
 
     rooms[room_id] = room
-    threading.Thread(target=judge_room, args=(room_id,), daemon=True).start()
+    cluster.register_room(room)
+    resolve_from_cache(room)
+    judge_scheduler.start()
     return jsonify({"room_id": room_id, "url": url_for("room_page", room_id=room_id, _external=True)})
 
 @app.route("/api/join", methods=["POST"])
@@ -548,13 +3600,15 @@ def join_room_api():
     if not room_id or not team:
         return jsonify({"error": "房间或队伍无效"}), 400
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
     # 用户加入指定队伍
     if room.add_member(team, user["luogu_name"]):
-        socketio.emit("update", room.get_status(), room=room_id)
+        room.mark_active()
+        broadcast_room(room)
+        resolve_from_cache(room)
         return jsonify({"ok": True})
     else:
         # 可能队伍不存在或用户已在房间
@@ -571,30 +3625,113 @@ def propose_problem():
     pid = data.get("pid")
     proposer_team = data.get("team")
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
-    if user["luogu_name"] not in room.teams.get(proposer_team, []):
-         return jsonify({"error": "你不在该队伍中"}), 403
+    if not isinstance(pid, str) or not PID_RE.match(pid):
+        return jsonify({"error": "题号格式不正确"}), 400
+    if problem_service.known_invalid(pid):
+        return jsonify({"error": "题目不存在"}), 400
+
+    with room.lock:
+        if room.member_team.get(user["luogu_name"]) != proposer_team:
+             return jsonify({"error": "你不在该队伍中"}), 403
 
-    room.proposals.append({
-        "proposer": proposer_team,
-        "pid": pid,
-        "status": "pending",
-        "timestamp": time.strftime("%H:%M:%S")
-    })
-    socketio.emit("proposal", {"proposer": proposer_team, "pid": pid}, room=room_id)
+        if not room.add_proposal("add", proposer_team, pid):
+            return jsonify({"error": "添加申请已存在"}), 400
+        room.mark_active()
+        emit_room("proposal", {"proposer": proposer_team, "pid": pid}, room_id)
+    # 在后台预取题目信息，对方同意时就不用等；题目不存在时自动取消申请
+    problem_service.prefetch(pid, lambda pid, meta: reject_invalid_proposal(room_id, pid, meta))
     return jsonify({"ok": True})
 
 
 
+@app.route("/api/problems")
+def problem_info():
+    """批量查询题目标题和难度：?pids=P1000,P1001（最多 50 个）。"""
+    if not get_current_user():
+        return jsonify({"error": "请先注册"}), 401
+    pids = [pid for pid in request.args.get("pids", "").split(",") if PID_RE.match(pid)][:50]
+    metas = problem_service.lookup_many(pids)
+    return jsonify({"problems": {pid: meta for pid, meta in metas.items() if meta is not None}})
+
+@app.route("/api/problem_stats")
+def problem_stats():
+    return jsonify(problem_service.stats())
+
+@app.route("/api/pool_stats")
+def pool_stats():
+    # 用于调整 BROWSER_POOL_SIZE：抓取耗时、排队耗时和浏览器进程数
+    return jsonify(browser_pool.stats())
+
+@app.route("/api/lifecycle_stats")
+def lifecycle_stats():
+    return jsonify(lifecycle.stats())
+
+@app.route("/api/store_stats")
+def store_stats():
+    return jsonify(store.stats())
+
+@app.route("/api/cluster_stats")
+def cluster_stats():
+    return jsonify(cluster.stats())
+
+@app.route("/api/judge_stats")
+def judge_stats():
+    # 每个 pid 距离上次抓取的秒数，以及调度器的累计轮数/抓取数
+    return jsonify(judge_scheduler.stats())
+
+@metrics.collector
+def collect_runtime_metrics():
+    """抓取 /metrics 时现算的仪表盘：队列深度、浏览器池占用、每个房间的判题延迟等。"""
+    now = time.time()
+    pool = browser_pool.stats()
+    room_states = list(judge_scheduler.room_state.items())
+    cache = ac_cache.stats()
+    return [
+        ("judge_keys", "gauge", "Scan keys wanted by due rooms in the last tick.", {(): judge_scheduler.wanted}),
+        ("judge_in_flight", "gauge", "Fetches currently running or queued in the judge scheduler.", {(): len(judge_scheduler.in_flight)}),
+        ("judge_backoff_keys", "gauge", "Scan keys waiting out an error backoff.", {(): len(judge_scheduler.backoff)}),
+        ("judge_paused_seconds", "gauge", "Remaining global pause after upstream rate limiting.",
+         {(): round(max(0, judge_scheduler.paused_until - now), 3)}),
+        ("judge_lag_seconds", "gauge", "Seconds since a room's AC data was last fully refreshed.",
+         {(("room", room_id),): round(now - state["fresh_at"], 3) for room_id, state in room_states}),
+        ("judge_last_cycle_seconds", "gauge", "Duration of a room's last completed judge cycle.",
+         {(("room", room_id),): round(state["last_cycle"], 3) for room_id, state in room_states if state["last_cycle"] is not None}),
+        ("browser_pool_size", "gauge", "Configured number of Playwright workers.", {(): pool["size"]}),
+        ("browser_pool_browsers", "gauge", "Live Chromium processes.", {(): pool["browsers"]}),
+        ("browser_pool_busy", "gauge", "Playwright workers currently running a job.", {(): pool["busy"]}),
+        ("browser_pool_queued", "gauge", "Playwright jobs waiting for a worker.", {(): pool["queued"]}),
+        ("browser_pool_recycles_total", "counter", "Browser contexts recycled after errors or max uses.", {(): pool["recycles"]}),
+        ("ac_cache_hits_total", "counter", "(pid, user) lookups answered by the AC cache.", {(): cache["hits"]}),
+        ("ac_cache_misses_total", "counter", "(pid, user) lookups that needed an upstream fetch.", {(): cache["misses"]}),
+        ("rooms_in_memory", "gauge", "Rooms held in this worker's memory.", {(): len(rooms)}),
+        ("sockets", "gauge", "SocketIO connections attached to rooms on this worker.", {(): len(lifecycle.sockets)}),
+        ("spectators", "gauge", "Spectator connections on this worker.", {(): len(spectator_hub.viewers)}),
+        ("spectator_pushes_total", "counter", "Coalesced state pushes to spectator channels.", {(): spectator_hub.pushes}),
+    ]
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # ----------------------------
 # Static File Serving for Avatars
 # ----------------------------
 @app.route('/static/avatars/<filename>')
 def uploaded_avatar(filename):
-    return send_from_directory(app.config['AVATAR_FOLDER'], filename)
+    if not AVATAR_NAME_RE.match(filename):
+        # 旧版本按用户 ID 保存的原图
+        return send_from_directory(app.config['AVATAR_FOLDER'], filename)
+    # 按内容哈希命名的缩略图永远不会变，哈希本身就是 ETag
+    resp = send_from_directory(
+        app.config['AVATAR_FOLDER'], filename, max_age=app.config["AVATAR_CACHE_MAX_AGE"], etag=filename[:-len(".webp")]
+    )
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
 
 @app.route("/api/reject_proposal", methods=["POST"])
 def reject_proposal():
@@ -606,32 +3743,30 @@ def reject_proposal():
     room_id = data.get("room_id")
     pid = data.get("pid")
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
-    proposal_to_reject = None
-    for prop in room.proposals:
-        if prop["pid"] == pid and prop["status"] == "pending":
-            proposal_to_reject = prop
-            break
+    with room.lock:
+        proposal_to_reject = room.pending.get(("add", pid))
 
-    if not proposal_to_reject:
-        return jsonify({"error": "提案未找到或非待处理状态"}), 404
+        if not proposal_to_reject:
+            return jsonify({"error": "提案未找到或非待处理状态"}), 404
 
-    proposer_team = proposal_to_reject["proposer"]
-    teams_list = list(room.teams.keys())
-    if proposer_team not in teams_list:
-        return jsonify({"error": "内部错误：提案队伍无效"}), 500
-    rejecter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
+        proposer_team = proposal_to_reject["proposer"]
+        teams_list = list(room.teams.keys())
+        if proposer_team not in teams_list:
+            return jsonify({"error": "内部错误：提案队伍无效"}), 500
+        rejecter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
 
-    if user["luogu_name"] not in room.teams.get(rejecter_team, []):
-        return jsonify({"error": "你不在有权限拒绝的队伍中"}), 403
+        if room.member_team.get(user["luogu_name"]) != rejecter_team:
+            return jsonify({"error": "你不在有权限拒绝的队伍中"}), 403
 
-    proposal_to_reject["status"] = "rejected"
+        room.resolve_proposal("add", pid, "rejected")
 
-    socketio.emit("update", room.get_status(), room=room_id)
-    return jsonify({"ok": True})
+        room.mark_active()
+        broadcast_room(room)
+        return jsonify({"ok": True})
 
 @app.route("/api/reject_delete", methods=["POST"])
 def reject_delete():
@@ -643,36 +3778,67 @@ def reject_delete():
     room_id = data.get("room_id")
     pid = data.get("pid")
 
-    if room_id not in rooms:
+    room = get_room(room_id)
+    if not room:
         return jsonify({"error": "房间不存在"}), 404
 
-    room = rooms[room_id]
-    proposal_to_reject = None
-    for prop in room.deletion_proposals:
-        if prop["pid"] == pid and prop["status"] == "pending":
-            proposal_to_reject = prop
-            break
+    with room.lock:
+        proposal_to_reject = room.pending.get(("delete", pid))
 
-    if not proposal_to_reject:
-        return jsonify({"error": "删除提案未找到或非待处理状态"}), 404
+        if not proposal_to_reject:
+            return jsonify({"error": "删除提案未找到或非待处理状态"}), 404
 
-    proposer_team = proposal_to_reject["proposer"]
-    teams_list = list(room.teams.keys())
-    if proposer_team not in teams_list:
-        return jsonify({"error": "内部错误：提案队伍无效"}), 500
-    rejecter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
+        proposer_team = proposal_to_reject["proposer"]
+        teams_list = list(room.teams.keys())
+        if proposer_team not in teams_list:
+            return jsonify({"error": "内部错误：提案队伍无效"}), 500
+        rejecter_team = teams_list[1] if teams_list[0] == proposer_team else teams_list[0]
 
-    if user["luogu_name"] not in room.teams.get(rejecter_team, []):
-        return jsonify({"error": "你不在有权限拒绝的队伍中"}), 403
+        if room.member_team.get(user["luogu_name"]) != rejecter_team:
+            return jsonify({"error": "你不在有权限拒绝的队伍中"}), 403
 
-    proposal_to_reject["status"] = "rejected"
+        room.resolve_proposal("delete", pid, "rejected")
 
-    socketio.emit("update", room.get_status(), room=room_id)
-    return jsonify({"ok": True})
+        room.mark_active()
+        broadcast_room(room)
+        return jsonify({"ok": True})
 
 
+restore_state()
+
 # ----------------------------
 # Main
 # ----------------------------
+def replay_cli(argv):
+    """python app.py replay <room_id> [--seq N]     打印房间在第 N 条事件之后的状态（默认最新）
+    python app.py events <room_id> [--after N]    逐行打印事件日志"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="app.py", description="重放房间事件日志")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay = commands.add_parser("replay")
+    replay.add_argument("room_id")
+    replay.add_argument("--seq", type=int, default=None)
+    events = commands.add_parser("events")
+    events.add_argument("room_id")
+    events.add_argument("--after", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == "events":
+        for event in store.load_events(args.room_id, after=args.after):
+            print(json.dumps(event, ensure_ascii=False))
+        return 0
+    try:
+        room = event_log.rebuild(args.room_id, args.seq)
+    except EventLogError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if room is None:
+        print(f"room {args.room_id} has no event log", file=sys.stderr)
+        return 1
+    print(json.dumps(room.get_status(), ensure_ascii=False, indent=2))
+    return 0
+
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5000, debug=True)
+    if sys.argv[1:2] in (["replay"], ["events"]):
+        sys.exit(replay_cli(sys.argv[1:]))
+    socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True)
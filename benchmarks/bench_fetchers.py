@@ -0,0 +1,59 @@
+"""离线对比各个记录抓取后端的吞吐：两个后端都对着本地桩服务器抓同一份录制页面。
+
+    python benchmarks/bench_fetchers.py --fetches 200 --concurrency 8
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_luogu import StubLuogu, load_fixture  # noqa: E402
+
+
+def expected_ac_users():
+    result = load_fixture("record_list.json")["currentData"]["records"]["result"]
+    return {r["user"]["name"] for r in result if r["status"] == 12}
+
+
+def bench(fetcher, fetches, concurrency):
+    expected = expected_ac_users()
+
+    def one(i):
+        records = fetcher.fetch_records(f"P{1000 + i % 50}")
+        got = {r["user"] for r in records if r["accepted"]}
+        if got != expected:
+            raise AssertionError(f"{fetcher.name}: got {sorted(got)}, expected {sorted(expected)}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(fetches)))
+    elapsed = time.perf_counter() - start
+    return elapsed, fetches / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fetches", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--backends", default="http,playwright")
+    args = parser.parse_args()
+
+    stub = StubLuogu()
+    server, base_url = stub.serve()
+    os.environ["LUOGU_BASE_URL"] = base_url
+    os.environ.setdefault("BROWSER_POOL_SIZE", str(args.concurrency))
+    import app  # 在设置好 LUOGU_BASE_URL 之后再导入
+
+    for name in args.backends.split(","):
+        fetcher = app.record_fetchers[name]
+        before = stub.requests
+        elapsed, rate = bench(fetcher, args.fetches, args.concurrency)
+        print(f"{name:>10}: {args.fetches} fetches in {elapsed:.2f}s -> {rate:.1f} fetches/s "
+              f"({stub.requests - before} upstream requests)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
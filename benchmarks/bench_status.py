@@ -0,0 +1,66 @@
+"""Room.get_status() 微基准：对比缓存命中（没有修改）和每次都失效（每次 touch）的开销。
+
+    python benchmarks/bench_status.py --problems 12 --proposals 200
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import Room  # noqa: E402
+
+
+def make_room(problems, proposals):
+    room = Room("bench", "Red", "Blue")
+    room.problems = {f"P{1000 + i}" for i in range(problems)}
+    for i in range(4):
+        room.add_member("Red" if i % 2 == 0 else "Blue", f"user{i}")
+    for i in range(proposals):
+        room.add_proposal("add", "Red", f"P{2000 + i}")
+        room.resolve_proposal("add", f"P{2000 + i}", "rejected")
+    room.touch()
+    return room
+
+
+def measure(label, fn, calls):
+    fn()  # 预热
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    elapsed = time.perf_counter() - start
+    # tracemalloc 本身很慢，单独跑一小轮看内存
+    tracemalloc.start()
+    for _ in range(min(calls, 100)):
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:>24}: {elapsed / calls * 1e6:8.2f} us/call, peak traced memory {peak / 1024:8.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--problems", type=int, default=12)
+    parser.add_argument("--proposals", type=int, default=200)
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    room = make_room(args.problems, args.proposals)
+
+    def uncached_status():
+        room.touch()
+        return room.get_status()
+
+    def uncached_json():
+        room.touch()
+        return room.status_json()
+
+    measure("get_status (cached)", room.get_status, args.calls)
+    measure("get_status (rebuilt)", uncached_status, args.calls)
+    measure("status_json (cached)", room.status_json, args.calls)
+    measure("status_json (rebuilt)", uncached_json, args.calls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""房间事件的线上格式对比：今天的 JSON（python-socketio 的默认编码）、直接 msgpack，以及
+WireCodec 的二进制帧（字符串表 + 超过阈值时压缩）。对每种事件报告字节数和每次编码的耗时。
+
+    pip install msgpack
+    python benchmarks/bench_wire.py --problems 12 --members 8 --history 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def make_room(problems, members, history):
+    room = app.Room("bench", "红队", "Blue Team")
+    pids = [f"P{1000 + i}" for i in range(problems)]
+    room.record("create", problems=pids)
+    for i in range(members):
+        room.add_member("红队" if i % 2 == 0 else "Blue Team", f"luogu_user_{i}")
+    for i in range(history):
+        team = "红队" if i % 2 == 0 else "Blue Team"
+        room.add_proposal("add", team, f"P{2000 + i}")
+        room.resolve_proposal("add", f"P{2000 + i}", "rejected")
+    return room
+
+
+def events(room):
+    """按真实顺序产生各类事件：进房间时的快照、加题申请、申请被处理的 patch、AC 的 patch、结束。"""
+    snapshot_status = room.get_status()
+    yield "snapshot", {"room_id": room.room_id, "rev": 1, "state": snapshot_status}
+
+    room.add_proposal("add", "红队", "P3000")
+    yield "proposal_request", {"proposer": "红队", "pid": "P3000", "timestamp": room.pending[("add", "P3000")]["timestamp"]}
+    before = room.get_status()
+    room.resolve_proposal("add", "P3000", "accepted")
+    room.record("add_problem", pid="P3000")
+    changed, items = app.diff_status(before, room.get_status())
+    yield "patch (proposal)", {"room_id": room.room_id, "base": 1, "rev": 2, "set": changed, "items": items}
+
+    before = room.get_status()
+    room.record("solve", pid="P1000", user="luogu_user_0", team="红队", points=100)
+    changed, items = app.diff_status(before, room.get_status())
+    yield "patch (solve)", {"room_id": room.room_id, "base": 2, "rev": 3, "set": changed, "items": items}
+
+    room.record("finish", winner="红队")
+    yield "game_over", room.get_status()
+
+
+def per_call(fn, calls):
+    fn()  # 预热
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--problems", type=int, default=12)
+    parser.add_argument("--members", type=int, default=8)
+    parser.add_argument("--history", type=int, default=50)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--threshold", type=int, default=app.app.config["WIRE_COMPRESS_THRESHOLD"])
+    args = parser.parse_args()
+
+    codec = app.WireCodec(args.threshold)
+    if not codec.available:
+        sys.exit("msgpack is not installed")
+    room = make_room(args.problems, args.members, args.history)
+
+    print(f"{'event':>18} {'json B':>8} {'msgpack B':>10} {'wire B':>8} {'ratio':>6}   {'json us':>8} {'wire us':>8}")
+    totals = [0, 0, 0]
+    for name, payload in events(room):
+        # python-socketio 发 JSON 时用的就是这个编码（ensure_ascii 保持默认）
+        as_json = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        as_msgpack = codec.msgpack.packb(payload)
+        frame = codec.encode(payload)
+        assert codec.decode(frame) == json.loads(as_json), name
+        json_us = per_call(lambda: json.dumps(payload, separators=(",", ":")), args.calls)
+        wire_us = per_call(lambda: codec.encode(payload), args.calls)
+        totals[0] += len(as_json)
+        totals[1] += len(as_msgpack)
+        totals[2] += len(frame)
+        print(f"{name:>18} {len(as_json):>8} {len(as_msgpack):>10} {len(frame):>8} {len(frame) / len(as_json):>6.2f}"
+              f"   {json_us:>8.1f} {wire_us:>8.1f}")
+    print(f"{'total':>18} {totals[0]:>8} {totals[1]:>10} {totals[2]:>8} {totals[2] / totals[0]:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
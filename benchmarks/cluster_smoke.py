@@ -0,0 +1,167 @@
+"""多 worker 部署的本地冒烟测试：起一个 Redis 兼容的代理（默认用 fakeredis 的 TCP 服务器，
+也可以用 --redis-url 指向真的 Redis）、本地洛谷桩服务器和 N 个 app worker，然后检查：
+
+- 在一个 worker 上创建的房间，能在另一个 worker 上加入、查询；
+- 判题结果经消息队列推送给连在其他 worker 上的客户端；
+- 每个房间只有一个 worker 在判题；加上 --failover 时杀掉它，租约过期后由别的 worker 接手。
+
+    pip install "fakeredis[lua]" redis
+    python benchmarks/cluster_smoke.py --workers 2 --failover
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_luogu import StubLuogu  # noqa: E402
+
+WORKER_CMD = "import app; app.socketio.run(app.app, host='127.0.0.1', port={port}, allow_unsafe_werkzeug=True)"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+    port = free_port()
+    server = TcpFakeServer(("127.0.0.1", port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"redis://127.0.0.1:{port}/0"
+
+
+def start_worker(index, redis_url, luogu_url, workdir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        SHARED_STATE_URL=redis_url,
+        SOCKETIO_MESSAGE_QUEUE=redis_url,
+        WORKER_ID=f"worker{index}",
+        LUOGU_BASE_URL=luogu_url,
+        JUDGE_MIN_INTERVAL="1",
+        DATABASE=os.path.join(workdir, f"worker{index}.db"),
+    )
+    proc = subprocess.Popen([sys.executable, "-c", WORKER_CMD.format(port=port)], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(url + "/api/cluster_stats", timeout=1)
+            return proc, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"worker{index} did not start")
+
+
+def login(url, name):
+    http = requests.Session()
+    http.post(url + "/register", data={"luogu_name": name})
+    return http
+
+
+def connect(url, http, room_id, team, received):
+    client = socketio.Client()
+    client.on("patch", lambda data: received.append(data))
+    client.connect(url, headers={"Cookie": "; ".join(f"{k}={v}" for k, v in http.cookies.items())})
+    client.emit("join_room", {"room_id": room_id, "team": team})
+    return client
+
+
+def judge_owners(urls, room_id):
+    owners = []
+    for url in urls:
+        try:
+            stats = requests.get(url + "/api/cluster_stats", timeout=2).json()
+        except requests.RequestException:
+            continue
+        if room_id in stats["judged_rooms"]:
+            owners.append(stats["worker_id"])
+    return owners
+
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--failover", action="store_true")
+    args = parser.parse_args()
+
+    redis_url = args.redis_url or start_fake_redis()
+    _, luogu_url = StubLuogu().serve()
+    workdir = tempfile.mkdtemp(prefix="luogu-duels-cluster-")
+    workers = [start_worker(i, redis_url, luogu_url, workdir) for i in range(args.workers)]
+    urls = [url for _, url in workers]
+    failures = []
+
+    def check(ok, label):
+        print(f"[{'OK' if ok else 'FAIL'}] {label}")
+        if not ok:
+            failures.append(label)
+
+    try:
+        # 录制的记录里 kkksc03 AC 了题目，someone 没有
+        red = login(urls[0], "kkksc03")
+        blue = login(urls[-1], "someone")
+        room_id = red.post(urls[0] + "/api/create", json={
+            "problems": ["P1000", "P1001", "P1002"], "team1_name": "A", "team2_name": "B",
+        }).json()["room_id"]
+        check(blue.post(urls[-1] + "/api/join", json={"room_id": room_id, "team": "B"}).json().get("ok"),
+              f"join room {room_id} on another worker")
+        status = blue.get(f"{urls[-1]}/api/room/{room_id}/status").json()
+        check(sorted(status["teams"]["A"] + status["teams"]["B"]) == ["kkksc03", "someone"],
+              "room status is shared between workers")
+
+        red_patches, blue_patches = [], []
+        clients = [connect(urls[0], red, room_id, "A", red_patches), connect(urls[-1], blue, room_id, "B", blue_patches)]
+
+        def solved():
+            return any("P1000" in patch["set"].get("solved", ()) for patch in blue_patches)
+
+        check(wait_for(solved, 30), "judge result fans out to a client on another worker")
+        owners = judge_owners(urls, room_id)
+        check(len(owners) == 1, f"exactly one judge owner: {owners}")
+
+        if args.failover and owners:
+            index = int(owners[0][len("worker"):])
+            workers[index][0].kill()
+            survivors = [url for i, url in enumerate(urls) if i != index]
+            new_owners = []
+
+            def taken_over():
+                new_owners[:] = judge_owners(survivors, room_id)
+                return len(new_owners) == 1
+
+            check(wait_for(taken_over, 30), f"judge lease taken over after killing {owners[0]}: {new_owners}")
+
+        for client in clients:
+            client.disconnect()
+    finally:
+        for proc, _ in workers:
+            proc.kill()
+
+    print("OK" if not failures else f"{len(failures)} check(s) failed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""对战服务器容量测试，完全离线：起一个实时产生提交的洛谷桩（ScriptedLuogu）和一个 app.py 进程，
+模拟 N 个房间 × 每间 M 个 SocketIO 客户端加入、聊天、申请和同意加题，然后报告：
+
+- 更新延迟 p50/p99：从 AC 记录出现在桩服务器上，到房间里每个客户端收到带这道题的 patch；
+- 服务器 CPU 占用和 RSS（读 /proc，仅 Linux）；
+- 抓取器对洛谷的请求速率，以及服务器 /metrics 里的推送次数和错误数。
+
+AC 的分配保证两队都拿不到一半以上的分数，房间不会中途结束，每个 AC 都应该送达所有客户端；
+有没送达的、或者超过 --max-p99 / --max-rss-mb 时以非零状态退出，可以放进 CI 抓性能回退。
+
+    python benchmarks/loadtest.py --rooms 10 --clients 4 --seconds 60
+    python benchmarks/loadtest.py --rooms 50 --clients 2 --server-env JUDGE_MAX_FETCHES_PER_SEC=20 --json out.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_luogu import ScriptedLuogu  # noqa: E402
+
+SERVER_CMD = "import app; app.socketio.run(app.app, host='127.0.0.1', port={port}, allow_unsafe_werkzeug=True)"
+TEAMS = ("A", "B")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(luogu_url, workdir, overrides, verbose):
+    port = free_port()
+    env = dict(
+        os.environ,
+        LUOGU_BASE_URL=luogu_url,
+        DATABASE=os.path.join(workdir, "loadtest.db"),
+        LOG_LEVEL="INFO" if verbose else "WARNING",
+    )
+    env.update(overrides)
+    output = None if verbose else subprocess.DEVNULL
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CMD.format(port=port)], cwd=ROOT, env=env,
+                            stdout=output, stderr=output)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            requests.get(url + "/metrics", timeout=1)
+            return proc, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+class ProcSampler:
+    """每秒读一次 /proc/<pid>，记录 CPU 时间和 RSS。不是 Linux 时什么都不记。"""
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.samples = []  # (墙钟时间, CPU 秒, RSS 字节)
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{self.pid}/status") as f:
+                rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            return
+        # 去掉 "pid (comm)" 之后，utime/stime 是第 12、13 个字段
+        self.samples.append((time.time(), (int(fields[11]) + int(fields[12])) / self.tick, rss))
+
+    def run(self, stop):
+        while not stop.wait(1):
+            self.sample()
+
+    def summary(self):
+        if len(self.samples) < 2:
+            return {"cpu_percent": None, "rss_mb_peak": None, "rss_mb_end": None}
+        (t0, cpu0, _), (t1, cpu1, rss_end) = self.samples[0], self.samples[-1]
+        return {
+            "cpu_percent": round((cpu1 - cpu0) / (t1 - t0) * 100, 1),
+            "rss_mb_peak": round(max(rss for _, _, rss in self.samples) / 2 ** 20, 1),
+            "rss_mb_end": round(rss_end / 2 ** 20, 1),
+        }
+
+
+class Client:
+    """一个登录过的用户：HTTP 会话 + SocketIO 连接，记下每道题第一次出现在 solved 里的时间。"""
+    def __init__(self, url, name):
+        self.url = url
+        self.name = name
+        self.http = requests.Session()
+        self.http.post(url + "/register", data={"luogu_name": name})
+        self.sio = socketio.Client(reconnection=False)
+        self.solved_at = {}  # pid -> 收到的时间
+        self.patches = 0
+        self.messages = 0
+        self.sio.on("patch", self.on_patch)
+        self.sio.on("messages", self.on_messages)
+
+    def on_patch(self, patch):
+        now = time.time()
+        self.patches += 1
+        for pid in patch["set"].get("solved", ()):
+            self.solved_at.setdefault(pid, now)
+
+    def on_messages(self, batch):
+        self.messages += len(batch["messages"])
+
+    def post(self, path, payload):
+        return self.http.post(self.url + path, json=payload).json()
+
+    def connect(self, room_id, team):
+        self.sio.connect(self.url, headers={"Cookie": "; ".join(f"{k}={v}" for k, v in self.http.cookies.items())})
+        self.sio.emit("join_room", {"room_id": room_id, "team": team})
+
+    def chat(self, room_id, team, text):
+        self.sio.emit("chat", {"room_id": room_id, "team": team, "user": self.name, "text": text})
+
+
+class SimRoom:
+    def __init__(self, index, url, clients, problems, rng):
+        self.index = index
+        self.rng = rng
+        self.problems = [f"P{10000 + index * problems + j}" for j in range(problems)]
+        self.members = [(Client(url, f"lt{index}u{c}"), TEAMS[c % 2]) for c in range(clients)]
+        creator = self.members[0][0]
+        created = creator.post("/api/create", {"problems": self.problems, "team1_name": TEAMS[0], "team2_name": TEAMS[1]})
+        if "room_id" not in created:
+            raise RuntimeError(f"room {index}: {created}")
+        self.room_id = created["room_id"]
+        for client, team in self.members[1:]:
+            client.post("/api/join", {"room_id": self.room_id, "team": team})
+        for client, team in self.members:
+            client.connect(self.room_id, team)
+        self.proposals = 0
+
+    def ac_pairs(self):
+        """每道题让某一队的一个成员 AC；两队交替分配，题数为奇数时最后一道没人 AC，所以谁都过不了半数。"""
+        pairs = []
+        for j, pid in enumerate(self.problems[:len(self.problems) // 2 * 2]):
+            team = TEAMS[j % 2]
+            candidates = [client.name for client, t in self.members if t == team]
+            if candidates:
+                pairs.append((pid, self.rng.choice(candidates)))
+        return pairs
+
+    def act(self, chat_interval, propose_interval, stop):
+        """模拟房间里的人：随机聊天，隔一阵子 A 队申请加一道题、B 队同意。"""
+        next_propose = time.time() + self.rng.expovariate(1 / propose_interval) if propose_interval else None
+        while not stop.wait(self.rng.expovariate(1 / chat_interval)):
+            client, team = self.rng.choice(self.members)
+            client.chat(self.room_id, team, f"hello from {client.name}")
+            if next_propose and time.time() >= next_propose:
+                self.propose()
+                next_propose = time.time() + self.rng.expovariate(1 / propose_interval)
+
+    def propose(self):
+        proposer = next((c for c, t in self.members if t == TEAMS[0]), None)
+        acceptor = next((c for c, t in self.members if t == TEAMS[1]), None)
+        if not proposer or not acceptor:
+            return
+        # 不会有人 AC 的新题，只是让房间状态和广播动起来
+        pid = f"P{500000 + self.index * 1000 + self.proposals}"
+        self.proposals += 1
+        proposer.post("/api/propose", {"room_id": self.room_id, "pid": pid, "team": TEAMS[0]})
+        acceptor.post("/api/accept_proposal", {"room_id": self.room_id, "pid": pid})
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def scrape_metrics(url):
+    """把 /metrics 里同名指标各个标签的样本加起来。"""
+    totals = {}
+    try:
+        text = requests.get(url + "/metrics", timeout=5).text
+    except requests.RequestException:
+        return totals
+    for line in text.splitlines():
+        if line.startswith("#") or not line.strip():
+            continue
+        series, value = line.rsplit(" ", 1)
+        name = series.split("{", 1)[0]
+        totals[name] = totals.get(name, 0) + float(value)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=4, help="每个房间的客户端数，轮流分到两队")
+    parser.add_argument("--problems", type=int, default=10)
+    parser.add_argument("--seconds", type=float, default=30, help="产生提交的时长")
+    parser.add_argument("--drain", type=float, default=60, help="停止产生提交后最多再等多久让更新送达")
+    parser.add_argument("--ac-rate", type=float, default=1, help="全站 AC 到达速率（次/秒）")
+    parser.add_argument("--wa-rate", type=float, default=2, help="全站不通过提交的速率（次/秒）")
+    parser.add_argument("--latency", type=float, default=0.05, help="桩服务器每个请求的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--judge-delay", type=float, default=0, help="新提交保持“评测中”的秒数")
+    parser.add_argument("--chat-interval", type=float, default=5, help="每个房间平均多久发一条聊天（秒）")
+    parser.add_argument("--propose-interval", type=float, default=20, help="每个房间平均多久申请加一次题（秒），0 表示不申请")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE", help="覆盖服务器的配置")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max-p99", type=float, default=None, help="p99 更新延迟超过这么多秒时失败")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="服务器 RSS 峰值超过这么多 MB 时失败")
+    parser.add_argument("--json", default=None, help="把结果写到这个 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="显示服务器日志")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    luogu = ScriptedLuogu(args.ac_rate, args.wa_rate, args.latency, args.jitter, seed=args.seed, judge_delay=args.judge_delay)
+    luogu_server, luogu_url = luogu.serve()
+    workdir = tempfile.mkdtemp(prefix="luogu-duels-loadtest-")
+    overrides = dict(item.split("=", 1) for item in args.server_env)
+    proc, url = start_server(luogu_url, workdir, overrides, args.verbose)
+    stop = threading.Event()
+    sampler = ProcSampler(proc.pid)
+    sim_rooms = []
+    try:
+        setup_started = time.time()
+        sim_rooms = [SimRoom(i, url, args.clients, args.problems, rng) for i in range(args.rooms)]
+        print(f"[INFO] {args.rooms} rooms x {args.clients} clients ready in {time.time() - setup_started:.1f}s")
+        for room in sim_rooms:
+            luogu.expect(room.ac_pairs())
+
+        threads = [threading.Thread(target=luogu.run, args=(stop,), daemon=True),
+                   threading.Thread(target=sampler.run, args=(stop,), daemon=True)]
+        threads += [threading.Thread(target=room.act, args=(args.chat_interval, args.propose_interval, stop), daemon=True)
+                    for room in sim_rooms]
+        sampler.sample()
+        requests_before = dict(luogu.counts)
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        stop.wait(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        # 等已经出现的 AC 送达所有客户端
+        expected = {pid: landed for (pid, _), landed in luogu.landed.items()}
+        room_of = {pid: room for room in sim_rooms for pid in room.problems}
+        deadline = time.time() + args.drain
+        while time.time() < deadline:
+            if all(pid in client.solved_at for pid in expected for client, _ in room_of[pid].members):
+                break
+            sampler.sample()
+            time.sleep(0.5)
+        sampler.sample()
+        elapsed = time.time() - started
+        server_metrics = scrape_metrics(url)
+        requests_after = dict(luogu.counts)
+    finally:
+        stop.set()
+        for room in sim_rooms:
+            for client, _ in room.members:
+                try:
+                    client.sio.disconnect()
+                except Exception:
+                    pass
+        proc.kill()
+        luogu_server.shutdown()
+
+    latencies, missed = [], 0
+    for pid, landed in expected.items():
+        for client, _ in room_of[pid].members:
+            if pid in client.solved_at:
+                latencies.append(client.solved_at[pid] - landed)
+            else:
+                missed += 1
+    scraped = requests_after["record_list"] - requests_before["record_list"]
+    result = {
+        "rooms": args.rooms,
+        "clients": args.rooms * args.clients,
+        "acs": len(expected),
+        "updates": len(latencies),
+        "missed": missed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies, default=None),
+        "scraper_rps": round(scraped / elapsed, 2),
+        "problem_requests": requests_after["problem"] - requests_before["problem"],
+        "socketio_emits": int(server_metrics.get("luogu_duels_socketio_emits_total", 0)),
+        "socketio_bytes": int(server_metrics.get("luogu_duels_socketio_payload_bytes_total", 0)),
+        "server_errors": int(server_metrics.get("luogu_duels_errors_total", 0)),
+        "chat_messages_received": sum(client.messages for room in sim_rooms for client, _ in room.members),
+        "elapsed": round(elapsed, 1),
+    }
+    result.update(sampler.summary())
+
+    def fmt(value):
+        return "n/a" if value is None else f"{value:.3f}s"
+
+    print(f"ACs landed: {result['acs']}, updates received: {result['updates']}, missed: {missed}")
+    print(f"update latency: p50 {fmt(result['latency_p50'])}, p99 {fmt(result['latency_p99'])}, max {fmt(result['latency_max'])}")
+    print(f"scraper: {result['scraper_rps']} record/list req/s, {result['problem_requests']} problem page requests")
+    print(f"server: cpu {result['cpu_percent']}%, rss peak {result['rss_mb_peak']} MB, end {result['rss_mb_end']} MB, "
+          f"{result['socketio_emits']} emits ({result['socketio_bytes']} bytes), {result['server_errors']} errors")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+    failures = []
+    if missed:
+        failures.append(f"{missed} updates not delivered within {args.drain}s")
+    if args.max_p99 is not None and result["latency_p99"] is not None and result["latency_p99"] > args.max_p99:
+        failures.append(f"p99 latency {result['latency_p99']:.3f}s > {args.max_p99}s")
+    if args.max_rss_mb is not None and result["rss_mb_peak"] is not None and result["rss_mb_peak"] > args.max_rss_mb:
+        failures.append(f"peak RSS {result['rss_mb_peak']} MB > {args.max_rss_mb} MB")
+    for failure in failures:
+        print(f"[FAIL] {failure}")
+    print("OK" if not failures else f"{len(failures)} check(s) failed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""增量扫描的冒烟测试：对着会产生“评测中”记录的洛谷桩，检查高水位不会越过还没评测完的提交。
+
+先评测中、后变成 AC 的提交，在下一轮扫描里必须被发现；按题目和按用户两种扫描键都检查，
+也检查先交的提交比后交的评测得慢的情况。
+
+    python benchmarks/scanner_smoke.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_luogu import ScriptedLuogu  # noqa: E402
+
+
+def check(label, ok):
+    print(f"{'ok' if ok else 'FAIL':>4}  {label}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--judge-delay", type=float, default=1, help="新提交保持“评测中”的秒数")
+    args = parser.parse_args()
+
+    luogu = ScriptedLuogu(0, judge_delay=args.judge_delay)
+    server, base_url = luogu.serve()
+    workdir = tempfile.mkdtemp(prefix="scanner_smoke_")
+    os.environ["LUOGU_BASE_URL"] = base_url
+    os.environ["DATABASE"] = os.path.join(workdir, "scanner_smoke.db")
+    # 每次请求都要等限速令牌，默认速率下一轮扫描就可能比评测延迟还长
+    os.environ["JUDGE_MAX_FETCHES_PER_SEC"] = "100"
+    import app  # 在设置好 LUOGU_BASE_URL 和 DATABASE 之后再导入
+    # 两种扫描键各用一个扫描器，免得一边扫到的 AC 顺手补进另一边的索引
+    by_pid = app.RecordScanner(app.app.config["RECORD_MAX_PAGES"])
+    by_user = app.RecordScanner(app.app.config["RECORD_MAX_PAGES"])
+
+    ok = True
+    # 先有一条已评测完的旧记录，让两个扫描键都建立高水位
+    luogu.judge_delay, delay = 0, luogu.judge_delay
+    luogu.submit("P1001", "alice", False)
+    luogu.submit("P1002", "bob", False)
+    luogu.judge_delay = delay
+    ok &= check("初次扫描没有 AC", by_pid.scan_pid("P1001") == set() and by_user.scan_user("bob") == set())
+
+    # bob 的 AC 先以评测中出现，后面再跟一条更新的记录
+    luogu.submit("P1001", "bob", True)
+    luogu.submit("P1001", "alice", False)
+    ok &= check("评测中的提交不算 AC", "bob" not in by_pid.scan_pid("P1001")
+                and "P1001" not in by_user.scan_user("bob"))
+
+    time.sleep(args.judge_delay + 0.2)
+    ok &= check("评测完成后按题目扫描能发现 AC", "bob" in by_pid.scan_pid("P1001"))
+    ok &= check("评测完成后按用户扫描能发现 AC", "P1001" in by_user.scan_user("bob"))
+    ok &= check("评测全部完成后高水位追上最新记录",
+                by_pid.high_water[("pid", "P1001")] == luogu.next_id)
+
+    # 先交的 AC 评测得慢，后交的 AC 先出结果：后者不能把前者挡在高水位后面
+    luogu.judge_delay = delay * 2
+    luogu.submit("P1003", "bob", True)
+    luogu.judge_delay = 0
+    luogu.submit("P1004", "bob", True)
+    luogu.judge_delay = delay
+    found = by_user.scan_user("bob")
+    ok &= check("后交先评完的 AC 先被发现", "P1004" in found and "P1003" not in found)
+    time.sleep(delay * 2 + 0.2)
+    ok &= check("先交后评完的 AC 随后也被发现", "P1003" in by_user.scan_user("bob"))
+
+    server.shutdown()
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
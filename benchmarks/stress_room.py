@@ -0,0 +1,112 @@
+"""Room 并发压力测试：判题线程不停记分，同时用 HTTP 接口反复申请/同意/删除题目、加入/离开房间。
+
+检查两件事：
+- 任何线程都不能抛异常（例如 "set changed size during iteration"）；
+- 每一份快照里总分都等于 100 × 已解决题数（同一道题不会被重复记分，记分和判定是原子的）。
+
+    python benchmarks/stress_room.py --seconds 10
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_luogu import StubLuogu  # noqa: E402
+
+# 不碰真实的数据库和洛谷：用临时数据库，题目校验和判题的请求都打到本地桩服务器
+server, base_url = StubLuogu().serve()
+os.environ["LUOGU_BASE_URL"] = base_url
+os.environ["DATABASE"] = os.path.join(tempfile.mkdtemp(prefix="stress_room_"), "stress_room.db")
+import app  # noqa: E402  在设置好 LUOGU_BASE_URL 和 DATABASE 之后再导入
+
+RED = [f"red{i}" for i in range(3)]
+BLUE = [f"blue{i}" for i in range(3)]
+SOLVABLE = [f"P{1000 + i}" for i in range(500)]  # 只有这些题会被判题线程记分
+CHURN = [f"P{5000 + i}" for i in range(20)]      # 这些题被反复添加和删除
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post("/register", data={"luogu_name": name})
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--judges", type=int, default=4)
+    args = parser.parse_args()
+    # 让线程尽可能频繁地切换，放大竞争窗口
+    sys.setswitchinterval(1e-6)
+
+    room = app.Room("stress", "Red", "Blue")
+    room.record("create", problems=SOLVABLE)
+    for name in RED:
+        room.add_member("Red", name)
+    for name in BLUE:
+        room.add_member("Blue", name)
+    app.rooms[room.room_id] = room
+
+    stop = threading.Event()
+    errors = []
+    counts = {"solves": 0, "mutations": 0, "snapshots": 0}
+
+    def guarded(fn):
+        def run():
+            try:
+                while not stop.is_set():
+                    fn()
+            except Exception:
+                errors.append(traceback.format_exc())
+                stop.set()
+        return threading.Thread(target=run, daemon=True)
+
+    def judge():
+        pid = random.choice(SOLVABLE)
+        app.apply_ac_results(room, {pid: {random.choice(RED + BLUE)}})
+        app.judge_scheduler.collect([(room.room_id, room)])
+        counts["solves"] += 1
+
+    red, blue = login(RED[0]), login(BLUE[0])
+    guest = login("guest")
+
+    def mutate():
+        pid = random.choice(CHURN)
+        red.post("/api/propose", json={"room_id": room.room_id, "pid": pid, "team": "Red"})
+        blue.post("/api/accept_proposal", json={"room_id": room.room_id, "pid": pid})
+        red.post("/api/propose_delete", json={"room_id": room.room_id, "pid": pid, "team": "Red"})
+        blue.post("/api/accept_delete", json={"room_id": room.room_id, "pid": pid})
+        guest.post("/api/join", json={"room_id": room.room_id, "team": random.choice(["Red", "Blue"])})
+        guest.post("/api/leave", json={"room_id": room.room_id})
+        counts["mutations"] += 1
+
+    def observe():
+        status = room.get_status()
+        total = sum(status["scores"].values())
+        if total != 100 * len(status["solved"]):
+            raise AssertionError(f"scores {dict(status['scores'])} do not match solved {list(status['solved'])}")
+        app.room_snapshot(room)
+        counts["snapshots"] += 1
+
+    threads = [guarded(judge) for _ in range(args.judges)] + [guarded(mutate), guarded(mutate), guarded(observe)]
+    for thread in threads:
+        thread.start()
+    stop.wait(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print(f"solves={counts['solves']} mutations={counts['mutations']} snapshots={counts['snapshots']} "
+          f"scores={dict(room.scores)} solved={len(room.solved)} finished={room.finished}")
+    if errors:
+        print(errors[0])
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
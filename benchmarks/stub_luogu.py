@@ -0,0 +1,241 @@
+"""本地洛谷桩服务器：用录制好的 fixtures 返回 record/list 页面，供离线压测抓取后端。
+题目页 problem/<pid> 对题号数字 >= 900000 的题目返回 404，其余都当作存在；记录页 record/<id> 返回录制的记录。
+ScriptedLuogu 则按脚本实时产生提交（见 loadtest.py），可以模拟网络延迟。
+
+    python benchmarks/stub_luogu.py --port 8900
+    LUOGU_BASE_URL=http://127.0.0.1:8900 python app.py
+"""
+import argparse
+import copy
+import html
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+STATUS_NAMES = {0: "Waiting", 1: "Judging", 12: "Accepted", 14: "Unaccepted", 7: "Wrong Answer", 6: "Time Limit Exceeded"}
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def render_record_list_html(payload):
+    """把 JSON 渲染成和洛谷前端一致的 DOM（div.row / span.status-name），并内嵌 _feInjection。"""
+    rows = []
+    for record in payload["currentData"].get("records", {}).get("result", []):  # 题目页没有记录，只有 _feInjection
+        rows.append(
+            '<div class="row">'
+            f'<span class="status"><a href="/record/{record["id"]}">'
+            f'<span class="status-name">{STATUS_NAMES.get(record["status"], "Unknown Error")}</span></a></span>'
+            '<div class="user"><div><span><span><span>'
+            f'<a href="/user/{record["user"]["uid"]}"><span>{html.escape(record["user"]["name"])}</span></a>'
+            '</span></span></span></div></div>'
+            '</div>'
+        )
+    injection = urllib.parse.quote(json.dumps(payload, ensure_ascii=False))
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>评测记录</title>"
+        f'<script>window._feInjection = JSON.parse(decodeURIComponent("{injection}"));</script>'
+        f"</head><body><div class=\"border table\">{''.join(rows)}</div></body></html>"
+    )
+
+
+class StubLuogu:
+    def __init__(self, latency=0, jitter=0):
+        self.template = load_fixture("record_list.json")
+        self.latency = latency  # 每个请求的平均延迟（秒），上下浮动 jitter
+        self.jitter = jitter
+        self.requests = 0
+        self.counts = {"record_list": 0, "problem": 0, "record": 0}
+        self.lock = threading.Lock()
+
+    def record_list(self, query):
+        page = int(query.get("page", ["1"])[0])
+        payload = copy.deepcopy(self.template)
+        records = payload["currentData"]["records"]
+        if page > 1:
+            records["result"] = []
+        if "user" in query:
+            # 按用户查询：只保留该用户的记录，status 过滤和洛谷一致
+            user = query["user"][0]
+            status = int(query["status"][0]) if "status" in query else None
+            records["result"] = [
+                r for r in records["result"]
+                if r["user"]["name"] == user and (status is None or r["status"] == status)
+            ]
+        elif "pid" in query:
+            for record in records["result"]:
+                record["problem"]["pid"] = query["pid"][0]
+        records["count"] = len(records["result"])
+        return payload
+
+    def problem(self, pid):
+        """返回 (HTTP 状态码, payload)。"""
+        digits = "".join(c for c in pid if c.isdigit())
+        if not digits or int(digits) >= 900000:
+            return 404, {"code": 404, "currentTemplate": "ErrorPage", "currentData": {"errorMessage": "题目未找到"}}
+        problem = {"pid": pid, "title": f"Stub problem {pid}", "difficulty": int(digits) % 8}
+        return 200, {"code": 200, "currentTemplate": "ProblemShow", "currentData": {"problem": problem}}
+
+    def find_record(self, record_id):
+        return next((r for r in self.template["currentData"]["records"]["result"] if r["id"] == record_id), None)
+
+    def record(self, record_id):
+        """返回 (HTTP 状态码, payload)。"""
+        record = self.find_record(int(record_id)) if record_id.isdigit() else None
+        if record is None:
+            return 404, {"code": 404, "currentTemplate": "ErrorPage", "currentData": {"errorMessage": "记录未找到"}}
+        return 200, {"code": 200, "currentTemplate": "RecordShow", "currentData": {"record": record}}
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 支持 keep-alive
+
+            def do_GET(self):
+                parsed = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(parsed.query)
+                with stub.lock:
+                    stub.requests += 1
+                if stub.latency or stub.jitter:
+                    time.sleep(max(0, stub.latency + random.uniform(-stub.jitter, stub.jitter)))
+                status = 200
+                if parsed.path.startswith("/problem/"):
+                    kind = "problem"
+                    status, payload = stub.problem(urllib.parse.unquote(parsed.path[len("/problem/"):]))
+                elif parsed.path == "/record/list":
+                    kind = "record_list"
+                    payload = stub.record_list(query)
+                elif parsed.path.startswith("/record/"):
+                    kind = "record"
+                    status, payload = stub.record(parsed.path[len("/record/"):])
+                else:
+                    self.send_error(404)
+                    return
+                with stub.lock:
+                    stub.counts[kind] += 1
+                if query.get("_contentOnly"):
+                    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                    content_type = "application/json; charset=utf-8"
+                else:
+                    body = render_record_list_html(payload).encode("utf-8")
+                    content_type = "text/html; charset=utf-8"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=0):
+        """在后台线程启动服务，返回 (server, base_url)。"""
+        server = ThreadingHTTPServer((host, port), self.handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://{host}:{server.server_address[1]}"
+
+
+class ScriptedLuogu(StubLuogu):
+    """实时产生提交的洛谷桩：登记过的 (题目, 用户) 按泊松过程以 ac_rate 次/秒随机 AC，每对只 AC 一次；
+    另外以 wa_rate 次/秒产生不通过的提交，让增量扫描有新记录可翻。记录按编号倒序分页，和洛谷一致。
+    judge_delay 大于 0 时，新提交先以“评测中”出现，过这么多秒才变成最终结果。"""
+    def __init__(self, ac_rate, wa_rate=0, latency=0, jitter=0, per_page=20, seed=None, judge_delay=0):
+        super().__init__(latency, jitter)
+        self.ac_rate = ac_rate
+        self.wa_rate = wa_rate
+        self.per_page = per_page
+        self.judge_delay = judge_delay
+        self.random = random.Random(seed)
+        self.records = []    # 按提交顺序，编号递增
+        self.next_id = 200000000
+        self.pending = []    # 还没 AC 的 (pid, user)
+        self.landed = {}     # (pid, user) -> AC 结果出现的时间
+        self.judged_at = {}  # 记录编号 -> 评测完成的时间
+        self.wa_pairs = []   # 产生不通过提交时从这里挑
+
+    def expect(self, pairs):
+        """登记之后会 AC 的 (pid, user)。"""
+        with self.lock:
+            self.pending.extend(pairs)
+            self.wa_pairs.extend(pairs)
+
+    def submit(self, pid, user, accepted):
+        with self.lock:
+            self.next_id += 1
+            self.judged_at[self.next_id] = time.time() + self.judge_delay
+            self.records.append({
+                "id": self.next_id,
+                "status": 12 if accepted else 7,
+                "score": 100 if accepted else 0,
+                "submitTime": int(time.time()),
+                "problem": {"pid": pid, "title": f"Stub problem {pid}", "difficulty": 0, "type": pid[0]},
+                "user": {"uid": abs(hash(user)) % 10 ** 7, "name": user, "color": "Gray", "badge": None},
+            })
+            if accepted:
+                self.landed[(pid, user)] = self.judged_at[self.next_id]
+
+    def run(self, stop):
+        """在当前线程里产生提交，直到 stop（threading.Event）被设置。"""
+        rate = self.ac_rate + self.wa_rate
+        while rate and not stop.wait(self.random.expovariate(rate)):
+            with self.lock:
+                accepted = self.random.random() < self.ac_rate / rate
+                if accepted and not self.pending:
+                    continue
+                pool = self.pending if accepted else self.wa_pairs
+                if not pool:
+                    continue
+                pair = pool.pop(self.random.randrange(len(pool))) if accepted else self.random.choice(pool)
+            self.submit(*pair, accepted)
+
+    def visible(self, record, now):
+        """记录此刻在洛谷上的样子：还没评测完时状态是“评测中”。"""
+        if now >= self.judged_at[record["id"]]:
+            return record
+        return dict(record, status=1, score=0)
+
+    def find_record(self, record_id):
+        now = time.time()
+        with self.lock:
+            record = next((r for r in reversed(self.records) if r["id"] == record_id), None)
+            return record and self.visible(record, now)
+
+    def record_list(self, query):
+        page = int(query.get("page", ["1"])[0])
+        pid = query.get("pid", [None])[0]
+        user = query.get("user", [None])[0]
+        status = int(query["status"][0]) if "status" in query else None
+        now = time.time()
+        with self.lock:
+            matched = [
+                r for r in (self.visible(r, now) for r in reversed(self.records))
+                if (pid is None or r["problem"]["pid"] == pid)
+                and (user is None or r["user"]["name"] == user)
+                and (status is None or r["status"] == status)
+            ]
+        result = matched[(page - 1) * self.per_page:page * self.per_page]
+        return {
+            "code": 200,
+            "currentTemplate": "RecordList",
+            "currentData": {"records": {"result": result, "count": len(matched), "perPage": self.per_page}},
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), StubLuogu().handler())
+    print(f"[INFO] Stub Luogu listening on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,113 @@
+// 房间事件二进制帧的解码，格式见 app.py 的 WireCodec：1 字节标志（0 原样，1 zlib）+ 两个连续的
+// msgpack 对象——字符串表和消息体；消息体里 ext 类型 0 的数据是字符串表的下标。
+const LuoguWire = (() => {
+    const FORMAT = "msgpack-z1";
+    const REF = 0;
+    const textDecoder = typeof TextDecoder !== "undefined" ? new TextDecoder() : null;
+
+    function reader(bytes, table) {
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let pos = 0;
+
+        function take(length) {
+            const chunk = bytes.subarray(pos, pos + length);
+            pos += length;
+            return chunk;
+        }
+        function str(length) {
+            return textDecoder.decode(take(length));
+        }
+        function array(length) {
+            const out = new Array(length);
+            for (let i = 0; i < length; i++) out[i] = read();
+            return out;
+        }
+        function map(length) {
+            const out = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                out[key] = read();
+            }
+            return out;
+        }
+        function ext(length) {
+            const type = view.getInt8(pos++);
+            const data = take(length);
+            if (type !== REF) throw new Error(`unknown msgpack ext type ${type}`);
+            let index = 0;
+            for (const byte of data) index = index * 256 + byte;
+            return table[index];
+        }
+        function u8() { return bytes[pos++]; }
+        function u16() { const value = view.getUint16(pos); pos += 2; return value; }
+        function u32() { const value = view.getUint32(pos); pos += 4; return value; }
+
+        function read() {
+            const byte = bytes[pos++];
+            if (byte <= 0x7f) return byte;
+            if (byte <= 0x8f) return map(byte & 0x0f);
+            if (byte <= 0x9f) return array(byte & 0x0f);
+            if (byte <= 0xbf) return str(byte & 0x1f);
+            if (byte >= 0xe0) return byte - 0x100;
+            let value;
+            switch (byte) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return take(u8()).slice();
+                case 0xc5: return take(u16()).slice();
+                case 0xc6: return take(u32()).slice();
+                case 0xc7: return ext(u8());
+                case 0xc8: return ext(u16());
+                case 0xc9: return ext(u32());
+                case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+                case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+                case 0xcc: return u8();
+                case 0xcd: return u16();
+                case 0xce: return u32();
+                case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+                case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+                case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+                case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+                case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+                case 0xd4: return ext(1);
+                case 0xd5: return ext(2);
+                case 0xd6: return ext(4);
+                case 0xd7: return ext(8);
+                case 0xd8: return ext(16);
+                case 0xd9: return str(u8());
+                case 0xda: return str(u16());
+                case 0xdb: return str(u32());
+                case 0xdc: return array(u16());
+                case 0xdd: return array(u32());
+                case 0xde: return map(u16());
+                case 0xdf: return map(u32());
+            }
+            throw new Error(`unsupported msgpack type 0x${byte.toString(16)}`);
+        }
+        return read;
+    }
+
+    async function inflate(bytes) {
+        const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+
+    async function decode(buffer) {
+        let bytes = new Uint8Array(buffer);
+        const compressed = bytes[0] === 1;
+        bytes = bytes.subarray(1);
+        if (compressed) bytes = await inflate(bytes);
+        const table = [];
+        const read = reader(bytes, table);
+        table.push(...read());
+        return read();
+    }
+
+    return {
+        FORMAT,
+        decode,
+        // 解压要用 DecompressionStream，老浏览器不声明支持，服务器就继续发 JSON
+        supported: textDecoder !== null && typeof DecompressionStream !== "undefined",
+    };
+})();